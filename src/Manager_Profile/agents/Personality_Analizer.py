@@ -4,7 +4,11 @@ from spade.message import Message
 from spade.template import Template
 
 import json
+import asyncio
 import requests
+from utils.constants import (MOODLE_JID, EMBEDDING_MODEL, ANSWER_CACHE_FILE, ANSWER_CACHE_THRESHOLD,
+                             ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_MAX_AGE, ANSWER_CACHE_PARAM_TOLERANCE)
+from utils.answer_cache import SemanticAnswerCache
 
 class PersonalityAnalyzerAgent(Agent):
              
@@ -36,6 +40,11 @@ class PersonalityAnalyzerAgent(Agent):
             if msg_profile and msg_profile.metadata["phase"] == "profile":
                 data= json.loads(msg_profile.body)
                 profile= data["profile"]
+                # Pregunta ya respondida con los mismos parámetros: ni LLM ni búsqueda,
+                # pero la interacción sigue contando para el perfil
+                if await self._answer_from_cache(data["raw_query"], profile):
+                    await self._send_interaction(data["user_id"], self._cached_interaction(profile))
+                    return
                 # Construir prompt para análisis de personalidad y query
                 prompt = await self._build_analysis_prompt(data["raw_query"], profile)
 
@@ -49,21 +58,66 @@ class PersonalityAnalyzerAgent(Agent):
                 next_msg = Message(to="search_agent@localhost")
                 next_msg.set_metadata("phase", "query")
                 next_msg.body = json.dumps({
-                    "query": structured_data["expanded_query"]
+                    "query": structured_data["expanded_query"],
+                    "raw_query": data["raw_query"]
                 })
                 await self.send(next_msg)
-                next_msg = Message(
-                    to= "profilemanageragent@localhost",
-                    body=json.dumps
-                    ({
-                        "user_id": data["user_id"],
-                        "interaction_data": structured_data["interaction_data"],
-                    }),
-                    metadata={"phase":"interaction"}
-                )
-                await self.send(next_msg)
+                await self._send_interaction(data["user_id"], structured_data["interaction_data"])
             
-             
+        async def _send_interaction(self, user_id, interaction_data):
+            """Envía la interacción al ProfileManager para que actualice el perfil"""
+            msg = Message(
+                to= "profilemanageragent@localhost",
+                body=json.dumps
+                ({
+                    "user_id": user_id,
+                    "interaction_data": interaction_data,
+                }),
+                metadata={"phase":"interaction"}
+            )
+            await self.send(msg)
+
+        def _cached_interaction(self, profile):
+            """
+            Interacción mínima de una respuesta cacheada: sin LLM no hay análisis del mensaje,
+            así que se repiten el humor, la formalidad y el estilo dominante del perfil (no lo
+            desplazan) y la interacción cuenta para el historial y el engagement.
+            """
+            comunicacion = profile.get('preferences', {}).get('communication', {})
+            interaction = {}
+            if 'humor' in comunicacion:
+                interaction["humor_score"] = comunicacion['humor']
+            if 'formality' in comunicacion:
+                interaction["formality_level"] = comunicacion['formality']
+            style_weights = comunicacion.get('style_weights') or {}
+            if style_weights:
+                interaction["response_style"] = max(style_weights, key=style_weights.get)
+            return interaction
+
+        async def _answer_from_cache(self, raw_query, profile):
+            """Envía a Moodle la respuesta cacheada de una pregunta parecida, si la hay"""
+            # Sin parámetros optimizados todavía no se sabe con qué estilo se respondería
+            params = profile.get('metadata', {}).get('optimized_params')
+            if not params:
+                return False
+            cache = self.agent.answer_cache
+            try:
+                embedding = await asyncio.get_running_loop().run_in_executor(None, cache.encode, raw_query)
+                entry = cache.lookup(embedding, params)
+            except Exception as e:
+                print(f"PersonalityAnalyzer: Error en la caché de respuestas - {str(e)}")
+                return False
+            if entry is None:
+                print(f"PersonalityAnalyzer: Caché de respuestas sin acierto {cache.stats()}")
+                return False
+            print(f"PersonalityAnalyzer: Respuesta cacheada para '{raw_query}' "
+                  f"(similar a '{entry['query']}', {entry['similarity']:.3f}) {cache.stats()}")
+            msg = Message(to=MOODLE_JID)
+            msg.set_metadata("phase", "final")
+            msg.body = json.dumps({"final_answer": entry["answer"]})
+            await self.send(msg)
+            return True
+
         async def _build_analysis_prompt(self, raw_query, profile):
             """Construye el prompt para el análisis de personalidad y expansión de query"""
             hist_prefs=profile.get('preferences',{}).get('history_specific',{})
@@ -153,6 +207,11 @@ class PersonalityAnalyzerAgent(Agent):
             content= response['choices'][0]['message']['content']
             return content
     async def setup(self):
+        self.answer_cache = SemanticAnswerCache(
+            ANSWER_CACHE_FILE, EMBEDDING_MODEL, threshold=ANSWER_CACHE_THRESHOLD,
+            max_entries=ANSWER_CACHE_MAX_ENTRIES, max_age=ANSWER_CACHE_MAX_AGE,
+            param_tolerance=ANSWER_CACHE_PARAM_TOLERANCE
+        )
         Template_Behaviour= Template()
         Template_Behaviour.metadata= {"phase":"analyzer"}
         self.add_behaviour(self.SearchProfileBehaviour(),Template_Behaviour)
@@ -1,16 +1,16 @@
 import json
 import asyncio
-import pickle
 import time
 import numpy as np
-from nltk.tokenize import word_tokenize
 from spade.agent import Agent
-from spade.behaviour import CyclicBehaviour
+from spade.behaviour import CyclicBehaviour, PeriodicBehaviour
 from spade.message import Message
 from spade.template import Template
-from rank_bm25 import BM25Okapi
-from utils.constants import METADATA_FILE, PROMPT_JID, SCRAPER_JID, CONFIDENCE_THRESHOLD, CRAWLER_JID
+from utils.constants import INDEX_FILE, CHUNK_STORE_DIR, MANIFEST_FILE, INDEX_RELOAD_PERIOD, PROMPT_JID, SCRAPER_JID, CONFIDENCE_THRESHOLD, CRAWLER_JID, PROMPT_CONTEXT_CHARS
 from utils.helpers import safe_json_dumps
+from utils.bm25 import BM25Index
+from utils.tokenizer import tokenize, tokenize_query
+from utils.index_holder import IndexHolder
 import logging
 import spacy
 
@@ -24,12 +24,10 @@ class EvaluationAgent(Agent):
         self.current_query = ""
         
     async def setup(self):
-        with open(METADATA_FILE, "rb") as f:
-            self.metadata = pickle.load(f)
-        
-        self.chunks = [entry['text'] for entry in self.metadata]
-        self.tokenized_chunks = [word_tokenize(chunk.lower(), language='spanish') for chunk in self.chunks]
-        self.bm25 = BM25Okapi(self.tokenized_chunks)
+        # Almacén de chunks y BM25 que dejó la construcción del índice, mapeados en memoria
+        # y recargados con cada generación; los ids solo se resuelven en la generación con
+        # la que el SearchAgent los mandó (snapshot_for)
+        self.index_holder = IndexHolder(INDEX_FILE, CHUNK_STORE_DIR, MANIFEST_FILE, load_index=False)
         
         self.query_analyzer = QueryAnalyzer()
         self.score_normalizer = ScoreNormalizer()
@@ -39,11 +37,34 @@ class EvaluationAgent(Agent):
         
         self.add_behaviour(self.EvaluationBehaviour(), eval_template)
         self.add_behaviour(self.ScraperResponseBehaviour(), scrape_template)
+        self.add_behaviour(self.IndexReloadBehaviour(period=INDEX_RELOAD_PERIOD))
         
         logger.info(f"{self.jid} iniciado correctamente")
 
+    async def snapshot_for(self, generation):
+        """
+        Instantánea de la generación con la que el SearchAgent asignó los ids de los
+        candidatos, recargando si la de este agente va por detrás. Devuelve None si no
+        se puede tener (el SearchAgent aún no recargó, o el mensaje no trae generación):
+        los ids de otra generación apuntan a otros chunks y hay que usar los textos recibidos.
+        """
+        if generation is None:
+            return None
+        if self.index_holder.current.generation != generation:
+            await self.index_holder.refresh()
+        snapshot = self.index_holder.current
+        if snapshot.generation != generation:
+            logger.info(f"EvaluationAgent: candidatos de la generación {generation} y almacén de la "
+                        f"{snapshot.generation}; se usan los textos recibidos")
+            return None
+        return snapshot
+
+    class IndexReloadBehaviour(PeriodicBehaviour):
+        async def run(self):
+            await self.agent.index_holder.refresh()
+
     class EvaluationBehaviour(CyclicBehaviour):
-        async def trigger_scraping(self, query, candidates, original_sender):
+        async def trigger_scraping(self, query, candidates, original_sender, raw_query="", generation=None):
             max_score = max(c["final_score"] for c in candidates) if candidates else 0
             
             if max_score < CONFIDENCE_THRESHOLD:
@@ -53,7 +74,9 @@ class EvaluationAgent(Agent):
                 "candidates": candidates,
                 "timestamp": time.time(),
                 "sender": str(original_sender),
-                "query_tokens": word_tokenize(query.lower(), language='spanish')
+                "raw_query": raw_query,
+                "generation": generation,
+                "query_tokens": tokenize_query(query)
             }
             
             scrape_msg = Message(to=CRAWLER_JID)
@@ -64,9 +87,10 @@ class EvaluationAgent(Agent):
             })
             await self.send(scrape_msg)
 
-        async def send_to_prompt(self, query, candidates, original_sender):
+        async def send_to_prompt(self, query, candidates, original_sender, raw_query="", snapshot=None):
             sorted_candidates = sorted(candidates, key=lambda c: c["final_score"], reverse=True)[:10]
-            context = " ".join(c["text"] for c in sorted_candidates)
+            # Los chunks ganadores se sustituyen por sus padres, sin repetir
+            context = self.agent.build_context(sorted_candidates, snapshot)
             
             sources = "local"
             if any(c.get("source") == "internet" for c in sorted_candidates):
@@ -77,8 +101,10 @@ class EvaluationAgent(Agent):
             msg.set_metadata("original_sender", str(original_sender))
             msg.body = safe_json_dumps({
                 "query": query,
+                "raw_query": raw_query,
                 "context": context,
-                "sources": sources
+                "sources": sources,
+                "candidate_ids": [c["id"] for c in sorted_candidates if "id" in c]
             })
             await self.send(msg)
             logger.info(f"EvaluationAgent: Contexto enviado a PromptAgent para '{query}'")
@@ -91,16 +117,21 @@ class EvaluationAgent(Agent):
             try:
                 data = json.loads(msg.body)
                 query = data.get("query", "")
+                raw_query = data.get("raw_query", "")
+                generation = data.get("generation")
                 self.agent.current_query = query
                 candidates = data.get("candidates", [])
                 original_sender = msg.sender
+                snapshot = await self.agent.snapshot_for(generation)
 
-                query_tokens = word_tokenize(query.lower(), language='spanish')
+                query_tokens = tokenize_query(query)
                 query_type = self.agent.query_analyzer.analyze(query)
                 logger.info(f"EvaluationAgent: Tipo de consulta '{query_type}' para: '{query}'")
 
                 # Normalización de puntajes FAISS
-                faiss_raw_scores = [1.0 / (1.0 + c["distance"]) for c in candidates] if candidates else []
+                # Los candidatos que solo encontró BM25 no tienen distancia y no suman por FAISS
+                faiss_raw_scores = [1.0 / (1.0 + c["distance"]) if c.get("distance") is not None else 0.0
+                                    for c in candidates]
                 
                 faiss_norm = []
                 if faiss_raw_scores:
@@ -119,13 +150,14 @@ class EvaluationAgent(Agent):
                 #Sistema de bonificación
                 candidate_bm25_scores = []
                 if candidates:
-                    bm25_full_scores = self.agent.bm25.get_scores(query_tokens)
-                    
-                    for i, candidate in enumerate(candidates):
-                        candidate_index = candidate.get("id", i)
-                        score = bm25_full_scores[candidate_index] if candidate_index < len(bm25_full_scores) else 0
-                        
-                        candidate_bm25_scores.append(score)
+                    # Solo los candidatos: el coste no depende del tamaño del corpus
+                    if snapshot is not None and snapshot.bm25 is not None:
+                        candidate_ids = [candidate.get("id", -1) for candidate in candidates]
+                        candidate_bm25_scores = snapshot.bm25.score(query_tokens, candidate_ids).tolist()
+                    else:
+                        # Sin el BM25 de su generación: se puntúan los textos recibidos entre sí
+                        local_bm25 = BM25Index.from_tokens([tokenize(candidate["text"]) for candidate in candidates])
+                        candidate_bm25_scores = local_bm25.score(query_tokens, np.arange(len(candidates))).tolist()
                     
                     # Normalización BM25
                     bm25_norm = self.agent.score_normalizer.robust_scale(candidate_bm25_scores)
@@ -164,9 +196,9 @@ class EvaluationAgent(Agent):
                     logger.info(f"EvaluationBehaviour: max final_score = {max_score:.2f}")
 
                     if max_score < CONFIDENCE_THRESHOLD:
-                        await self.trigger_scraping(query, ranked_candidates, original_sender)
+                        await self.trigger_scraping(query, ranked_candidates, original_sender, raw_query, generation)
                     else:
-                        await self.send_to_prompt(query, ranked_candidates, original_sender)
+                        await self.send_to_prompt(query, ranked_candidates, original_sender, raw_query, snapshot)
                 else:
                     logger.warning("No hay candidatos para evaluar")
                 
@@ -201,9 +233,8 @@ class EvaluationAgent(Agent):
                 # Calcular BM25 para los nuevos chunks
                 outer_scores = []
                 if scraped_chunks:
-                    tokenized_outer = [word_tokenize(chunk.lower(), language='spanish') for chunk in scraped_chunks]
-                    outer_bm25 = BM25Okapi(tokenized_outer)
-                    outer_scores = outer_bm25.get_scores(query_tokens)
+                    outer_bm25 = BM25Index.from_tokens([tokenize(chunk) for chunk in scraped_chunks])
+                    outer_scores = outer_bm25.score(query_tokens, np.arange(len(scraped_chunks)))
                     outer_norm = self.agent.score_normalizer.sigmoid_scale(outer_scores, a=10)
                 else:
                     outer_norm = []
@@ -226,15 +257,18 @@ class EvaluationAgent(Agent):
                 # Re-rankear
                 combined_candidates.sort(key=lambda x: x["final_score"], reverse=True)
                 sorted_candidates = combined_candidates[:10]
-                context = " ".join(c["text"] for c in sorted_candidates)
+                snapshot = await self.agent.snapshot_for(state.get("generation"))
+                context = self.agent.build_context(sorted_candidates, snapshot)
                 
                 prompt_msg = Message(to=PROMPT_JID)
                 prompt_msg.set_metadata("phase", "prompt")
                 prompt_msg.set_metadata("original_sender", original_sender)
                 prompt_msg.body = safe_json_dumps({
                     "query": query,
+                    "raw_query": state.get("raw_query", ""),
                     "context": context,
-                    "sources": "local+outerpedia"
+                    "sources": "local+outerpedia",
+                    "candidate_ids": [c["id"] for c in sorted_candidates if "id" in c]
                 })
                 await self.send(prompt_msg)
                 logger.info(f"EvaluationAgent: Contexto mejorado enviado a PromptAgent para '{query}'")
@@ -244,6 +278,34 @@ class EvaluationAgent(Agent):
                 import traceback
                 traceback.print_exc()
 
+    def build_context(self, candidates, snapshot=None, max_chars=PROMPT_CONTEXT_CHARS):
+        """
+        Contexto para el prompt a partir de los candidatos ya ordenados. Cada chunk local
+        se expande a su chunk padre en `snapshot` (la instantánea de la generación de sus
+        ids); varios hijos del mismo padre aportan el padre una sola vez, en la posición
+        del mejor de ellos. Sin instantánea se usa el texto de cada candidato.
+        Se añaden textos hasta `max_chars`.
+        """
+        parts, seen, size = [], set(), 0
+        for candidate in candidates:
+            chunk_id = candidate.get("id")
+            if (snapshot is None or candidate.get("source") == "internet" or chunk_id is None
+                    or chunk_id >= len(snapshot.chunks)):
+                key, text = ("text", candidate["text"]), candidate["text"]
+            else:
+                chunks = snapshot.chunks
+                parent_id = int(chunks.parents[chunk_id])
+                key = ("parent", parent_id) if parent_id >= 0 else ("chunk", chunk_id)
+                text = chunks.context_text(chunk_id)
+            if key in seen or not text:
+                continue
+            if parts and size + len(text) > max_chars:
+                continue
+            seen.add(key)
+            parts.append(text)
+            size += len(text)
+        return " ".join(parts)
+
     def get_adaptive_weights(self, query_type, candidate, query_tokens):
         base_weights = {
             "factual": {"faiss": 0.6, "bm25": 0.4},
@@ -5,13 +5,23 @@ import requests
 from spade.agent import Agent
 from spade.behaviour import CyclicBehaviour
 from spade.message import Message
-from utils.constants import INITIATOR_JID, HF_MODEL,MOODLE_JID
+from utils.constants import (INITIATOR_JID, HF_MODEL, MOODLE_JID, EMBEDDING_MODEL, ANSWER_CACHE_FILE,
+                             ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_MAX_AGE,
+                             ANSWER_CACHE_PARAM_TOLERANCE)
+from utils.answer_cache import SemanticAnswerCache
+
+FAILED_ANSWER = "No se pudo generar una respuesta. Por favor intenta nuevamente."
 
 class PromptAgent(Agent):
     async def setup(self):
         self.hf_api_token = os.getenv("HF_API_TOKEN")
         self.add_behaviour(self.PromptBehaviour())
         self.params={}
+        self.answer_cache = SemanticAnswerCache(
+            ANSWER_CACHE_FILE, EMBEDDING_MODEL, threshold=ANSWER_CACHE_THRESHOLD,
+            max_entries=ANSWER_CACHE_MAX_ENTRIES, max_age=ANSWER_CACHE_MAX_AGE,
+            param_tolerance=ANSWER_CACHE_PARAM_TOLERANCE
+        )
         print(f"{self.jid} iniciado correctamente")
 
     class PromptBehaviour(CyclicBehaviour):
@@ -33,11 +43,22 @@ class PromptAgent(Agent):
                         new_msg.body = json.dumps({"final_answer": final_answer})
                         await self.send(new_msg)
                         print("DistributedPromptAgent: Respuesta enviada")
+                        if data.get("raw_query") and final_answer != FAILED_ANSWER:
+                            await self.cache_answer(data, final_answer)
                 except Exception as e:
                     print(f"DistributedPromptAgent: Error - {str(e)}")
             else:
                 await asyncio.sleep(1)
 
+        async def cache_answer(self, data, final_answer):
+            """Guarda la respuesta para reutilizarla en preguntas parecidas del mismo perfil"""
+            try:
+                cache = self.agent.answer_cache
+                embedding = await asyncio.get_running_loop().run_in_executor(None, cache.encode, data["raw_query"])
+                cache.store(embedding, data["raw_query"], self.agent.params, data.get("candidate_ids", []), final_answer)
+            except Exception as e:
+                print(f"DistributedPromptAgent: Error guardando en la caché de respuestas - {str(e)}")
+
         async def generate_final_answer(self, query, context,params, max_new_tokens=250, num_beams=5, max_retries=3):
     
             prompt_template0 = """ 
@@ -314,7 +335,7 @@ Adaptive precision response: """
                     print(f"Error en conexión: {str(e)}")
                     await asyncio.sleep(5)
             
-            return "No se pudo generar una respuesta. Por favor intenta nuevamente."
+            return FAILED_ANSWER
 
         
 def call_endpoint(body):
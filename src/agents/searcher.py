@@ -1,20 +1,31 @@
 import os
-import pickle
 import faiss
 import numpy as np
 import json
 import asyncio
-from nltk.tokenize import word_tokenize
+from concurrent.futures import ThreadPoolExecutor
 from spade.agent import Agent
-from spade.behaviour import CyclicBehaviour
+from spade.behaviour import CyclicBehaviour, PeriodicBehaviour
 from spade.message import Message
-from rank_bm25 import BM25Okapi
 from sentence_transformers import SentenceTransformer
-from utils.constants import INDEX_FILE, METADATA_FILE, DOCUMENTS_FOLDER, EVAL_JID
+from utils.constants import (
+    INDEX_FILE, INDEX_MMAP, INDEX_RELOAD_PERIOD, CHUNK_STORE_DIR, MANIFEST_FILE, DOCUMENTS_FOLDER, EVAL_JID,
+    EMBEDDING_MODEL, EMBEDDER_MISMATCH_POLICY, SEARCH_TOP_K, SEARCH_BATCH_WINDOW_MS, SEARCH_BATCH_MAX,
+    SEARCH_WORKERS, SEARCH_QUEUE_SIZE, QUERY_CACHE_SIZE, QUERY_CACHE_TTL, HYBRID_DEPTH, RRF_K
+)
+from utils.bm25 import reciprocal_rank_fusion, bm25_index_current
+from utils.tokenizer import tokenize_query
 from utils.helpers import safe_json_dumps
-from indexer import build_index
+from utils.chunk_store import store_exists
+from utils.index_holder import IndexHolder
+from utils.index_manifest import embedder_fingerprint, fingerprint_mismatches
+from utils.query_batcher import QueryBatcher
+from utils.query_cache import QueryCache
+from indexer import build_index, index_chunker, migrate_index
 from ontology.ontology import OntologyManager
+import logging
 
+logger = logging.getLogger(__name__)
 ontology_man = OntologyManager()
 class SearchAgent(Agent):
     async def setup(self):
@@ -22,48 +33,172 @@ class SearchAgent(Agent):
         if not os.path.exists(DOCUMENTS_FOLDER):
             os.makedirs(DOCUMENTS_FOLDER, exist_ok=True)
             
-        if not (os.path.exists(INDEX_FILE) and os.path.exists(METADATA_FILE)):
+        # Un índice sin BM25 (o con el de otro tokenizador) también pasa por build_index, que solo rehace el BM25
+        if not (os.path.exists(INDEX_FILE) and store_exists(CHUNK_STORE_DIR) and bm25_index_current(CHUNK_STORE_DIR)):
             print(f"Construyendo base desde {DOCUMENTS_FOLDER}...")
-            build_index(DOCUMENTS_FOLDER, INDEX_FILE, METADATA_FILE)
+            build_index(DOCUMENTS_FOLDER, INDEX_FILE, CHUNK_STORE_DIR, MANIFEST_FILE)
             
-        self.index = faiss.read_index(INDEX_FILE)
-        with open(METADATA_FILE, "rb") as f:
-            self.metadata = pickle.load(f)
-        self.chunks = [entry['text'] for entry in self.metadata]
-        self.tokenized_chunks = [word_tokenize(chunk.lower()) for chunk in self.chunks]
-        self.bm25 = BM25Okapi(self.tokenized_chunks)
-        self.embedder = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+        # Índice mapeado en memoria (las réplicas comparten páginas) con los nprobe/efSearch
+        # calibrados al construirlo; se recarga en caliente cuando cambia la generación
+        self.index_holder = IndexHolder(INDEX_FILE, CHUNK_STORE_DIR, MANIFEST_FILE, INDEX_MMAP)
+        # Las consultas se codifican con el mismo modelo que los chunks del índice
+        self.embedders = {EMBEDDING_MODEL: SentenceTransformer(EMBEDDING_MODEL)}
         #self.embedder =  TextEmbedding("sentence-transformers/all-MiniLM-L6-v2", cache_dir="model_cache")
+        self.migration = None
+        self.verify_embedder()
+        # Las consultas que llegan dentro de la misma ventana se codifican y buscan juntas,
+        # en hilos propios: el modelo y FAISS liberan el GIL y el event loop sigue libre
+        self.search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search")
+        self.search_batcher = QueryBatcher(
+            self.search_batch, SEARCH_BATCH_WINDOW_MS, SEARCH_BATCH_MAX,
+            executor=self.search_executor, max_inflight=SEARCH_WORKERS, max_pending=SEARCH_QUEUE_SIZE
+        )
+        self.search_tasks = set()
+        # Resultados de las consultas repetidas (se vacía al cambiar la generación del índice)
+        self.query_cache = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+        self.query_cache_reported = 0
         
         self.add_behaviour(self.SearchBehaviour())
+        self.add_behaviour(self.IndexReloadBehaviour(period=INDEX_RELOAD_PERIOD))
         print(f"{self.jid} iniciado correctamente")
 
-    class SearchBehaviour(CyclicBehaviour):
+    def verify_embedder(self):
+        """
+        Compara la huella del embedder guardada en el manifiesto con la configuración
+        actual. Si no coincide, según EMBEDDER_MISMATCH_POLICY, no arranca o lanza la
+        reconstrucción en segundo plano y sigue sirviendo el índice anterior con su
+        propio modelo hasta que el nuevo esté listo.
+        """
+        manifest = self.index_holder.current.manifest
+        dimension = self.embedders[EMBEDDING_MODEL].get_sentence_embedding_dimension()
+        expected = embedder_fingerprint(EMBEDDING_MODEL, dimension, index_chunker(EMBEDDING_MODEL))
+        mismatches = fingerprint_mismatches(manifest.get("embedder"), expected)
+        if not mismatches:
+            return
+        message = (f"El índice {INDEX_FILE} no coincide con el embedder configurado ({', '.join(mismatches)}): "
+                   f"índice={manifest.get('embedder', {}).get('model_id')}, consultas={EMBEDDING_MODEL}")
+        if EMBEDDER_MISMATCH_POLICY == "refuse":
+            raise RuntimeError(message)
+
+        logger.warning(f"{message}. Se reconstruye en segundo plano.")
+        # Mientras tanto se sirve el índice anterior con el modelo que lo construyó
+        self.encoder_for(self.index_holder.current)
+        loop = asyncio.get_running_loop()
+        self.migration = loop.run_in_executor(
+            None, migrate_index, DOCUMENTS_FOLDER, INDEX_FILE, CHUNK_STORE_DIR, MANIFEST_FILE
+        )
+
+    def encoder_for(self, snapshot):
+        """Modelo con el que se construyó la instantánea, o None si no se sabe (índice sin huella)."""
+        embedder = snapshot.manifest.get("embedder") or {}
+        model_id = embedder.get("model_id")
+        if model_id is None:
+            return None
+        if model_id not in self.embedders:
+            self.embedders[model_id] = SentenceTransformer(model_id)
+        return self.embedders[model_id]
+
+    def search_batch(self, queries):
+        """
+        Búsqueda híbrida de un lote. Las consultas se codifican en una sola pasada del
+        modelo y se buscan con una sola llamada a index.search; cada una se busca además
+        en el índice BM25, y los HYBRID_DEPTH primeros de cada lista se fusionan con
+        reciprocal rank fusion en los SEARCH_TOP_K finales.
+        Devuelve, por consulta, (instantánea, embedding, distancias, ids); la distancia
+        es NaN para los chunks que solo encontró BM25.
+        """
+        # La instantánea se fija para todo el lote: una recarga en medio no le afecta
+        snapshot = self.index_holder.current
+        embedder = self.encoder_for(snapshot)
+        embeddings = None
+        if embedder is not None:
+            embeddings = np.ascontiguousarray(embedder.encode(queries, batch_size=len(queries)), dtype='float32')
+            if snapshot.manifest["embedder"].get("normalized"):
+                faiss.normalize_L2(embeddings)
+            distances, indices = snapshot.index.search(embeddings, HYBRID_DEPTH)
+        else:
+            # Índice sin huella: sus distancias no serían comparables con la consulta
+            distances = np.empty((len(queries), 0), dtype='float32')
+            indices = np.empty((len(queries), 0), dtype='int64')
+
+        results = []
+        for i, query in enumerate(queries):
+            found = indices[i] >= 0
+            dense_ids, dense_distances = indices[i][found], distances[i][found]
+            sparse_ids = snapshot.bm25.search(tokenize_query(query), HYBRID_DEPTH)[0] if snapshot.bm25 is not None else []
+            ids, _ = reciprocal_rank_fusion([dense_ids, sparse_ids], RRF_K, SEARCH_TOP_K)
+            dense = dict(zip(dense_ids.tolist(), dense_distances.tolist()))
+            fused_distances = np.array([dense.get(chunk_id, np.nan) for chunk_id in ids.tolist()], dtype='float32')
+            embedding = embeddings[i] if embeddings is not None else None
+            results.append((snapshot, embedding, fused_distances, ids))
+        return results
+
+    class IndexReloadBehaviour(PeriodicBehaviour):
         async def run(self):
-            msg = await self.receive(timeout=10)
-            if msg and msg.get_metadata("phase") == "query":
+            # Tasa de aciertos de la caché de consultas, si hubo consultas desde el último informe
+            stats = self.agent.query_cache.stats()
+            lookups = stats["hits"] + stats["misses"]
+            if lookups != self.agent.query_cache_reported:
+                self.agent.query_cache_reported = lookups
+                logger.info(f"QueryCache: {stats['hits']} aciertos, {stats['misses']} fallos "
+                            f"({stats['hit_rate']:.1%}), {stats['entries']} consultas, generación {stats['generation']}")
+            if await self.agent.index_holder.refresh():
+                # Tras una migración el modelo del índice anterior ya no hace falta
+                current = (self.agent.index_holder.current.manifest.get("embedder") or {}).get("model_id")
+                for model_id in list(self.agent.embedders):
+                    if model_id not in (current, EMBEDDING_MODEL):
+                        del self.agent.embedders[model_id]
+
+    class SearchBehaviour(CyclicBehaviour):
+        async def handle_query(self, msg):
+            try:
                 payload = json.loads(msg.body)
                 query = payload.get("query", "")
                 print(f"DistributedSearchAgent: Consulta recibida: {query}")
-                
+
                 query = ontology_man.expand_query(query)
-                
-                query_embedding = self.agent.embedder.encode([query])[0]
-                query_embedding = np.array([query_embedding])
-                distances, indices = self.agent.index.search(query_embedding, 10)
-                
+                snapshot = self.agent.index_holder.current
+                cached = self.agent.query_cache.get(query, snapshot.generation)
+                if cached is not None:
+                    # Consulta repetida: ni modelo ni FAISS
+                    _, distances, indices = cached
+                else:
+                    snapshot, embedding, distances, indices = await self.agent.search_batcher.submit(query)
+                    # Si el índice se recargó mientras el lote estaba en vuelo, el resultado es de
+                    # la generación anterior: no se guarda (ni vacía la caché de la actual)
+                    if embedding is not None and snapshot.generation == self.agent.index_holder.current.generation:
+                        self.agent.query_cache.put(query, snapshot.generation, (embedding, distances, indices))
+
                 candidates = []
-                for dist, idx in zip(distances[0], indices[0]):
+                for dist, idx in zip(distances, indices):
                     candidates.append({
                         "id": int(idx),
-                        "text": self.agent.metadata[idx]['text'],
-                        "distance": float(dist)
+                        "text": snapshot.chunks.text(idx),
+                        # Sin distancia: lo encontró solo BM25
+                        "distance": None if np.isnan(dist) else float(dist)
                     })
-                
+
                 new_msg = Message(to=EVAL_JID)
                 new_msg.set_metadata("phase", "evaluation")
-                new_msg.body = safe_json_dumps({"query": query, "candidates": candidates})
+                new_msg.body = safe_json_dumps({
+                    "query": query,
+                    "raw_query": payload.get("raw_query", ""),
+                    # Los ids solo valen en esta generación del almacén
+                    "generation": snapshot.generation,
+                    "candidates": candidates
+                })
                 await self.send(new_msg)
                 print("DistributedSearchAgent: Resultados enviados para evaluación")
+            except Exception as e:
+                logger.warning(f"SearchBehaviour ERROR: {str(e)}")
+
+        async def run(self):
+            msg = await self.receive(timeout=10)
+            if msg and msg.get_metadata("phase") == "query":
+                # Cada consulta se atiende en su propia tarea: mientras espera su lote la
+                # behaviour sigue recibiendo, y las que llegan a la vez comparten lote
+                task = asyncio.create_task(self.handle_query(msg))
+                self.agent.search_tasks.add(task)
+                task.add_done_callback(self.agent.search_tasks.discard)
             else:
-                await asyncio.sleep(1)
\ No newline at end of file
+                await asyncio.sleep(1)
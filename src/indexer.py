@@ -1,21 +1,22 @@
 import os
 import glob
-import pickle
-import faiss
-import requests
-from sentence_transformers import SentenceTransformer
+import shutil
 import nltk
 from nltk.tokenize import sent_tokenize
 import time
+import asyncio
 import logging
-import json
-import numpy as np
-import random
-from collections import defaultdict
 from bs4 import BeautifulSoup
 import re
+from functools import partial
 from utils.logging import configure_logging
-from utils.chunking import chunk_fixed_char, chunk_fixed_tokens, chunk_paragraph_based, chunk_recursive, chunk_sentence_based, chunk_sliding_window
+from utils.chunking import chunk_fixed_char, chunk_fixed_tokens, chunk_paragraph_based, chunk_recursive, chunk_sentence_based, chunk_sliding_window, chunk_token_budget, chunk_token_budget_ranges, embedder_token_budget
+from utils.corpus import read_text_mmap
+from utils.chunk_store import store_exists
+from utils.constants import EMBEDDING_MODEL, CHUNK_TOKEN_OVERLAP, FAISS_INDEX_SPEC, CORPUS_MIRROR, DOWNLOAD_PER_HOST
+from utils.downloader import CorpusDownloader, run_sync
+from utils.index_manifest import load_manifest, save_manifest
+from utils.index_pipeline import IndexBuildPipeline
 
 
 # Configurar logging
@@ -33,75 +34,58 @@ HISTORY_KEYWORDS = {
 }
 
 
-def search_gutenberg_books(count):
+async def search_gutenberg_books(downloader, count):
     """
     Busca libros en español con temática histórica usando la API Gutendex.
-    Devuelve una lista de dicts: {id, title}.
+    Devuelve una lista de dicts: {source, id, title, urls}.
     """
     books = []
     page = 1
-    while len(books) < 4:
-        resp = requests.get(
+    while len(books) < count:
+        data = await downloader.get_json(
             "https://gutendex.com/books",
             params={
                 "languages": "es",
                 "topic": "history",
                 "page": page
-            },
-            timeout=15
+            }
         )
-        resp.raise_for_status()
-        data = resp.json()
         for item in data.get("results", []):
-            title = item.get("title", "")
-            # Verificamos si el título contiene alguna clave de historia
+            # Primero el texto plano que anuncia Gutendex, luego los sufijos habituales
+            formats = item.get("formats", {})
+            urls = [url for fmt, url in formats.items() if fmt.startswith("text/plain") and not url.endswith(".zip")]
+            urls += [f"https://www.gutenberg.org/files/{item['id']}/{item['id']}{suffix}" for suffix in ("-0.txt", "-8.txt")]
             books.append({
                 "source": "GUTENBERG",
                 "id": item["id"],
-                "title": title
+                "title": item.get("title", ""),
+                "urls": urls
             })
             if len(books) >= count:
                 break
         if not data.get("next"):
             break
-        print("7")
         page += 1
     return books[:count]
 
 
-def download_gutenberg_book(book):
+async def download_gutenberg_book(downloader, book):
     """
-    Descarga el texto del libro de Gutenberg. Intenta dos sufijos comunes.
+    Descarga el texto del libro de Gutenberg probando sus URLs en orden.
     Devuelve la ruta al archivo .txt o None.
     """
-    identifier = book["id"]
-    filename = os.path.join(BOOKS_FOLDER, f"GUT_{identifier}.txt")
-
-    if os.path.exists(filename):
-        return filename
-    print("1")
-
-    for suffix in ("-0.txt", "-8.txt"):
-        print("2")
-        url = f"https://www.gutenberg.org/files/{identifier}/{identifier}{suffix}"
-        try:
-            r = requests.get(url, timeout=30)
-            if r.status_code == 200 and len(r.text) > 5000:
-                # Verificamos contenido histórico mínimo
-                print("3")
-                with open(filename, "w", encoding="utf-8") as f:
-                    f.write(r.text)
-                    print("4")
-                return filename
-        except Exception:
-            continue
+    filename = f"GUT_{book['id']}.txt"
+    for url in book["urls"]:
+        path = await downloader.fetch(url, filename, min_size=5000)
+        if path:
+            return path
     return None
 
 
-def search_archive_books(count):
+async def search_archive_books(downloader, count):
     """
     Busca en Internet Archive libros con subject:History, idioma español.
-    Devuelve lista de dicts: {id, title}.
+    Devuelve lista de dicts: {source, id, title}.
     """
     params = {
         "q": 'subject:"History" AND language:(spa)',
@@ -110,16 +94,9 @@ def search_archive_books(count):
         "rows": str(count),
         "output": "json"
     }
-    r = requests.get(
-        "https://archive.org/advancedsearch.php",
-        params=params,
-        timeout=15,
-        headers={"User-Agent": "Mozilla/5.0"}
-    )
-    r.raise_for_status()
-    docs = r.json()["response"]["docs"]
+    data = await downloader.get_json("https://archive.org/advancedsearch.php", params=params)
     books = []
-    for d in docs:
+    for d in data["response"]["docs"]:
         title = d.get("title", d["identifier"])
         if any(kw in title.lower() for kw in HISTORY_KEYWORDS):
             books.append({
@@ -130,18 +107,25 @@ def search_archive_books(count):
     return books[:count]
 
 
-def download_archive_book(book):
+def has_history_keywords(file_path):
+    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+        snippet = f.read(20_000).lower()
+    return any(kw in snippet for kw in HISTORY_KEYWORDS)
+
+
+async def download_archive_book(downloader, book):
     """
     Descarga el mayor .txt disponible de Internet Archive para el identificador dado.
     Devuelve la ruta al archivo o None.
     """
     identifier = book["id"]
-    filename = BOOKS_FOLDER / f"IA_{identifier}.txt"
-    if filename.exists():
-        return filename
+    filename = f"IA_{identifier}.txt"
+    path = os.path.join(downloader.dest_folder, filename)
+    if os.path.exists(path) and filename not in downloader.etags:
+        return path
 
     # Obtén metadata y selecciona el .txt más grande
-    meta = requests.get(f"https://archive.org/metadata/{identifier}", timeout=15).json()
+    meta = await downloader.get_json(f"https://archive.org/metadata/{identifier}")
     txts = [
         f for f in meta.get("files", [])
         if f.get("name", "").lower().endswith(".txt")
@@ -152,72 +136,73 @@ def download_archive_book(book):
     largest = max(txts, key=lambda f: int(f.get("size", 0)))
     url = f"https://archive.org/download/{identifier}/{largest['name']}"
 
-    # Descarga en streaming
-    with requests.get(url, stream=True, timeout=30) as r:
-        r.raise_for_status()
-        with open(filename, "wb") as f:
-            for chunk in r.iter_content(8_192):
-                f.write(chunk)
-
+    path = await downloader.fetch(url, filename, min_size=10240)
     # Verificamos contenido histórico
-    snippet = filename.read_text(encoding="utf-8", errors="ignore")[:20_000].lower()
-    if not any(kw in snippet for kw in HISTORY_KEYWORDS):
-        filename.unlink(missing_ok=True)
+    if path and not has_history_keywords(path):
+        os.remove(path)
         return None
-    return filename
+    return path
 
 
-def download_history_collection(min_books=MIN_BOOKS):
-    """
-    Descarga hasta min_books combinando Gutenberg y Archive.
-    """
+async def _download_from_mirror(downloader, count):
+    existing = set(os.listdir(downloader.dest_folder))
+    names = [name for name in await downloader.mirror_files() if name not in existing][:count]
+    paths = await asyncio.gather(*(downloader.fetch(None, name) for name in names))
+    return [path for path in paths if path]
+
+
+async def _download_from_internet(downloader, count):
+    # Las búsquedas de ambas fuentes van en paralelo; si faltan libros de Gutenberg se
+    # completan con los de Archive (se piden de más porque algunos se descartan)
+    gut_books, ia_books = await asyncio.gather(
+        search_gutenberg_books(downloader, count),
+        search_archive_books(downloader, 2 * count),
+        return_exceptions=True
+    )
     downloaded = []
-    remaining = min_books
+    for label, books, download in (("GUT", gut_books, download_gutenberg_book),
+                                   ("IA", ia_books, download_archive_book)):
+        if isinstance(books, Exception):
+            logger.warning(f"[{label}] Búsqueda fallida: {str(books)}")
+            continue
+        # Por tandas del tamaño de lo que falta, para no bajar libros de más
+        while books and len(downloaded) < count:
+            wave, books = books[:count - len(downloaded)], books[count - len(downloaded):]
+            paths = await asyncio.gather(*(download(downloader, b) for b in wave), return_exceptions=True)
+            for book, path in zip(wave, paths):
+                if isinstance(path, Exception):
+                    logger.warning(f"[{label}] {book['title']}: {str(path)}")
+                elif path:
+                    downloaded.append(path)
+                    logger.info(f"[{label}] {book['title']} -> {os.path.basename(path)}")
+    return downloaded
 
-    print("0")
-    #Gutenberg
-    gut_books = search_gutenberg_books(remaining)
-    for b in gut_books:
-        if remaining <= 0:
-            break
-        path = download_gutenberg_book(b)
-        if path:
-            downloaded.append(path)
-            remaining -= 1
-            print(f"[GUT] {b['title']} -> {path.name}")
-            time.sleep(0.2)
-
-    #Internet Archive
-    if remaining > 0:
-        ia_books = search_archive_books(remaining)
-        for b in ia_books:
-            if remaining <= 0:
-                break
-            path = download_archive_book(b)
-            if path:
-                downloaded.append(path)
-                remaining -= 1
-                print(f"[IA] {b['title']} -> {path.name}")
-                time.sleep(0.2)
-
-    print(f"Total descargados: {len(downloaded)}")
+
+async def download_history_collection_async(min_books=MIN_BOOKS, folder=BOOKS_FOLDER, mirror=CORPUS_MIRROR):
+    """
+    Descarga hasta min_books combinando Gutenberg y Archive, o los toma del espejo
+    local si `mirror` es una carpeta o una URL.
+    """
+    async with CorpusDownloader(folder, per_host=DOWNLOAD_PER_HOST, mirror=mirror) as downloader:
+        if mirror is not None:
+            downloaded = await _download_from_mirror(downloader, min_books)
+        else:
+            downloaded = await _download_from_internet(downloader, min_books)
+        logger.info(f"Total descargados: {len(downloaded)} ({dict(downloader.stats)})")
     return downloaded
 
 
+def download_history_collection(min_books=MIN_BOOKS, folder=BOOKS_FOLDER, mirror=CORPUS_MIRROR):
+    return run_sync(download_history_collection_async(min_books, folder, mirror))
+
 
 def load_documents_from_folder(folder_path):
     """Carga todos los archivos .txt de la carpeta y devuelve una lista de documentos."""
     documents = []
     for file_path in glob.glob(os.path.join(folder_path, "*.txt")):
-        try:
-            with open(file_path, 'r', encoding='utf-8', errors='replace') as file:
-                content = file.read()
-                if content.strip():
-                    documents.append(content)
-                else:
-                    logger.warning(f"Archivo vacío: {file_path}")
-        except Exception as e:
-            logger.error(f"Error leyendo {file_path}: {str(e)}")
+        content = read_text_mmap(file_path)
+        if content is not None:
+            documents.append(content)
     return documents
 
 """
@@ -233,119 +218,102 @@ def chunk_text(text, max_sentences=2):
         logger.error(f"Error en chunk_text: {str(e)}")
         return []
 """
-def chunk_text(text, chunk_size=1000): # Mas eficiente
-    #text = text.replace("\n", " ")
-    # Eliminar espacios innecesarios
-    #text = " ".join(text.split())
-    #chunks = [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
-    #return chunks
-    return chunk_sentence_based(text)
-
-def build_index(folder_path, index_file='faiss_index.bin', metadata_file='chunk_metadata.pickle'):
-    # 1. Revisar si el índice ya existe
-    if os.path.exists(index_file) and os.path.exists(metadata_file):
-        logger.info("El índice y los metadatos ya existen. Saliendo de build_index.")
-        return
-
-    # 2. Verificar libros existentes en la carpeta
-    existing_books = [fname for fname in os.listdir(folder_path) if fname.endswith('.txt')]
-    if len(existing_books) < MIN_BOOKS:
-        faltan = MIN_BOOKS - len(existing_books)
-        logger.info(f"Se requieren al menos {MIN_BOOKS} libros. Actualmente hay {len(existing_books)}. Descargando {faltan} libros más...")
-        download_history_collection(faltan)
-    
-    # 3. Cargar documentos
-    logger.info(f"Cargando documentos desde: {folder_path}")
-    documents = load_documents_from_folder(folder_path)
-    
-    if not documents:
-        logger.error("No se encontraron documentos para indexar después de la descarga.")
-        return
-    
-    # 4. Crear chunks y metadatos
-    chunks = []
-    chunk_metadata = []
-    for doc_id, doc in enumerate(documents):
-        # Usamos el método rápido para dividir el documento en chunks
-        doc_chunks = chunk_text(doc, chunk_size=1000)
-        if not doc_chunks:
-            continue
-        for chunk in doc_chunks:
-            chunks.append(chunk)
-            chunk_metadata.append({
-                'document_id': doc_id,
-                'text': chunk,
-                'source': 'internet_archive'
-            })
-    
-    if not chunks:
-        logger.error("No se generaron chunks válidos para indexar.")
-        return
-    
-    # 5. Generar embeddings y normalizarlos (con batch_size para acelerar)
-    logger.info("Generando embeddings...")
-    try:
-        #embedder = SentenceTransformer('all-MiniLM-L6-v2')
-        #device = "cuda" if torch.cuda.is_available() else "cpu"
-        embedder = SentenceTransformer("sentence-transformers/paraphrase-MiniLM-L3-v2")
-
-        print("1")
-        chunk_embeddings = embedder.encode(chunks, convert_to_numpy=True, batch_size=512)
-        print("2")
-        # Normalizar los embeddings para similitud coseno
-        faiss.normalize_L2(chunk_embeddings)
-        print("3")
-    except Exception as e:
-        logger.error(f"Error generando embeddings: {str(e)}")
-        return
-
-
-    # 6. Preparación del submuestreo para entrenamiento del índice.
-    doc_indices = defaultdict(list)
-    for idx, meta in enumerate(chunk_metadata):
-        doc_indices[meta['document_id']].append(idx)
-    
-    training_indices = []
-    for doc_id, indices in doc_indices.items():
-        n_sample = max(1, int(0.1 * len(indices)))  # al menos 1
-        sampled = random.sample(indices, n_sample)
-        training_indices.extend(sampled)
-    training_embeddings = chunk_embeddings[training_indices]
-    
-    logger.info(f"Se usarán {len(training_embeddings)} embeddings para entrenar el índice (de un total de {chunk_embeddings.shape[0]}).")
-    
-    # 7. Construir el índice FAISS con clustering (IndexIVFFlat)
-    logger.info("Construyendo el índice FAISS con clustering (IndexIVFFlat)...")
-    try:
-        dimension = chunk_embeddings.shape[1]
-        nlist = 100  # Número de clusters
-        quantizer = faiss.IndexFlatIP(dimension)
-        index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
-        index.make_direct_map()
-        
-        if not index.is_trained:
-            logger.info("Entrenando el índice IVFFlat con los embeddings seleccionados...")
-            index.train(training_embeddings)
-        
-        # Agregar todo el conjunto de embeddings al índice entrenado
-        index.add(chunk_embeddings)
-        norms = np.linalg.norm(chunk_embeddings, axis=1)
-        logger.info(f"Normas de embeddings - Min: {norms.min():.4f}, Max: {norms.max():.4f}")
-    except Exception as e:
-        logger.error(f"Error construyendo índice FAISS: {str(e)}")
-        return
-    
-    # 8. Guardar el índice y los metadatos en disco
-    logger.info("Guardando el índice y los metadatos...")
-    try:
-        faiss.write_index(index, index_file)
-        with open(metadata_file, 'wb') as f:
-            pickle.dump(chunk_metadata, f)
-    except Exception as e:
-        logger.error(f"Error guardando archivos: {str(e)}")
-        return
-    
-    logger.info(f"Índice generado con éxito. Total documentos: {len(documents)}, Total chunks: {len(chunks)}")
+def chunk_text(text, model_id=EMBEDDING_MODEL, overlap=CHUNK_TOKEN_OVERLAP, max_tokens=None):
+    # Chunks al límite de tokens del modelo: con 1000 caracteres MiniLM truncaba la cola
+    #return chunk_sentence_based(text)
+    return chunk_token_budget(text, model_id, max_tokens=max_tokens, overlap=overlap)
+
+
+def chunk_text_ranges(text, ranges, model_id=EMBEDDING_MODEL, overlap=CHUNK_TOKEN_OVERLAP, max_tokens=None):
+    return chunk_token_budget_ranges(text, ranges, model_id, max_tokens=max_tokens, overlap=overlap)
+
+
+def index_chunker(model_id=EMBEDDING_MODEL):
+    """
+    chunk_text con el presupuesto de tokens de `model_id` ya resuelto. Así el presupuesto
+    queda en la huella del índice (si cambia, se reconstruye) y todos los workers cortan
+    con el mismo.
+    """
+    return partial(chunk_text, model_id=model_id, max_tokens=embedder_token_budget(model_id))
+
+
+def build_index(folder_path, index_file='faiss_index.bin', chunk_store_dir='chunk_store',
+                manifest_file='index_manifest.json', workers=None, shard_dir='embedding_shards',
+                index_spec=FAISS_INDEX_SPEC, cleaning_rules=None):
+    """
+    Construye o actualiza de forma incremental el índice FAISS con IndexBuildPipeline
+    (utils/index_pipeline.py), descargando antes libros si la carpeta tiene menos de
+    MIN_BOOKS y todavía no hay índice.
+
+    Solo se procesan los archivos nuevos o modificados; los chunks de los eliminados o
+    modificados quedan como 'tombstone'. Antes de embeber, el texto se limpia según su
+    fuente (`cleaning_rules`, por defecto CLEANING_RULES; {} la desactiva) y los chunks
+    casi duplicados se descartan. Los chunks que se embeben son hijos de chunks padre de
+    hasta PARENT_CHUNK_CHARS caracteres, que se guardan solo por offset para dárselos
+    al LLM como contexto. `index_spec` es un alias ('flat', 'ivf', 'ivfpq',
+    'hnsw') o una cadena de index_factory. El manifiesto guarda la huella del embedder
+    (modelo, dimensión, normalización y chunker, con su presupuesto de tokens); si no
+    coincide con la configuración actual el índice se reconstruye desde cero. Devuelve el
+    contexto de la construcción, con el informe de tiempos por etapa, o None si falló.
+    """
+    if not (os.path.exists(index_file) and store_exists(chunk_store_dir)):
+        existing_books = [fname for fname in os.listdir(folder_path) if fname.endswith('.txt')]
+        if len(existing_books) < MIN_BOOKS:
+            faltan = MIN_BOOKS - len(existing_books)
+            logger.info(f"Se requieren al menos {MIN_BOOKS} libros. Actualmente hay {len(existing_books)}. Descargando {faltan} libros más...")
+            download_history_collection(faltan, folder_path)
+
+    chunker = index_chunker(EMBEDDING_MODEL)
+    pipeline = IndexBuildPipeline(
+        folder_path, index_file, chunk_store_dir, manifest_file, shard_dir=shard_dir,
+        chunker=chunker, model_id=EMBEDDING_MODEL, index_spec=index_spec,
+        cleaning_rules=cleaning_rules, workers=workers,
+        # Tokeniza cada documento una sola vez para todos sus padres
+        ranges_chunker=partial(chunk_text_ranges, **chunker.keywords)
+    )
+    return pipeline.run()
+
+
+def promote_index(source, target):
+    """
+    Sustituye el índice `target` por `source`; cada uno es una tupla
+    (index_file, chunk_store_dir, manifest_file). El manifiesto va al final y con una
+    generación mayor que la actual, así que los agentes que recargan en caliente solo
+    ven el índice nuevo cuando está completo. Quien tenga mapeados los archivos
+    anteriores sigue leyéndolos hasta que los suelte.
+    """
+    index_file, chunk_store_dir, manifest_file = target
+    new_index, new_store, new_manifest_file = source
+    manifest = load_manifest(new_manifest_file)
+    manifest["generation"] = max(manifest.get("generation", 0), load_manifest(manifest_file).get("generation", 0)) + 1
+
+    os.replace(new_index, index_file)
+    old_store = f"{chunk_store_dir}.old"
+    shutil.rmtree(old_store, ignore_errors=True)
+    if os.path.exists(chunk_store_dir):
+        os.rename(chunk_store_dir, old_store)
+    os.rename(new_store, chunk_store_dir)
+    save_manifest(manifest, manifest_file)
+    os.remove(new_manifest_file)
+    shutil.rmtree(old_store, ignore_errors=True)
+
+
+def migrate_index(folder_path, index_file='faiss_index.bin', chunk_store_dir='chunk_store',
+                  manifest_file='index_manifest.json', **kwargs):
+    """
+    Reconstruye el índice con el embedder configurado en rutas paralelas (.next) mientras
+    el actual sigue sirviendo consultas, y lo promueve cuando termina. Si se interrumpe,
+    la siguiente migración continúa la construcción paralela. Devuelve True si se promovió.
+    """
+    side = (f"{index_file}.next", f"{chunk_store_dir}.next", f"{manifest_file}.next")
+    logger.info(f"Migrando el índice a {EMBEDDING_MODEL} en segundo plano...")
+    ctx = build_index(folder_path, *side, shard_dir="embedding_shards.next", **kwargs)
+    if ctx is None or not all(os.path.exists(path) for path in side):
+        logger.error("La migración del índice no terminó; se sigue sirviendo el índice anterior.")
+        return False
+    promote_index(side, (index_file, chunk_store_dir, manifest_file))
+    logger.info("Migración del índice completada.")
+    return True
 
 if __name__ == "__main__":
     start_time = time.time()
@@ -1,152 +1,210 @@
+import os
+import csv
+import json
 import time
+import random
+import logging
+import subprocess
+import unicodedata
+from datetime import datetime
+from functools import partial
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-from utils.chunking import chunk_fixed_char, chunk_fixed_tokens, chunk_paragraph_based, chunk_recursive, chunk_sentence_based, chunk_sliding_window
+import faiss
 from sentence_transformers import SentenceTransformer
-import logging
-from indexer import load_documents_from_folder
-from utils.constants import DOCUMENTS_FOLDER
-import re  # Asegúrate de importar re para las operaciones regex
+from utils.chunking import (chunk_fixed_char, chunk_fixed_tokens, chunk_paragraph_based, chunk_recursive,
+                            chunk_sentence_based, chunk_sliding_window, chunk_token_budget)
+from utils.cleaning import clean_text
+from utils.corpus import read_text_mmap
+from utils.index_pipeline import PeakMemory
+from utils.constants import (DOCUMENTS_FOLDER, EMBEDDING_MODEL, CHUNK_TOKEN_OVERLAP,
+                             EMBEDDING_CACHE_FILE, EMBEDDING_CACHE_MAX_BYTES)
+from utils.embedding_cache import EmbeddingCache
+from utils.testingquestions import labeled_queries
 from utils.logging import configure_logging
 
-def evaluate_chunking_strategies(documents, strategies):
-    """Evalúa múltiples estrategias de chunking en una lista de documentos"""
-    all_results = []
-    embedder = SentenceTransformer('all-MiniLM-L6-v2')
-    
-    for doc_id, document in enumerate(documents):
-        doc_results = {
-            'doc_id': doc_id,
-            'doc_length': len(document),
-            'strategies': {}
-        }
-        
-        for name, strategy in strategies.items():
-            try:
-                # 1. Métrica: Tiempo de ejecución
-                start_time = time.perf_counter()
-                chunks = strategy(document)
-                duration = time.perf_counter() - start_time
-                
-                # 2. Métrica: Distribución de tamaños
-                lengths = [len(chunk) for chunk in chunks]
-                
-                # 3. Métrica: Coherencia semántica
-                coherence = 0
-                """
-                if len(chunks) > 1:
-                    embeddings = embedder.encode(chunks)
-                    similarities = cosine_similarity(embeddings)
-                    np.fill_diagonal(similarities, 0)
-                    coherence = np.mean(similarities) if similarities.size > 0 else 0
-                """
-                
-                # 4. Métrica: Pérdida de información
-                reconstructed = " ".join(chunks)
-                info_loss = abs(len(document) - len(reconstructed)) / len(document) if len(document) > 0 else 0
-                
-                doc_results['strategies'][name] = {
-                    'time': duration,
-                    'num_chunks': len(chunks),
-                    'avg_length': np.mean(lengths) if lengths else 0,
-                    'length_std': np.std(lengths) if len(lengths) > 1 else 0,
-                    'coherence': coherence,
-                    'info_loss': info_loss,
-                    'chunks_sample': chunks[:3]  # Muestra primeros chunks
-                }
-                
-            except Exception as e:
-                logger.error(f"Error en estrategia {name} con documento {doc_id}: {str(e)}")
-                doc_results['strategies'][name] = None
-        
-        all_results.append(doc_results)
-        print("Documento terminado.")
-    
-    return all_results
-
-# SOLUCIÓN: Definición de estrategias sin partial
-# Usamos funciones wrapper para pasar los parámetros
+# Banco de pruebas de las estrategias de chunking: por cada una mide el troceo
+# (MB/s, crecimiento pico de la RSS, nº de chunks), el tamaño del índice resultante,
+# la recuperación (recall@k y MRR sobre utils/testingquestions.labeled_queries) y la
+# coherencia entre chunks adyacentes. Los resultados se guardan en JSON y CSV con el commit actual para
+# poder comparar entre versiones.
+
+RESULTS_DIR = "benchmarks"
+TOP_K = 10
+# Pares de chunks adyacentes que se muestrean para la coherencia (en vez de la matriz n²)
+COHERENCE_SAMPLES = 2000
+CSV_FIELDS = ["strategy", "num_chunks", "chunk_seconds", "mb_per_s", "rss_growth_mb", "avg_length",
+              "length_std", "text_mb", "index_mb", "coherence", "info_loss", "recall_at_k", "mrr"]
+
+# Todas las estrategias de utils/chunking.py con los parámetros que usa el proyecto
 strategies = {
-    "Sliding Window": lambda text: chunk_sliding_window(text, window_size=800, overlap=200),
-    "Fixed Char": lambda text: chunk_fixed_char(text, chunk_size=1000),
-    "Fixed Tokens": lambda text: chunk_fixed_tokens(text, chunk_size=200),
-    "Sentence-based": lambda text: chunk_sentence_based(text, max_chars=1000),
-    #"Paragraph-based": chunk_paragraph_based,
-    #"Recursive": lambda text: chunk_recursive(text, chunk_size=1000)
+    "Sliding Window": partial(chunk_sliding_window, window_size=800, overlap=200),
+    "Fixed Char": partial(chunk_fixed_char, chunk_size=1000),
+    "Fixed Tokens": partial(chunk_fixed_tokens, chunk_size=200),
+    "Sentence-based": partial(chunk_sentence_based, max_chars=1000),
+    "Paragraph-based": chunk_paragraph_based,
+    "Recursive": partial(chunk_recursive, chunk_size=1000),
+    "Token Budget": partial(chunk_token_budget, model_id=EMBEDDING_MODEL, overlap=CHUNK_TOKEN_OVERLAP)
 }
 
-current_log = configure_logging()
 logger = logging.getLogger(__name__)
 
-# Cargar documentos
-logger.info(f"Cargando documentos desde: {DOCUMENTS_FOLDER}")
-documents = load_documents_from_folder(DOCUMENTS_FOLDER)
-
-# Verificar que tenemos documentos antes de continuar
-if not documents:
-    logger.error("No se encontraron documentos para procesar")
-    exit()
 
-# Evaluar estrategias en todos los documentos
-results = evaluate_chunking_strategies(documents, strategies)
-
-# Calcular estadísticas agregadas
-strategy_stats = {}
-
-# Inicializar estructura para estadísticas
-for strategy_name in strategies.keys():
-    strategy_stats[strategy_name] = {
-        'times': [],
-        'num_chunks': [],
-        'coherences': [],
-        'info_losses': []
+def fold(text):
+    """Minúsculas y sin acentos, para comparar la evidencia con los chunks."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def is_relevant(chunk, evidence):
+    folded = fold(chunk)
+    return any(all(fold(word) in folded for word in group) for group in evidence)
+
+
+def load_corpus(folder_path):
+    """Documentos limpios igual que en la construcción del índice: [(nombre, texto)]."""
+    documents = []
+    for name in sorted(os.listdir(folder_path)):
+        if not name.endswith(".txt"):
+            continue
+        content = read_text_mmap(os.path.join(folder_path, name))
+        if content:
+            documents.append((name, clean_text(content, name)[0]))
+    return documents
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def adjacent_coherence(embeddings, doc_ends, n_samples=COHERENCE_SAMPLES):
+    """Similitud coseno media entre chunks consecutivos de un mismo documento (muestreada)."""
+    last_of_doc = set(end - 1 for end in doc_ends)
+    pairs = [i for i in range(len(embeddings) - 1) if i not in last_of_doc]
+    if not pairs:
+        return 0.0
+    pairs = np.array(random.Random(0).sample(pairs, min(n_samples, len(pairs))))
+    # Los embeddings están normalizados: el coseno es el producto escalar fila a fila
+    return float(np.mean(np.einsum("ij,ij->i", embeddings[pairs], embeddings[pairs + 1])))
+
+
+def retrieval_metrics(index, chunks, query_embeddings, queries, k=TOP_K):
+    """recall@k (consultas con algún chunk relevante en el top-k) y MRR del primer acierto."""
+    _, ids = index.search(query_embeddings, k)
+    hits, reciprocal_ranks = 0, []
+    for query, row in zip(queries, ids):
+        rank = next((r for r, i in enumerate(row, 1) if i >= 0 and is_relevant(chunks[i], query["evidence"])), None)
+        hits += rank is not None
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+    return hits / len(queries), float(np.mean(reciprocal_ranks))
+
+
+def evaluate_strategy(name, strategy, documents, encode, query_embeddings, queries, k=TOP_K):
+    total_bytes = sum(len(text.encode("utf-8")) for _, text in documents)
+    chunks, doc_ends = [], []
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        for _, text in documents:
+            chunks.extend(strategy(text))
+            doc_ends.append(len(chunks))
+        duration = time.perf_counter() - start
+
+    lengths = np.array([len(chunk) for chunk in chunks])
+    text_length = sum(len(text) for _, text in documents)
+    embeddings = encode(chunks)
+    index = faiss.IndexFlatIP(embeddings.shape[1])
+    index.add(embeddings)
+    recall, mrr = retrieval_metrics(index, chunks, query_embeddings, queries, k)
+
+    return {
+        "strategy": name,
+        "num_chunks": len(chunks),
+        "chunk_seconds": duration,
+        "mb_per_s": total_bytes / 1e6 / duration if duration > 0 else 0.0,
+        # Sobre la RSS al empezar a trocear: sin el modelo ni lo que dejaron las estrategias anteriores
+        "rss_growth_mb": memory.growth / 1e6,
+        "avg_length": float(lengths.mean()) if len(lengths) else 0.0,
+        "length_std": float(lengths.std()) if len(lengths) > 1 else 0.0,
+        "text_mb": sum(len(chunk.encode("utf-8")) for chunk in chunks) / 1e6,
+        "index_mb": len(faiss.serialize_index(index)) / 1e6,
+        "coherence": adjacent_coherence(embeddings, doc_ends),
+        # Caracteres del documento que faltan (o sobran, con solapamiento) al unir los chunks
+        "info_loss": abs(text_length - int(lengths.sum())) / text_length if text_length else 0.0,
+        "recall_at_k": recall,
+        "mrr": mrr
     }
 
 
-
-
-
-
-
-
-
-
-
-# Recolectar datos de todos los documentos
-for doc_result in results:
-    for strategy_name, metrics in doc_result['strategies'].items():
-        if metrics:
-            strategy_stats[strategy_name]['times'].append(metrics['time'])
-            strategy_stats[strategy_name]['num_chunks'].append(metrics['num_chunks'])
-            #strategy_stats[strategy_name]['coherences'].append(metrics['coherence'])
-            strategy_stats[strategy_name]['info_losses'].append(metrics['info_loss'])
-
-# Calcular promedios y mostrar resultados
-logger.info("\n=== RESULTADOS AGREGADOS ===")
-logger.info(f"{'Estrategia':<20} | {'Tiempo (ms)':>12} | {'Chunks/Doc':>10} | {'Coherencia':>10} | {'Pérdida (%)':>12}")
-logger.info("-" * 75)
-
-for strategy_name, stats in strategy_stats.items():
-    if stats['times']:  # Solo si hay datos
-        avg_time = np.mean(stats['times']) * 1000  # ms
-        avg_chunks = np.mean(stats['num_chunks'])
-        #avg_coherence = np.mean(stats['coherences'])
-        avg_info_loss = np.mean(stats['info_losses']) * 100  # Porcentaje
-        
-        logger.info(f"{strategy_name:<20} | {avg_time:>12.2f} | {avg_chunks:>10.1f}  | {avg_info_loss:>12.2f}")
-        #| {avg_coherence:>10.4f}
-    else:
-        logger.warning(f"{strategy_name:<20} | Sin datos válidos")
-
-# Resultados detallados por documento (opcional)
-"""
-logger.info("\n=== RESUMEN POR DOCUMENTO ===")
-for doc_result in results:
-    logger.info(f"\nDocumento ID: {doc_result['doc_id']} - Longitud: {doc_result['doc_length']} caracteres")
-    for strategy_name, metrics in doc_result['strategies'].items():
-        if metrics:
-            logger.info(f"  {strategy_name}: {metrics['num_chunks']} chunks, "
-                        f"tiempo: {metrics['time']*1000:.2f}ms, "
-                        f"coherencia: {metrics['coherence']:.4f}, "
-                        f"pérdida: {metrics['info_loss']*100:.2f}%")
-"""
\ No newline at end of file
+def evaluate_chunking_strategies(documents, strategies, model_id=EMBEDDING_MODEL, k=TOP_K):
+    """Evalúa cada estrategia sobre todo el corpus; devuelve una fila de métricas por estrategia."""
+    embedder = SentenceTransformer(model_id)
+    embedding_cache = EmbeddingCache(EMBEDDING_CACHE_FILE, EMBEDDING_CACHE_MAX_BYTES)
+
+    def encode(texts):
+        embeddings = embedding_cache.encode(
+            model_id, texts, lambda missing: embedder.encode(missing, convert_to_numpy=True, batch_size=512)
+        )
+        faiss.normalize_L2(embeddings)
+        return embeddings
+
+    # Solo las consultas con respuesta en el corpus cuentan para recall y MRR
+    queries = [q for q in labeled_queries if q["evidence"]]
+    query_embeddings = encode([q["query"] for q in queries])
+
+    results = []
+    for name, strategy in strategies.items():
+        try:
+            results.append(evaluate_strategy(name, strategy, documents, encode, query_embeddings, queries, k))
+            logger.info(f"Estrategia {name} evaluada.")
+        except Exception as e:
+            logger.error(f"Error en estrategia {name}: {str(e)}")
+
+    logger.info(f"Caché de embeddings: {embedding_cache.hits} aciertos, {embedding_cache.misses} fallos")
+    embedding_cache.close()
+    return results
+
+
+def save_results(results, results_dir=RESULTS_DIR, **metadata):
+    """Escribe chunking_<commit>.json y .csv en `results_dir`; devuelve la ruta del JSON."""
+    os.makedirs(results_dir, exist_ok=True)
+    base = os.path.join(results_dir, f"chunking_{metadata.get('commit', 'unknown')}")
+    with open(base + ".json", "w", encoding="utf-8") as f:
+        json.dump({**metadata, "results": results}, f, ensure_ascii=False, indent=2)
+    with open(base + ".csv", "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["commit"] + CSV_FIELDS)
+        writer.writeheader()
+        for row in results:
+            writer.writerow({"commit": metadata.get("commit"), **row})
+    return base + ".json"
+
+
+def log_results(results, k=TOP_K):
+    logger.info("\n=== RESULTADOS AGREGADOS ===")
+    logger.info(f"{'Estrategia':<16} | {'Chunks':>7} | {'MB/s':>7} | {'ΔRSS (MB)':>9} | {'Índice (MB)':>11} | "
+                f"{'Coherencia':>10} | {'Pérdida (%)':>11} | {f'Recall@{k}':>9} | {'MRR':>6}")
+    logger.info("-" * 111)
+    for row in results:
+        logger.info(f"{row['strategy']:<16} | {row['num_chunks']:>7} | {row['mb_per_s']:>7.2f} | "
+                    f"{row['rss_growth_mb']:>9.1f} | {row['index_mb']:>11.2f} | {row['coherence']:>10.4f} | "
+                    f"{row['info_loss'] * 100:>11.2f} | {row['recall_at_k']:>9.2f} | {row['mrr']:>6.3f}")
+
+
+if __name__ == "__main__":
+    current_log = configure_logging()
+
+    logger.info(f"Cargando documentos desde: {DOCUMENTS_FOLDER}")
+    documents = load_corpus(DOCUMENTS_FOLDER)
+    if not documents:
+        logger.error("No se encontraron documentos para procesar")
+        exit()
+
+    results = evaluate_chunking_strategies(documents, strategies)
+    log_results(results)
+    output = save_results(
+        results, commit=current_commit(), date=datetime.now().isoformat(timespec="seconds"),
+        model=EMBEDDING_MODEL, k=TOP_K, documents=[name for name, _ in documents]
+    )
+    logger.info(f"Resultados guardados en {output}")
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import logging
+from datetime import datetime
+import numpy as np
+from nltk.tokenize import word_tokenize
+from utils.bm25 import BM25Index, MAX_TERM_CHARS
+from utils.chunking import chunk_recursive
+from utils.constants import DOCUMENTS_FOLDER
+from utils.index_pipeline import PeakMemory
+from utils.testingquestions import labeled_queries
+from utils.tokenizer import TOKENIZER_VERSION, tokenize, tokenize_query, clear_caches
+from utils.logging import configure_logging
+from testingChunks import RESULTS_DIR, TOP_K, is_relevant, load_corpus, current_commit
+
+# Banco de pruebas del camino léxico: compara el tokenizador anterior (NLTK punkt)
+# con el de utils/tokenizer.py en velocidad (MB/s y µs por consulta, con y sin caché),
+# memoria, tamaño del vocabulario y del índice BM25, y recuperación (recall@k y MRR de
+# BM25 solo, sobre utils/testingquestions.labeled_queries). Los chunks son los de
+# chunk_recursive, que no necesita modelos; el resultado se guarda con el commit actual.
+
+QUERY_REPEATS = 20
+
+logger = logging.getLogger(__name__)
+
+
+def nltk_tokenize(text):
+    """El camino anterior: word_tokenize de NLTK en español, sin signos de puntuación."""
+    return [token for token in word_tokenize(text.lower(), language='spanish')
+            if len(token) <= MAX_TERM_CHARS and any(ch.isalnum() for ch in token)]
+
+
+# nombre -> (tokenizar un texto, tokenizar una consulta)
+tokenizers = {
+    "NLTK word_tokenize": (nltk_tokenize, nltk_tokenize),
+    f"Regex+Snowball ({TOKENIZER_VERSION})": (tokenize, tokenize_query)
+}
+
+
+def bm25_retrieval(index, chunks, tokenize_fn, queries, k=TOP_K):
+    hits, reciprocal_ranks = 0, []
+    for query in queries:
+        ids, _ = index.search(tokenize_fn(query["query"]), k)
+        rank = next((r for r, i in enumerate(ids, 1) if is_relevant(chunks[i], query["evidence"])), None)
+        hits += rank is not None
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+    return hits / len(queries), float(np.mean(reciprocal_ranks))
+
+
+def evaluate_tokenizer(name, tokenize_fn, query_fn, chunks, queries, k=TOP_K):
+    clear_caches()
+    total_bytes = sum(len(chunk.encode("utf-8")) for chunk in chunks)
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        token_lists = [tokenize_fn(chunk) for chunk in chunks]
+        cold = time.perf_counter() - start
+    # Segunda pasada: con el tokenizador nuevo las palabras ya tienen su raíz en caché
+    start = time.perf_counter()
+    for chunk in chunks:
+        tokenize_fn(chunk)
+    warm = time.perf_counter() - start
+
+    texts = [q["query"] for q in labeled_queries]
+    clear_caches()
+    start = time.perf_counter()
+    for text in texts:
+        tokenize_fn(text)
+    query_us = (time.perf_counter() - start) / len(texts) * 1e6
+    query_fn(texts[0])
+    start = time.perf_counter()
+    for _ in range(QUERY_REPEATS):
+        for text in texts:
+            query_fn(text)
+    cached_query_us = (time.perf_counter() - start) / (QUERY_REPEATS * len(texts)) * 1e6
+
+    index = BM25Index.from_tokens(token_lists)
+    recall, mrr = bm25_retrieval(index, chunks, query_fn, queries, k)
+    n_tokens = sum(len(tokens) for tokens in token_lists)
+    return {
+        "tokenizer": name,
+        "tokens": n_tokens,
+        "mb_per_s": total_bytes / 1e6 / cold if cold > 0 else 0.0,
+        "warm_mb_per_s": total_bytes / 1e6 / warm if warm > 0 else 0.0,
+        "tokens_per_s": n_tokens / cold if cold > 0 else 0.0,
+        "rss_growth_mb": memory.growth / 1e6,
+        "query_us": query_us,
+        "cached_query_us": cached_query_us,
+        "vocabulary": len(index.terms),
+        "postings": len(index.doc_ids),
+        "index_mb": sum(np.asarray(getattr(index, name)).nbytes
+                        for name in ("terms", "term_ptr", "doc_ids", "tfs", "doc_lengths")) / 1e6,
+        "recall_at_k": recall,
+        "mrr": mrr
+    }
+
+
+def log_results(results, k=TOP_K):
+    logger.info("\n=== TOKENIZADORES ===")
+    logger.info(f"{'Tokenizador':<32} | {'MB/s':>7} | {'MB/s cal.':>9} | {'µs/cons.':>8} | {'µs caché':>8} | "
+                f"{'Vocab.':>7} | {'BM25 MB':>7} | {f'Recall@{k}':>9} | {'MRR':>6}")
+    logger.info("-" * 118)
+    for row in results:
+        logger.info(f"{row['tokenizer']:<32} | {row['mb_per_s']:>7.2f} | {row['warm_mb_per_s']:>9.2f} | "
+                    f"{row['query_us']:>8.1f} | {row['cached_query_us']:>8.2f} | {row['vocabulary']:>7} | "
+                    f"{row['index_mb']:>7.2f} | {row['recall_at_k']:>9.2f} | {row['mrr']:>6.3f}")
+
+
+if __name__ == "__main__":
+    current_log = configure_logging()
+
+    logger.info(f"Cargando documentos desde: {DOCUMENTS_FOLDER}")
+    documents = load_corpus(DOCUMENTS_FOLDER)
+    if not documents:
+        logger.error("No se encontraron documentos para procesar")
+        exit()
+    chunks = [chunk for _, text in documents for chunk in chunk_recursive(text)]
+    queries = [q for q in labeled_queries if q["evidence"]]
+
+    results = []
+    for name, (tokenize_fn, query_fn) in tokenizers.items():
+        try:
+            results.append(evaluate_tokenizer(name, tokenize_fn, query_fn, chunks, queries))
+        except Exception as e:
+            logger.error(f"Error en el tokenizador {name}: {str(e)}")
+    log_results(results)
+
+    commit = current_commit()
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    output = os.path.join(RESULTS_DIR, f"tokenizer_{commit}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"commit": commit, "date": datetime.now().isoformat(timespec="seconds"), "k": TOP_K,
+                   "chunks": len(chunks), "results": results}, f, ensure_ascii=False, indent=2)
+    logger.info(f"Resultados guardados en {output}")
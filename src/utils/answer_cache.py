@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+from functools import lru_cache
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Parámetros del perfil que entran en el prompt y cambian el contenido de la respuesta;
+# el resto (muestreo, afinidades numéricas que se recalculan en cada interacción) no
+# impide reutilizarla
+ANSWER_PARAMS = (
+    "style", "humor_level", "formality_level", "max_length", "preferred_topics", "disliked_topics",
+    "response_types", "historiographical_approach", "source_criticism", "evidence_preference",
+    "controversy_handling", "temporal_focus"
+)
+
+
+@lru_cache(maxsize=None)
+def _load_embedder(model_id):
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_id)
+
+
+def params_compatible(a, b, tolerance=0.1):
+    """
+    Dos juegos de parámetros del LLM dan respuestas intercambiables si coinciden en
+    ANSWER_PARAMS: los numéricos con una diferencia relativa de hasta `tolerance` y
+    el resto exactamente (las listas sin importar el orden).
+    """
+    for key in ANSWER_PARAMS:
+        x, y = a.get(key), b.get(key)
+        if isinstance(x, (int, float)) and isinstance(y, (int, float)):
+            if abs(x - y) > tolerance * max(abs(x), abs(y), 1):
+                return False
+        elif isinstance(x, list) and isinstance(y, list):
+            if sorted(map(str, x)) != sorted(map(str, y)):
+                return False
+        elif x != y:
+            return False
+    return True
+
+
+class SemanticAnswerCache:
+    """
+    Caché semántica de respuestas finales, compartida entre agentes a través de SQLite.
+
+    Cada entrada guarda el embedding normalizado de la pregunta del alumno, los
+    parámetros del perfil con que se respondió, los candidatos que formaron el contexto
+    y la respuesta. Una pregunta nueva reutiliza la respuesta de la entrada más parecida
+    con similitud coseno >= `threshold` y parámetros compatibles. Las entradas caducan
+    a los `max_age` segundos y, por encima de `max_entries`, se expulsan las más antiguas.
+    """
+
+    def __init__(self, path, model_id, threshold=0.92, max_entries=5000, max_age=7 * 24 * 3600,
+                 param_tolerance=0.1):
+        self.path = path
+        self.model_id = model_id
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.param_tolerance = param_tolerance
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " model TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " query TEXT NOT NULL,"
+            " params TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " candidates TEXT NOT NULL,"
+            " answer TEXT NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_created ON answers(created)")
+        self.conn.commit()
+        self._version = None
+        self._ids = np.empty(0, dtype="int64")
+        self._created = np.empty(0, dtype="float64")
+        self._vectors = np.empty((0, 0), dtype="float32")
+        self._params = []
+
+    def encode(self, text):
+        """Embedding normalizado de una pregunta (el modelo se carga una vez por proceso)."""
+        vector = _load_embedder(self.model_id).encode([text], convert_to_numpy=True)[0]
+        vector = np.asarray(vector, dtype="float32")
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _refresh(self):
+        """Recarga la matriz de embeddings si otro agente añadió o expulsó entradas."""
+        version = self.conn.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM answers").fetchone()
+        if version == self._version:
+            return
+        rows = self.conn.execute(
+            "SELECT id, created, params, vector FROM answers WHERE model = ? ORDER BY id", (self.model_id,)
+        ).fetchall()
+        self._ids = np.array([row[0] for row in rows], dtype="int64")
+        self._created = np.array([row[1] for row in rows], dtype="float64")
+        self._params = [json.loads(row[2]) for row in rows]
+        self._vectors = (np.vstack([np.frombuffer(row[3], dtype="float32") for row in rows])
+                         if rows else np.empty((0, 0), dtype="float32"))
+        self._version = version
+
+    def evict(self):
+        """Borra las entradas caducadas y, si sobran, las más antiguas."""
+        cursor = self.conn.execute("DELETE FROM answers WHERE created < ?", (time.time() - self.max_age,))
+        removed = cursor.rowcount
+        count = self.conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        if count > self.max_entries:
+            cursor = self.conn.execute(
+                "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY created ASC LIMIT ?)",
+                (count - self.max_entries,)
+            )
+            removed += cursor.rowcount
+        self.conn.commit()
+        if removed:
+            logger.info(f"SemanticAnswerCache: expulsadas {removed} respuestas")
+
+    def lookup(self, embedding, params):
+        """
+        Entrada reutilizable más parecida a `embedding` ({query, answer, candidates, similarity}) o None.
+        Solo lee: las caducadas se saltan aquí y se borran al guardar (store).
+        """
+        self._refresh()
+        if len(self._ids):
+            similarities = self._vectors @ np.asarray(embedding, dtype="float32")
+            expired = self._created < time.time() - self.max_age
+            for i in np.argsort(-similarities):
+                if similarities[i] < self.threshold:
+                    break
+                if not expired[i] and params_compatible(self._params[i], params, self.param_tolerance):
+                    row = self.conn.execute(
+                        "SELECT query, candidates, answer FROM answers WHERE id = ?", (int(self._ids[i]),)
+                    ).fetchone()
+                    if row is None:
+                        continue
+                    self.hits += 1
+                    return {"query": row[0], "candidates": json.loads(row[1]), "answer": row[2],
+                            "similarity": float(similarities[i])}
+        self.misses += 1
+        return None
+
+    def store(self, embedding, query, params, candidates, answer):
+        blob = np.ascontiguousarray(embedding, dtype="float32").tobytes()
+        self.conn.execute(
+            "INSERT INTO answers (model, created, query, params, vector, candidates, answer) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (self.model_id, time.time(), query, json.dumps(params, ensure_ascii=False, default=str), blob,
+             json.dumps(candidates, ensure_ascii=False, default=str), answer)
+        )
+        self.conn.commit()
+        self.evict()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate()}
+
+    def close(self):
+        self.conn.close()
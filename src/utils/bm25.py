@@ -0,0 +1,300 @@
+import os
+import json
+import logging
+from collections import Counter
+import numpy as np
+from utils.corpus import map_in_processes
+from utils.tokenizer import tokenize, TOKENIZER_VERSION
+
+logger = logging.getLogger(__name__)
+
+# El índice BM25 vive dentro del almacén de chunks: se reconstruye, migra y promueve con él
+BM25_DIR = "bm25"
+META_NAME = "meta.json"
+ARRAYS = ("terms", "term_ptr", "doc_ids", "tfs", "doc_lengths")
+# Tokens más largos son basura de OCR o URLs y solo inflarían el vocabulario
+MAX_TERM_CHARS = 32
+
+
+def _tokenize_batch(texts):
+    return [tokenize(text) for text in texts]
+
+
+class BM25Index:
+    """
+    Índice invertido BM25 sobre los chunks, con todo en arrays de numpy.
+
+    `terms` es el vocabulario ordenado (el id de un término es su posición y se busca
+    con searchsorted) y las postings de cada término son el tramo
+    term_ptr[t]:term_ptr[t+1] de `doc_ids`/`tfs`, con los chunks en orden creciente.
+    El id de un documento es el del chunk; los chunks eliminados y los casi duplicados
+    no tienen postings (longitud 0). IDF y normalización por longitud se calculan al
+    cargar, así que los arrays se pueden mapear en memoria tal cual. `tokenizer` es la
+    versión de utils/tokenizer.py con que se tokenizaron los chunks.
+    """
+
+    def __init__(self, terms, term_ptr, doc_ids, tfs, doc_lengths, k1=1.5, b=0.75, tokenizer=TOKENIZER_VERSION):
+        self.terms = terms
+        self.term_ptr = term_ptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.tokenizer = tokenizer
+        live = np.asarray(doc_lengths) > 0
+        n_live = int(live.sum())
+        self.avgdl = float(np.asarray(doc_lengths)[live].mean()) if n_live else 1.0
+        df = np.diff(np.asarray(term_ptr))
+        # IDF de Lucene: siempre positivo, también para términos de más de la mitad de los chunks
+        self.idf = np.log1p((n_live - df + 0.5) / (df + 0.5)).astype("float32")
+        self.doc_norms = (k1 * (1 - b + b * np.asarray(doc_lengths, dtype="float32") / self.avgdl)).astype("float32")
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    @classmethod
+    def from_tokens(cls, token_lists, k1=1.5, b=0.75):
+        """Construye el índice a partir de la lista de tokens de cada documento ([] = sin postings)."""
+        doc_lengths = np.zeros(len(token_lists), dtype="int32")
+        postings = _count_terms(range(len(token_lists)), token_lists, doc_lengths)
+        return cls.from_postings([postings], doc_lengths, k1, b)
+
+    @classmethod
+    def from_postings(cls, parts, doc_lengths, k1=1.5, b=0.75):
+        """
+        Construye el índice uniendo varios bloques de postings sueltas
+        (vocabulario, filas, chunks, tf): la fila de cada posting es la posición de su
+        término en el vocabulario del bloque. Los términos sin postings se descartan.
+        """
+        vocabularies, rows, doc_ids, tfs = [], [], [], []
+        offset = 0
+        for vocabulary, part_rows, part_docs, part_tfs in parts:
+            vocabularies.append(np.asarray(vocabulary, dtype=f"<U{MAX_TERM_CHARS}"))
+            rows.append(np.asarray(part_rows, dtype="int64") + offset)
+            doc_ids.append(np.asarray(part_docs, dtype="int32"))
+            tfs.append(np.asarray(part_tfs, dtype="int32"))
+            offset += len(vocabularies[-1])
+        # Solo se ordenan los vocabularios (cadenas); las postings se manejan como enteros
+        terms, remap = np.unique(np.concatenate(vocabularies), return_inverse=True)
+        rows = remap.reshape(-1)[np.concatenate(rows)]
+        df = np.bincount(rows, minlength=len(terms))
+        used = df > 0
+        rows = (np.cumsum(used) - 1)[rows]
+        terms, df = terms[used], df[used]
+
+        doc_ids, tfs = np.concatenate(doc_ids), np.concatenate(tfs)
+        order = np.lexsort((doc_ids, rows))
+        term_ptr = np.zeros(len(terms) + 1, dtype="int64")
+        np.cumsum(df, out=term_ptr[1:])
+        return cls(terms, term_ptr, doc_ids[order], tfs[order], np.asarray(doc_lengths, dtype="int32"), k1, b)
+
+    def postings(self, keep=None):
+        """Bloque de postings sueltas del índice, opcionalmente solo las de los chunks con keep[chunk]."""
+        rows = np.repeat(np.arange(len(self.terms)), np.diff(np.asarray(self.term_ptr)))
+        doc_ids, tfs = np.asarray(self.doc_ids), np.asarray(self.tfs)
+        if keep is not None:
+            mask = keep[doc_ids]
+            rows, doc_ids, tfs = rows[mask], doc_ids[mask], tfs[mask]
+        return np.asarray(self.terms), rows, doc_ids, tfs
+
+    def save(self, path):
+        # Cada array se reemplaza de forma atómica y meta.json va al final
+        os.makedirs(path, exist_ok=True)
+        for name in ARRAYS:
+            tmp_file = os.path.join(path, f"{name}.tmp.npy")
+            np.save(tmp_file, np.asarray(getattr(self, name)))
+            os.replace(tmp_file, os.path.join(path, f"{name}.npy"))
+        meta = {"count": len(self), "terms": len(self.terms), "postings": len(self.doc_ids), "k1": self.k1, "b": self.b,
+                "tokenizer": self.tokenizer}
+        tmp_file = os.path.join(path, META_NAME + ".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_file, os.path.join(path, META_NAME))
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        with open(os.path.join(path, META_NAME), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in ARRAYS]
+        return cls(*arrays, k1=meta["k1"], b=meta["b"], tokenizer=meta.get("tokenizer"))
+
+    def term_ids(self, tokens):
+        """Ids de los tokens que están en el vocabulario y cuántas veces aparece cada uno."""
+        tokens = [token for token in tokens if len(token) <= MAX_TERM_CHARS]
+        if not tokens or not len(self.terms):
+            return np.empty(0, dtype="int64"), np.empty(0, dtype="int64")
+        query, counts = np.unique(np.array(tokens, dtype=self.terms.dtype), return_counts=True)
+        positions = np.minimum(np.searchsorted(self.terms, query), len(self.terms) - 1)
+        found = self.terms[positions] == query
+        return positions[found], counts[found]
+
+    def search(self, tokens, k=10):
+        """Los `k` chunks con mayor BM25 para la consulta: (ids, puntuaciones) de mayor a menor."""
+        scores = np.zeros(len(self), dtype="float32")
+        touched = []
+        for term, qtf in zip(*self.term_ids(tokens)):
+            start, end = self.term_ptr[term], self.term_ptr[term + 1]
+            docs = self.doc_ids[start:end]
+            tf = self.tfs[start:end].astype("float32")
+            # Dentro de un término cada chunk aparece una vez: la suma indexada es segura
+            scores[docs] += qtf * self.idf[term] * tf * (self.k1 + 1) / (tf + self.doc_norms[docs])
+            touched.append(docs)
+        if not touched:
+            return np.empty(0, dtype="int64"), np.empty(0, dtype="float32")
+        candidates = np.unique(np.concatenate(touched)).astype("int64")
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return candidates, scores[candidates]
+
+    def score(self, tokens, doc_ids):
+        """BM25 de la consulta para los chunks `doc_ids` (0 para los ids fuera del índice)."""
+        return self.score_batch([tokens], [doc_ids])[0]
+
+    def score_batch(self, token_lists, doc_id_lists):
+        """
+        BM25 de varias consultas, cada una solo sobre sus candidatos: una lista de
+        arrays float32 alineados con `doc_id_lists`.
+
+        Se forman todos los pares (término de la consulta, candidato) del lote y cada tf
+        se busca con una búsqueda binaria vectorizada dentro de las postings del
+        término, así que el coste depende de consultas x términos x candidatos y del
+        log de las postings, no del tamaño del corpus.
+        """
+        sizes = [len(ids) for ids in doc_id_lists]
+        slots, terms, qtfs, docs = [], [], [], []
+        offset = 0
+        for tokens, ids, size in zip(token_lists, doc_id_lists, sizes):
+            term_ids, counts = self.term_ids(tokens)
+            ids = np.asarray(ids, dtype="int64")
+            valid = np.flatnonzero((ids >= 0) & (ids < len(self)))
+            if len(term_ids) and len(valid):
+                slots.append(np.tile(offset + valid, len(term_ids)))
+                docs.append(np.tile(ids[valid], len(term_ids)))
+                terms.append(np.repeat(term_ids, len(valid)))
+                qtfs.append(np.repeat(counts, len(valid)))
+            offset += size
+
+        scores = np.zeros(offset, dtype="float32")
+        if slots and len(self.doc_ids):
+            slots, terms, qtfs, docs = (np.concatenate(a) for a in (slots, terms, qtfs, docs))
+            # lower_bound de cada candidato en las postings de su término
+            lo = np.asarray(self.term_ptr[terms], dtype="int64")
+            end = np.asarray(self.term_ptr[terms + 1], dtype="int64")
+            hi = end.copy()
+            active = lo < hi
+            while active.any():
+                mid = (lo + hi) // 2
+                right = active & (self.doc_ids[np.where(active, mid, 0)] < docs)
+                lo = np.where(right, mid + 1, lo)
+                hi = np.where(active & ~right, mid, hi)
+                active = lo < hi
+            found = lo < end
+            found[found] = self.doc_ids[lo[found]] == docs[found]
+            tf = self.tfs[lo[found]].astype("float32")
+            terms, docs = terms[found], docs[found]
+            contributions = qtfs[found] * self.idf[terms] * tf * (self.k1 + 1) / (tf + self.doc_norms[docs])
+            scores = np.bincount(slots[found], weights=contributions, minlength=offset).astype("float32")
+        return np.split(scores, np.cumsum(sizes)[:-1])
+
+
+def _count_terms(doc_ids, token_lists, doc_lengths):
+    """Bloque de postings (vocabulario, filas, chunks, tf) de unos chunks; anota su longitud en `doc_lengths`."""
+    vocabulary, rows, docs, tfs = {}, [], [], []
+    for doc_id, tokens in zip(doc_ids, token_lists):
+        if not tokens:
+            continue
+        doc_lengths[doc_id] = len(tokens)
+        for term, tf in Counter(tokens).items():
+            if len(term) > MAX_TERM_CHARS:
+                continue
+            rows.append(vocabulary.setdefault(term, len(vocabulary)))
+            docs.append(doc_id)
+            tfs.append(tf)
+    return list(vocabulary), rows, docs, tfs
+
+
+def _tokenize_chunks(chunks, ids, workers, batch_size):
+    batches = [[chunks.text(i) for i in ids[start:start + batch_size]] for start in range(0, len(ids), batch_size)]
+    return [tokens for tokenized in map_in_processes(_tokenize_batch, batches, workers) for tokens in tokenized]
+
+
+def build_bm25_index(chunks, chunk_store_dir, k1=1.5, b=0.75, workers=None, batch_size=1000):
+    """
+    Actualiza (o crea) el índice BM25 del almacén en `chunk_store_dir`/bm25 y lo devuelve.
+
+    Solo se tokenizan los chunks vivos y originales que el índice guardado no cubre (los
+    nuevos y los duplicados que pasaron a ser originales, en paralelo y por lotes); de
+    los ya indexados se conservan las postings, menos las de los chunks eliminados.
+    """
+    path = os.path.join(chunk_store_dir, BM25_DIR)
+    live = ~np.asarray(chunks.tombstones) & (np.asarray(chunks.duplicate_of) < 0)
+    previous = BM25Index.load(path) if os.path.exists(os.path.join(path, META_NAME)) else None
+    if previous is not None and previous.tokenizer != TOKENIZER_VERSION:
+        logger.info(f"El tokenizador pasó de {previous.tokenizer} a {TOKENIZER_VERSION}: se tokenizan todos los chunks.")
+        previous = None
+    if previous is not None and len(previous) > len(chunks):
+        previous = None
+
+    lengths = np.zeros(len(chunks), dtype="int32")
+    parts = []
+    if previous is None:
+        pending = np.flatnonzero(live)
+    else:
+        indexed = np.zeros(len(chunks), dtype=bool)
+        indexed[:len(previous)] = np.asarray(previous.doc_lengths) > 0
+        parts.append(previous.postings(keep=live[:len(previous)]))
+        kept = np.flatnonzero(live & indexed)
+        lengths[kept] = np.asarray(previous.doc_lengths)[kept]
+        pending = np.flatnonzero(live & ~indexed)
+
+    parts.append(_count_terms(pending, _tokenize_chunks(chunks, pending, workers, batch_size), lengths))
+    index = BM25Index.from_postings(parts, lengths, k1, b)
+    index.save(path)
+    logger.info(f"Índice BM25: {len(index.terms)} términos y {len(index.doc_ids)} postings para "
+                f"{int(live.sum())} de {len(chunks)} chunks ({len(pending)} tokenizados en esta construcción).")
+    return index
+
+
+def load_bm25_index(chunk_store_dir, count):
+    """Índice BM25 del almacén mapeado en memoria, o None si no existe o es de otra versión del almacén."""
+    path = os.path.join(chunk_store_dir, BM25_DIR)
+    if not os.path.exists(os.path.join(path, META_NAME)):
+        return None
+    index = BM25Index.load(path)
+    if index.tokenizer != TOKENIZER_VERSION:
+        # Los términos de las consultas no coincidirían con los del índice
+        logger.warning(f"El índice BM25 se tokenizó con {index.tokenizer} y las consultas usan "
+                       f"{TOKENIZER_VERSION}; se ignora hasta la próxima construcción.")
+        return None
+    if len(index) != count:
+        logger.warning(f"El índice BM25 cubre {len(index)} chunks y el almacén tiene {count}; se ignora.")
+        return None
+    return index
+
+
+def bm25_index_current(chunk_store_dir):
+    """Si el almacén tiene índice BM25 y se tokenizó con el tokenizador actual."""
+    meta_file = os.path.join(chunk_store_dir, BM25_DIR, META_NAME)
+    if not os.path.exists(meta_file):
+        return False
+    with open(meta_file, "r", encoding="utf-8") as f:
+        return json.load(f).get("tokenizer") == TOKENIZER_VERSION
+
+
+def reciprocal_rank_fusion(rankings, k=60, limit=10):
+    """
+    Fusiona varias listas de ids ordenadas de mejor a peor: cada id suma 1/(k + rango)
+    por cada lista en que aparece (rango desde 1). Devuelve (ids, puntuaciones) de los
+    `limit` mejores, de mayor a menor.
+    """
+    rankings = [np.asarray(ranking, dtype="int64") for ranking in rankings if len(ranking)]
+    if not rankings:
+        return np.empty(0, dtype="int64"), np.empty(0, dtype="float64")
+    ids = np.concatenate(rankings)
+    contributions = np.concatenate([1.0 / (k + np.arange(1, len(ranking) + 1)) for ranking in rankings])
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    scores = np.bincount(inverse, weights=contributions)
+    order = np.argsort(-scores, kind="stable")[:limit]
+    return unique_ids[order], scores[order]
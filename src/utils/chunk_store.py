@@ -0,0 +1,278 @@
+import os
+import json
+import mmap
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TEXTS_NAME = "texts.bin"
+PARENTS_NAME = "parents.bin"
+META_NAME = "meta.json"
+COLUMNS = {
+    "offsets": "int64",
+    "document_id": "int32",
+    "source": "uint8",
+    "file": "int32",
+    "tombstone": "bool",
+    "simhash": "uint64",
+    "duplicate_of": "int64",
+    "parent": "int64"
+}
+# Valor de las columnas que un almacén antiguo no tiene todavía
+DEFAULTS = {"simhash": 0, "duplicate_of": -1, "parent": -1}
+# Offsets (p+1) de los chunks padre en parents.bin; no es una columna por chunk
+PARENT_OFFSETS = "parent_offsets"
+
+
+class ChunkStore:
+    """
+    Almacén columnar de chunks, de solo lectura y mapeado en memoria.
+
+    En disco es un directorio con un blob UTF-8 contiguo (texts.bin), un array de
+    offsets (n+1) y las columnas document_id/source/file/tombstone como .npy. El texto
+    de un chunk se decodifica solo cuando se pide, y todas las páginas se comparten
+    entre procesos a través de la caché de páginas del sistema operativo.
+    El id de un chunk es su posición, igual que el id del vector en FAISS.
+
+    Los chunks son los hijos que se embeben y se buscan. Cada uno apunta (columna
+    `parent`) a un chunk padre más grande, guardado solo como un tramo de parents.bin,
+    que es el contexto que se le pasa al LLM.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_NAME), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.sources = meta["sources"]
+        self.files = meta["files"]
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.document_ids = np.load(os.path.join(path, "document_id.npy"), mmap_mode="r")
+        self.source_codes = np.load(os.path.join(path, "source.npy"), mmap_mode="r")
+        self.file_codes = np.load(os.path.join(path, "file.npy"), mmap_mode="r")
+        self.tombstones = np.load(os.path.join(path, "tombstone.npy"), mmap_mode="r")
+        self.simhashes = _load_column(path, "simhash", len(self))
+        self.duplicate_of = _load_column(path, "duplicate_of", len(self))
+        self.parents = _load_column(path, "parent", len(self))
+        self.parent_offsets = _load_parent_offsets(path)
+
+        self._blob, self._blob_file = _map_blob(path, TEXTS_NAME, self.offsets[-1])
+        self._parent_blob, self._parent_blob_file = _map_blob(path, PARENTS_NAME, self.parent_offsets[-1])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def text(self, chunk_id):
+        """Texto del chunk; cadena vacía si el chunk está marcado como eliminado."""
+        if self.tombstones[chunk_id]:
+            return ""
+        start, end = self.offsets[chunk_id], self.offsets[chunk_id + 1]
+        return self._blob[start:end].decode("utf-8")
+
+    def parent_text(self, parent_id):
+        start, end = self.parent_offsets[parent_id], self.parent_offsets[parent_id + 1]
+        return self._parent_blob[start:end].decode("utf-8")
+
+    def context_text(self, chunk_id):
+        """Texto del chunk padre, o el del propio chunk si no tiene padre."""
+        parent_id = self.parents[chunk_id]
+        if parent_id < 0 or self.tombstones[chunk_id]:
+            return self.text(chunk_id)
+        return self.parent_text(parent_id)
+
+    def texts(self, chunk_ids):
+        return [self.text(i) for i in chunk_ids]
+
+    def iter_texts(self):
+        for i in range(len(self)):
+            yield self.text(i)
+
+    def __getitem__(self, chunk_id):
+        """Vista dict de un chunk, compatible con las entradas de los antiguos metadatos."""
+        return {
+            "document_id": int(self.document_ids[chunk_id]),
+            "text": self.text(chunk_id),
+            "source": self.sources[self.source_codes[chunk_id]],
+            "file": self.files[self.file_codes[chunk_id]],
+            "tombstone": bool(self.tombstones[chunk_id]),
+            "duplicate_of": int(self.duplicate_of[chunk_id]),
+            "parent": int(self.parents[chunk_id])
+        }
+
+    def close(self):
+        for blob, blob_file in ((self._blob, self._blob_file), (self._parent_blob, self._parent_blob_file)):
+            if blob is not None:
+                blob.close()
+                blob_file.close()
+        self._blob = self._parent_blob = None
+
+
+def _map_blob(path, name, size):
+    if size <= 0:
+        return None, None
+    blob_file = open(os.path.join(path, name), "rb")
+    return mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ), blob_file
+
+
+def _load_parent_offsets(path, mmap_mode="r"):
+    file_path = os.path.join(path, f"{PARENT_OFFSETS}.npy")
+    if not os.path.exists(file_path):
+        return np.zeros(1, dtype="int64")
+    return np.load(file_path, mmap_mode=mmap_mode)
+
+
+def _load_column(path, name, count, mmap_mode="r"):
+    file_path = os.path.join(path, f"{name}.npy")
+    if not os.path.exists(file_path):
+        return np.full(count, DEFAULTS[name], dtype=COLUMNS[name])
+    return np.load(file_path, mmap_mode=mmap_mode)
+
+
+def _empty_columns():
+    columns = {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+    columns["offsets"] = np.zeros(1, dtype="int64")
+    columns[PARENT_OFFSETS] = np.zeros(1, dtype="int64")
+    return columns, {"sources": [], "files": []}
+
+
+def _load_columns(path):
+    """Carga las columnas en memoria para modificarlas (unos pocos bytes por chunk)."""
+    if not os.path.exists(os.path.join(path, META_NAME)):
+        return _empty_columns()
+    with open(os.path.join(path, META_NAME), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    count = meta.get("count", store_size(path))
+    columns = {name: np.array(_load_column(path, name, count, mmap_mode=None)) for name in COLUMNS}
+    columns[PARENT_OFFSETS] = np.array(_load_parent_offsets(path, mmap_mode=None))
+    return columns, meta
+
+
+def _save_columns(path, columns, meta):
+    # Cada archivo se reemplaza de forma atómica y meta.json va al final
+    for name, values in columns.items():
+        tmp_file = os.path.join(path, f"{name}.tmp.npy")
+        np.save(tmp_file, values.astype(COLUMNS.get(name, "int64")))
+        os.replace(tmp_file, os.path.join(path, f"{name}.npy"))
+    meta = dict(meta, count=len(columns["offsets"]) - 1)
+    tmp_file = os.path.join(path, META_NAME + ".tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_file, os.path.join(path, META_NAME))
+
+
+def _shrink_blob(path, name, size):
+    """
+    Deja el blob `name` en `size` bytes sin truncarlo en el sitio: un agente que lo
+    tenga mapeado recibiría SIGBUS al tocar una página del final. Como las columnas,
+    se copia el prefijo a un archivo temporal que reemplaza al anterior; quien tenga
+    mapeado el anterior sigue leyéndolo hasta que lo suelte. Añadir al final sí es seguro.
+    """
+    file_path = os.path.join(path, name)
+    if not os.path.exists(file_path) or os.path.getsize(file_path) <= size:
+        return
+    tmp_file = file_path + ".tmp"
+    with open(file_path, "rb") as source, open(tmp_file, "wb") as target:
+        remaining = size
+        while remaining:
+            data = source.read(min(remaining, 1 << 24))
+            if not data:
+                break
+            target.write(data)
+            remaining -= len(data)
+    os.replace(tmp_file, file_path)
+
+
+def _code(labels, value):
+    if value not in labels:
+        labels.append(value)
+    return labels.index(value)
+
+
+def store_exists(path):
+    return os.path.exists(os.path.join(path, META_NAME))
+
+
+def store_size(path):
+    if not store_exists(path):
+        return 0
+    return len(np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")) - 1
+
+
+def append_chunks(path, records, parents=()):
+    """
+    Añade chunks al final del almacén (lo crea si no existe).
+    Cada registro es un dict con 'document_id', 'text', 'source' y 'file', y
+    opcionalmente 'simhash', 'duplicate_of' y 'parent' (posición de su padre en
+    `parents`, la lista de textos de los chunks padre que se añaden con ellos).
+    """
+    os.makedirs(path, exist_ok=True)
+    columns, meta = _load_columns(path)
+    offset = int(columns["offsets"][-1])
+
+    first_parent = len(columns[PARENT_OFFSETS]) - 1
+    parent_offset = int(columns[PARENT_OFFSETS][-1])
+    parent_offsets = []
+    _shrink_blob(path, PARENTS_NAME, parent_offset)
+    with open(os.path.join(path, PARENTS_NAME), "ab") as blob:
+        for parent in parents:
+            data = parent.encode("utf-8")
+            blob.write(data)
+            parent_offset += len(data)
+            parent_offsets.append(parent_offset)
+
+    new_offsets, document_ids, sources, files, simhashes, duplicates, parent_ids = [], [], [], [], [], [], []
+    _shrink_blob(path, TEXTS_NAME, offset)
+    with open(os.path.join(path, TEXTS_NAME), "ab") as blob:
+        for record in records:
+            data = record["text"].encode("utf-8")
+            blob.write(data)
+            offset += len(data)
+            new_offsets.append(offset)
+            document_ids.append(record["document_id"])
+            sources.append(_code(meta["sources"], record.get("source", "local")))
+            files.append(_code(meta["files"], record.get("file", "")))
+            simhashes.append(record.get("simhash", DEFAULTS["simhash"]))
+            duplicates.append(record.get("duplicate_of", DEFAULTS["duplicate_of"]))
+            parent = record.get("parent", DEFAULTS["parent"])
+            parent_ids.append(first_parent + parent if parent >= 0 else parent)
+
+    columns["offsets"] = np.concatenate([columns["offsets"], np.array(new_offsets, dtype="int64")])
+    columns["document_id"] = np.concatenate([columns["document_id"], np.array(document_ids, dtype="int32")])
+    columns["source"] = np.concatenate([columns["source"], np.array(sources, dtype="uint8")])
+    columns["file"] = np.concatenate([columns["file"], np.array(files, dtype="int32")])
+    columns["tombstone"] = np.concatenate([columns["tombstone"], np.zeros(len(new_offsets), dtype="bool")])
+    columns["simhash"] = np.concatenate([columns["simhash"], np.array(simhashes, dtype="uint64")])
+    columns["duplicate_of"] = np.concatenate([columns["duplicate_of"], np.array(duplicates, dtype="int64")])
+    columns["parent"] = np.concatenate([columns["parent"], np.array(parent_ids, dtype="int64")])
+    columns[PARENT_OFFSETS] = np.concatenate([columns[PARENT_OFFSETS], np.array(parent_offsets, dtype="int64")])
+    _save_columns(path, columns, meta)
+
+
+def mark_tombstones(path, chunk_ids):
+    """Marca chunks como eliminados; su texto sigue en el blob hasta la próxima reconstrucción."""
+    columns, meta = _load_columns(path)
+    columns["tombstone"][np.asarray(chunk_ids, dtype="int64")] = True
+    _save_columns(path, columns, meta)
+
+
+def set_duplicates(path, chunk_ids, originals):
+    """Reasigna el original de unos chunks (-1 los convierte en originales con vector propio)."""
+    columns, meta = _load_columns(path)
+    columns["duplicate_of"][np.asarray(chunk_ids, dtype="int64")] = np.asarray(originals, dtype="int64")
+    _save_columns(path, columns, meta)
+
+
+def truncate_chunks(path, count):
+    """Descarta los chunks a partir de `count` (restos de una construcción interrumpida)."""
+    columns, meta = _load_columns(path)
+    if len(columns["offsets"]) - 1 <= count:
+        return
+    logger.info(f"Descartando {len(columns['offsets']) - 1 - count} chunks de una construcción interrumpida.")
+    for name in COLUMNS:
+        columns[name] = columns[name][:count + 1] if name == "offsets" else columns[name][:count]
+    _shrink_blob(path, TEXTS_NAME, int(columns["offsets"][-1]))
+    # Los padres se añaden junto con sus hijos: sobran los posteriores al último padre usado
+    n_parents = int(columns["parent"].max()) + 1 if count else 0
+    columns[PARENT_OFFSETS] = columns[PARENT_OFFSETS][:max(n_parents, 0) + 1]
+    _shrink_blob(path, PARENTS_NAME, int(columns[PARENT_OFFSETS][-1]))
+    _save_columns(path, columns, meta)
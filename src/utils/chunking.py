@@ -1,88 +1,318 @@
 import re
+import json
+import logging
+from functools import lru_cache
+import numpy as np
 import nltk
-from nltk.tokenize import sent_tokenize, word_tokenize
+from utils.constants import CHUNK_MAX_TOKENS
 nltk.download('punkt', quiet=True)
+nltk.download('punkt_tab', quiet=True)
+
+logger = logging.getLogger(__name__)
+
+# Los chunkers iter_*_spans recorren el texto una sola vez y generan offsets (inicio, fin)
+# sobre el texto original, sin copiarlo. Las funciones chunk_* conservan la interfaz de
+# siempre (lista de cadenas) y solo cortan el texto al materializar cada chunk.
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_PARAGRAPH_BREAK_RE = re.compile(r"\n[ \t\r\f\v]*\n\s*")
+RECURSIVE_SEPARATORS = ["\n\n", "\n", ". ", "? ", "! ", " ", ""]
+
+
+@lru_cache(maxsize=None)
+def sentence_tokenizer(language="spanish"):
+    """Modelo punkt del idioma (por defecto español), cargado una sola vez por proceso."""
+    try:
+        from nltk.tokenize import PunktTokenizer
+        return PunktTokenizer(language)
+    except ImportError:
+        return nltk.data.load(f"tokenizers/punkt/{language}.pickle")
+
+
+@lru_cache(maxsize=None)
+def embedder_tokenizer(model_id):
+    """Tokenizador rápido (Rust) del modelo de embeddings, sin cargar sus pesos."""
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(model_id, use_fast=True)
+
+
+@lru_cache(maxsize=None)
+def embedder_token_budget(model_id):
+    """
+    Tokens de texto que el modelo llega a embeber: su max_seq_length (de
+    sentence_bert_config.json) menos los tokens especiales ([CLS], [SEP]).
+    Lo que pase de ahí sentence-transformers lo trunca sin avisar. Si la configuración
+    no se puede leer se usa CHUNK_MAX_TOKENS, no el model_max_length del tokenizador
+    (512 en MiniLM, el cuádruple de lo que embebe).
+    """
+    tokenizer = embedder_tokenizer(model_id)
+    try:
+        from huggingface_hub import hf_hub_download
+        with open(hf_hub_download(model_id, "sentence_bert_config.json"), "r", encoding="utf-8") as f:
+            max_length = json.load(f)["max_seq_length"]
+    except Exception as e:
+        max_length = CHUNK_MAX_TOKENS
+        logger.warning(f"No se pudo leer max_seq_length de {model_id} ({str(e)}); "
+                       f"se usa CHUNK_MAX_TOKENS={CHUNK_MAX_TOKENS}")
+    max_length = min(max_length, tokenizer.model_max_length)
+    return max_length - tokenizer.num_special_tokens_to_add(pair=False)
+
+
+def iter_chunk_texts(text, spans):
+    """Materializa los chunks de `spans` a medida que se consumen."""
+    for start, end in spans:
+        yield text[start:end]
+
+
+def _strip_span(text, start, end):
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def iter_fixed_char_spans(text, chunk_size=1000):
+    for start in range(0, len(text), chunk_size):
+        yield start, min(start + chunk_size, len(text))
+
+
+def iter_fixed_token_spans(text, chunk_size=200):
+    """Bloques de `chunk_size` tokens (palabras y signos de puntuación)."""
+    first = last = None
+    count = 0
+    for match in _TOKEN_RE.finditer(text):
+        if first is None:
+            first = match.start()
+        last = match.end()
+        count += 1
+        if count == chunk_size:
+            yield first, last
+            first, count = None, 0
+    if first is not None:
+        yield first, last
+
+
+def iter_sentence_spans(text, language="spanish"):
+    return sentence_tokenizer(language).span_tokenize(text)
+
+
+def iter_sentence_chunk_spans(text, max_chars=1000, language="spanish"):
+    """Agrupa oraciones consecutivas mientras el chunk no supere `max_chars`."""
+    start = end = None
+    for sent_start, sent_end in iter_sentence_spans(text, language):
+        if start is None:
+            start, end = sent_start, sent_end
+        elif sent_end - start <= max_chars:
+            end = sent_end
+        else:
+            yield start, end
+            start, end = sent_start, sent_end
+    if start is not None:
+        yield start, end
+
+
+def iter_paragraph_spans(text):
+    start = 0
+    for match in _PARAGRAPH_BREAK_RE.finditer(text):
+        span = _strip_span(text, start, match.start())
+        if span[0] < span[1]:
+            yield span
+        start = match.end()
+    span = _strip_span(text, start, len(text))
+    if span[0] < span[1]:
+        yield span
+
+
+def iter_sliding_window_spans(text, window_size=800, overlap=200):
+    step = max(1, window_size - overlap)
+    for start in range(0, len(text), step):
+        yield start, min(start + window_size, len(text))
+
+
+def _iter_pieces(text, start, end, sep):
+    """Trozos de text[start:end] que terminan en `sep` (incluido), sin copiar el texto."""
+    if not sep:
+        for i in range(start, end):
+            yield i, i + 1
+        return
+    while start < end:
+        found = text.find(sep, start, end)
+        if found < 0:
+            yield start, end
+            return
+        yield start, found + len(sep)
+        start = found + len(sep)
+
+
+def iter_recursive_spans(text, chunk_size=1000, separators=RECURSIVE_SEPARATORS, start=0, end=None):
+    """
+    Divide por el primer separador que aparece y junta los trozos hasta `chunk_size`;
+    solo los trozos que por sí solos exceden el tamaño se vuelven a dividir con los
+    separadores siguientes. Cada nivel recorre su tramo una sola vez.
+    """
+    end = len(text) if end is None else end
+    if end - start <= chunk_size:
+        span = _strip_span(text, start, end)
+        if span[0] < span[1]:
+            yield span
+        return
+    for level, sep in enumerate(separators):
+        if not sep or text.find(sep, start, end) >= 0:
+            break
+    rest = separators[level + 1:]
+
+    chunk_start = chunk_end = None
+    for piece_start, piece_end in _iter_pieces(text, start, end, sep):
+        if chunk_start is not None and piece_end - chunk_start <= chunk_size:
+            chunk_end = piece_end
+            continue
+        if chunk_start is not None:
+            span = _strip_span(text, chunk_start, chunk_end)
+            if span[0] < span[1]:
+                yield span
+        if piece_end - piece_start > chunk_size and rest:
+            yield from iter_recursive_spans(text, chunk_size, rest, piece_start, piece_end)
+            chunk_start = chunk_end = None
+        else:
+            chunk_start, chunk_end = piece_start, piece_end
+    if chunk_start is not None:
+        span = _strip_span(text, chunk_start, chunk_end)
+        if span[0] < span[1]:
+            yield span
+
+
+def _iter_token_segments(text, segment_chars):
+    """Tramos de unos `segment_chars` caracteres cortados en un espacio, para no partir tokens."""
+    start, size = 0, len(text)
+    while start < size:
+        end = min(start + segment_chars, size)
+        if end < size:
+            cut = max(text.rfind(" ", start, end), text.rfind("\n", start, end))
+            if cut > start:
+                end = cut
+        yield start, end
+        start = end
+
+
+def token_offsets(text, tokenizer, segment_chars=50000):
+    """
+    Offsets (inicio, fin) de los tokens de `text`, como array (n, 2). El texto se
+    tokeniza una sola vez, en un lote de tramos, con el mapeo de offsets del
+    tokenizador rápido.
+    """
+    segments = list(_iter_token_segments(text, segment_chars))
+    if not segments:
+        return np.empty((0, 2), dtype=np.int64)
+    encoded = tokenizer(
+        [text[start:end] for start, end in segments], add_special_tokens=False,
+        return_offsets_mapping=True, return_attention_mask=False, return_token_type_ids=False,
+        verbose=False
+    )
+    return np.concatenate([
+        np.asarray(mapping, dtype=np.int64).reshape(-1, 2) + start
+        for (start, _), mapping in zip(segments, encoded["offset_mapping"])
+    ])
+
+
+def _iter_token_windows(offsets, max_tokens, overlap, start=None, end=None):
+    """
+    Ventanas de `max_tokens` tokens solapadas en `overlap` sobre los tokens de
+    `offsets` que caen en [start, end) (todos si no se indica el tramo).
+    """
+    if start is not None:
+        first = int(np.searchsorted(offsets[:, 1], start, side="right"))
+        stop = int(np.searchsorted(offsets[:, 0], end, side="left"))
+        offsets = offsets[first:stop]
+    n_tokens = len(offsets)
+    step = max_tokens - overlap
+    for first in range(0, n_tokens, step):
+        last = min(first + max_tokens, n_tokens) - 1
+        window_start, window_end = int(offsets[first, 0]), int(offsets[last, 1])
+        if start is not None:
+            # Un token partido por el límite del tramo se queda con su parte
+            window_start, window_end = max(window_start, start), min(window_end, end)
+        yield window_start, window_end
+        if last == n_tokens - 1:
+            break
+
+
+def iter_token_budget_spans(text, tokenizer, max_tokens, overlap=0, segment_chars=50000):
+    """
+    Ventanas de `max_tokens` tokens del tokenizador del modelo, solapadas en `overlap`.
+
+    El texto se tokeniza una sola vez (token_offsets); los límites de cada chunk son
+    los offsets del primer y del último token de la ventana, así que cada chunk cabe
+    entero en el modelo.
+    """
+    if overlap >= max_tokens:
+        raise ValueError(f"overlap ({overlap}) debe ser menor que max_tokens ({max_tokens})")
+    yield from _iter_token_windows(token_offsets(text, tokenizer, segment_chars), max_tokens, overlap)
+
+
+def chunk_token_budget(text, model_id, max_tokens=None, overlap=0):
+    """Chunks del tamaño que embebe `model_id` (por defecto, su max_seq_length)."""
+    tokenizer = embedder_tokenizer(model_id)
+    max_tokens = embedder_token_budget(model_id) if max_tokens is None else max_tokens
+    return list(iter_chunk_texts(text, iter_token_budget_spans(text, tokenizer, max_tokens, overlap)))
+
+
+def chunk_token_budget_ranges(text, ranges, model_id, max_tokens=None, overlap=0):
+    """
+    Como chunk_token_budget dentro de cada tramo (inicio, fin) de `ranges`, sin que
+    ningún chunk cruce un límite, pero tokenizando el documento una sola vez en lugar
+    de una vez por tramo. Devuelve una lista de chunks por tramo.
+    """
+    tokenizer = embedder_tokenizer(model_id)
+    max_tokens = embedder_token_budget(model_id) if max_tokens is None else max_tokens
+    if overlap >= max_tokens:
+        raise ValueError(f"overlap ({overlap}) debe ser menor que max_tokens ({max_tokens})")
+    offsets = token_offsets(text, tokenizer)
+    return [list(iter_chunk_texts(text, _iter_token_windows(offsets, max_tokens, overlap, start, end)))
+            for start, end in ranges]
+
+
+def chunk_hierarchical(text, chunker, parent_chars=4000, ranges_chunker=None):
+    """
+    Chunks padre (bloques de párrafos de hasta `parent_chars`, cortados con
+    iter_recursive_spans) y, dentro de cada uno, los chunks hijo de `chunker`.
+    Devuelve (textos de los padres, [(índice del padre, texto del hijo)]); un hijo
+    nunca cruza el límite de su padre.
+
+    Si se pasa `ranges_chunker`, la variante por tramos de `chunker` (como
+    chunk_token_budget_ranges), se llama una vez con todo el documento y los tramos de
+    los padres: así el tokenizador del modelo recorre el documento una vez y no una por
+    padre.
+    """
+    spans = list(iter_recursive_spans(text, parent_chars))
+    parents = [text[start:end] for start, end in spans]
+    if ranges_chunker is not None:
+        per_parent = ranges_chunker(text, spans)
+    else:
+        per_parent = (chunker(parent) for parent in parents)
+    children = [(i, child) for i, chunks in enumerate(per_parent) for child in chunks]
+    return parents, children
+
 
 def chunk_fixed_char(text, chunk_size=1000):
-    print("fixed vhars")
-    text = re.sub(r'\s+', ' ', text).strip()
-    return [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
+    return list(iter_chunk_texts(text, iter_fixed_char_spans(text, chunk_size)))
+
 
 def chunk_fixed_tokens(text, chunk_size=200):
-    print("fixed tokens")    
-    tokens = word_tokenize(text)
-    chunks = [' '.join(tokens[i:i+chunk_size]) for i in range(0, len(tokens), chunk_size)]
-    return chunks
+    return list(iter_chunk_texts(text, iter_fixed_token_spans(text, chunk_size)))
+
 
 def chunk_sentence_based(text, max_chars=1000):
-    print("sentence based")    
-    sentences = sent_tokenize(text)
-    chunks = []
-    current_chunk = ""
-    
-    for sentence in sentences:
-        if len(current_chunk) + len(sentence) + 1 <= max_chars:
-            current_chunk += sentence + " "
-        else:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = sentence + " "
-    
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-    
-    return chunks
+    return list(iter_chunk_texts(text, iter_sentence_chunk_spans(text, max_chars)))
+
 
 def chunk_paragraph_based(text):
-    print("paragraph based")    
-    paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
-    print("recursive")
-    return paragraphs
-
-def chunk_recursive(text, chunk_size=1000, separators=["\n\n", "\n", ". ", "? ", "! ", " ", ""]):
-    if len(text) <= chunk_size:
-        return [text]
-    
-    for sep in separators:
-        parts = text.split(sep)
-        if len(parts) > 1:
-            break
-    
-    chunks = []
-    current_chunk = ""
-    
-    for part in parts:
-        if len(current_chunk) + len(part) + len(sep) <= chunk_size:
-            current_chunk += part + sep
-        else:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = part + sep
-    
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-    
-    # Si algún chunk sigue siendo muy grande, recursión
-    final_chunks = []
-    for chunk in chunks:
-        if len(chunk) > chunk_size:
-            final_chunks.extend(chunk_recursive(chunk, chunk_size, separators))
-        else:
-            final_chunks.append(chunk)
-    
-    return final_chunks
+    return list(iter_chunk_texts(text, iter_paragraph_spans(text)))
 
-def chunk_sliding_window(text, window_size=800, overlap=200):
-    print("sliding window")    
-    text = re.sub(r'\n\s*\n', ' ', text).strip()
-    chunks = []
-    start = 0
-    
-    while start < len(text):
-        end = min(start + window_size, len(text))
-        chunks.append(text[start:end])
-        start += (window_size - overlap)
-    
-    return chunks
+
+def chunk_recursive(text, chunk_size=1000, separators=RECURSIVE_SEPARATORS):
+    return list(iter_chunk_texts(text, iter_recursive_spans(text, chunk_size, separators)))
 
 
+def chunk_sliding_window(text, window_size=800, overlap=200):
+    return list(iter_chunk_texts(text, iter_sliding_window_spans(text, window_size, overlap)))
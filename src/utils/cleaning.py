@@ -0,0 +1,156 @@
+import os
+import re
+import unicodedata
+from collections import Counter
+
+# Marcadores de inicio y fin del texto en los libros de Project Gutenberg
+_GUTENBERG_START = re.compile(
+    r"^.*(?:\*{3}\s*START OF (?:THE|THIS) PROJECT GUTENBERG|\*END\*THE SMALL PRINT).*$",
+    re.IGNORECASE | re.MULTILINE
+)
+_GUTENBERG_END = re.compile(
+    r"^.*(?:\*{3}\s*END OF (?:THE|THIS) PROJECT GUTENBERG|End of (?:the )?Project Gutenberg).*$",
+    re.IGNORECASE | re.MULTILINE
+)
+_GUTENBERG_CREDITS = re.compile(
+    r"\A(?:\s*(?:Produced by|E-text prepared by|This file was produced|Nota del transcriptor)[^\n]*(?:\n[^\n]+)*)+",
+    re.IGNORECASE
+)
+# Sellos de digitalización que el OCR de Internet Archive deja en cada página
+_ARCHIVE_STAMP = re.compile(
+    r"^[^\n]{0,40}(?:Digitized by|Digitalizado por|Original from|Generated (?:by|from)|Provided by"
+    r"|archive\.org|Internet Archive|Google)[^\n]{0,60}$",
+    re.IGNORECASE | re.MULTILINE
+)
+# "12", "— 12 —", "[12]", "Pág. 12", "xiv" (solo numerales romanos válidos, para no borrar palabras)
+_ROMAN = r"(?=[ivxlcdm])m{0,3}(?:cm|cd|d?c{0,3})(?:xc|xl|l?x{0,3})(?:ix|iv|v?i{0,3})"
+_PAGE_NUMBER = re.compile(
+    r"^[ \t]*(?:[-—–\[(][ \t]*)?(?:p[áa]g(?:ina)?\.?[ \t]*)?(?:\d{1,4}|" + _ROMAN + r")(?:[ \t]*[-—–\])])?[ \t]*$",
+    re.IGNORECASE | re.MULTILINE
+)
+# Entradas de índice con puntos guía: "Capítulo III. La conquista ........ 45"
+_TOC_ENTRY = re.compile(r"^[^\n]{0,120}?(?:[.…·][ \t]*){4,}[ \t]*\d{1,4}[ \t]*$", re.MULTILINE)
+_HYPHEN_BREAK = re.compile(r"(?<=\w)[-¬][ \t]*\n[ \t]*(?=[a-záéíóúüñ])")
+_CONTROL_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f\ufffd]")
+
+
+def strip_gutenberg_boilerplate(text):
+    """Se queda con el texto entre los marcadores START/END y quita los créditos del inicio."""
+    starts = list(_GUTENBERG_START.finditer(text))
+    if starts:
+        text = text[starts[-1].end():]
+    end = _GUTENBERG_END.search(text)
+    if end:
+        text = text[:end.start()]
+    return _GUTENBERG_CREDITS.sub("", text.lstrip("\r\n"))
+
+
+def strip_archive_boilerplate(text):
+    return _ARCHIVE_STAMP.sub("", text)
+
+
+def strip_page_numbers(text):
+    return _PAGE_NUMBER.sub("", text)
+
+
+def strip_table_of_contents(text):
+    return _TOC_ENTRY.sub("", text)
+
+
+def strip_running_headers(text, min_repeats=5):
+    """Quita las líneas cortas que se repiten en muchas páginas (título del libro, capítulo...)."""
+    lines = text.split("\n")
+    counts = Counter(line.strip() for line in lines)
+    headers = {
+        line for line, n in counts.items()
+        if n >= min_repeats and 8 <= len(line) <= 60 and any(c.isalpha() for c in line)
+    }
+    if not headers:
+        return text
+    return "\n".join(line for line in lines if line.strip() not in headers)
+
+
+def strip_ocr_noise(text, min_alpha_ratio=0.5):
+    """Quita caracteres de control y las líneas donde predominan símbolos sueltos."""
+    text = _CONTROL_CHARS.sub("", text)
+    kept = []
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if len(stripped) > 3:
+            alnum = sum(c.isalnum() or c.isspace() for c in stripped)
+            if alnum < min_alpha_ratio * len(stripped):
+                continue
+        kept.append(line)
+    return "\n".join(kept)
+
+
+def dehyphenate(text):
+    """Une las palabras partidas a final de línea: 'indepen-\\ndencia' -> 'independencia'."""
+    return _HYPHEN_BREAK.sub("", text)
+
+
+def normalize_whitespace(text):
+    """
+    Unicode NFC, espacios simples y párrafos separados por una línea en blanco.
+    Los saltos de línea sueltos (ajuste de línea del archivo) se convierten en espacios.
+    """
+    text = unicodedata.normalize("NFC", text).replace("\r\n", "\n").replace("\r", "\n")
+    text = re.sub(r"[ \t\u00a0\f\v]+", " ", text)
+    text = re.sub(r" ?\n ?", "\n", text)
+    text = re.sub(r"(?<!\n)\n(?!\n)", " ", text)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip()
+
+
+# Pasos disponibles, en el orden en que se aplican: primero los que trabajan por
+# líneas, después la unión de palabras partidas y por último los espacios.
+CLEANING_STEPS = {
+    "gutenberg_boilerplate": strip_gutenberg_boilerplate,
+    "archive_boilerplate": strip_archive_boilerplate,
+    "running_headers": strip_running_headers,
+    "page_numbers": strip_page_numbers,
+    "table_of_contents": strip_table_of_contents,
+    "ocr_noise": strip_ocr_noise,
+    "dehyphenate": dehyphenate,
+    "whitespace": normalize_whitespace
+}
+
+# Pasos por fuente. La fuente se deduce del prefijo con que se descargó el archivo.
+CLEANING_RULES = {
+    "gutenberg": ["gutenberg_boilerplate", "page_numbers", "table_of_contents", "dehyphenate", "whitespace"],
+    "archive": ["archive_boilerplate", "running_headers", "page_numbers", "table_of_contents",
+                "ocr_noise", "dehyphenate", "whitespace"],
+    "local": ["page_numbers", "dehyphenate", "whitespace"]
+}
+
+
+def source_for_file(file_path):
+    name = os.path.basename(file_path)
+    if name.startswith("GUT_"):
+        return "gutenberg"
+    if name.startswith("IA_"):
+        return "archive"
+    return "local"
+
+
+def clean_text(text, file_path="", rules=None):
+    """
+    Limpia el texto de un libro antes de trocearlo según las reglas de su fuente.
+    Devuelve (texto limpio, {paso: bytes eliminados}).
+    """
+    rules = CLEANING_RULES if rules is None else rules
+    steps = set(rules.get(source_for_file(file_path), ()))
+    removed = {}
+    size = len(text.encode("utf-8"))
+    if not steps:
+        return text, removed
+    # Los pasos por líneas asumen saltos de línea '\n'
+    text = text.replace("\r\n", "\n")
+    for name, step in CLEANING_STEPS.items():
+        if name not in steps:
+            continue
+        text = step(text)
+        new_size = len(text.encode("utf-8"))
+        removed[name] = size - new_size
+        size = new_size
+    return text, removed
@@ -9,7 +9,7 @@ PROFILE_JID="profilemanageragent@localhost"
 PERSONALITY_JID="personality_analizer@localhost"
 
 INDEX_FILE = "faiss_index.bin"
-METADATA_FILE = "chunk_metadata.pickle"
+CHUNK_STORE_DIR = "chunk_store"
 
 SERVER = "localhost"
 PASSWORDS = {
@@ -25,14 +25,73 @@ PASSWORDS = {
 }
 
 INDEX_FILE = "faiss_index.bin"
-METADATA_FILE = "chunk_metadata.pickle"
+CHUNK_STORE_DIR = "chunk_store"
+MANIFEST_FILE = "index_manifest.json"
+# Modelo con el que se embeben los chunks del corpus
+EMBEDDING_MODEL = "sentence-transformers/paraphrase-MiniLM-L3-v2"
+# Tokens que comparten dos chunks consecutivos (el tamaño lo fija el max_seq_length del modelo)
+CHUNK_TOKEN_OVERLAP = 32
+# max_seq_length de EMBEDDING_MODEL; solo se usa si no se puede leer de su sentence_bert_config.json
+CHUNK_MAX_TOKENS = 128
+# Tamaño máximo de los chunks padre: se embeben los hijos y al LLM se le pasan los padres
+PARENT_CHUNK_CHARS = 4000
+EMBEDDING_CACHE_FILE = "embedding_cache.sqlite"
+EMBEDDING_CACHE_MAX_BYTES = 1 << 30
+# 'flat', 'ivf', 'ivfpq', 'hnsw' o una cadena de faiss.index_factory ({nlist} y {m} se calculan)
+FAISS_INDEX_SPEC = "ivf"
+TARGET_RECALL = 0.95
+# Cargar el índice con mmap de solo lectura (compartido entre réplicas del SearchAgent)
+INDEX_MMAP = True
+# Cada cuántos segundos el SearchAgent comprueba si hay una nueva generación del índice
+INDEX_RELOAD_PERIOD = 30
+# Candidatos que devuelve el SearchAgent por consulta
+SEARCH_TOP_K = 10
+# Ventana (ms) y tamaño máximo de los lotes de consultas que el SearchAgent codifica y busca juntas
+SEARCH_BATCH_WINDOW_MS = 10
+SEARCH_BATCH_MAX = 32
+# Hilos que codifican y buscan los lotes fuera del event loop, y consultas que pueden esperar en cola
+SEARCH_WORKERS = 2
+SEARCH_QUEUE_SIZE = 256
+# Consultas repetidas cuyo embedding y top-k guarda el SearchAgent, y segundos que valen
+QUERY_CACHE_SIZE = 1024
+QUERY_CACHE_TTL = 3600
+# Búsqueda híbrida: candidatos que aporta cada recuperador (FAISS y BM25) antes de
+# fusionarlos con reciprocal rank fusion, y constante k de la fusión
+HYBRID_DEPTH = 30
+RRF_K = 60
+# Parámetros de BM25 (saturación de la frecuencia y normalización por longitud)
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Consultas tokenizadas que se guardan para no volver a tokenizar las repetidas
+QUERY_TOKENS_CACHE_SIZE = 4096
+# Caché semántica de respuestas finales: similitud coseno mínima entre preguntas, tamaño,
+# antigüedad máxima (s) y diferencia relativa tolerada en los parámetros numéricos del perfil
+ANSWER_CACHE_FILE = "answer_cache.sqlite"
+ANSWER_CACHE_THRESHOLD = 0.92
+ANSWER_CACHE_MAX_ENTRIES = 5000
+ANSWER_CACHE_MAX_AGE = 7 * 24 * 3600
+ANSWER_CACHE_PARAM_TOLERANCE = 0.1
+# Qué hace el SearchAgent si el índice se construyó con otro embedder o chunker:
+# "migrate" lo reconstruye en segundo plano sirviendo el anterior; "refuse" no arranca
+EMBEDDER_MISMATCH_POLICY = "migrate"
+# Distancia de Hamming máxima (SimHash de 64 bits) para considerar dos chunks casi duplicados
+DEDUP_MAX_DISTANCE = 3
+# Los chunks con menos palabras no se deduplican
+DEDUP_MIN_TOKENS = 8
 DOCUMENTS_FOLDER = "./data"
+# Descargas simultáneas por host al construir el corpus
+DOWNLOAD_PER_HOST = 4
+# Carpeta o URL (p. ej. http://localhost:8000) de la que copiar los libros en lugar de
+# buscarlos en Gutenberg/Archive; None para descargarlos de internet
+CORPUS_MIRROR = None
 
 HF_MODEL = "mistralai/Mixtral-8x7B-Instruct-v0.1"
 #HF_MODEL = "free"
 WIKIPEDIA_API = "https://es.wikipedia.org/w/api.php"
 
 CONFIDENCE_THRESHOLD = 0.75
+# Caracteres de contexto (chunks padre sin repetir) que se envían al PromptAgent
+PROMPT_CONTEXT_CHARS = 10000
 
 LOG_DIR = "logs"
 
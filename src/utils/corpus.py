@@ -0,0 +1,73 @@
+import os
+import mmap
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def read_text_mmap(file_path):
+    """
+    Lee un .txt mapeándolo en memoria; el archivo solo se toca cuando un worker lo procesa.
+    Devuelve None si está vacío o no se puede leer.
+    """
+    try:
+        if os.path.getsize(file_path) == 0:
+            logger.warning(f"Archivo vacío: {file_path}")
+            return None
+        with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            content = str(mm, encoding="utf-8", errors="replace")
+    except Exception as e:
+        logger.error(f"Error leyendo {file_path}: {str(e)}")
+        return None
+    if not content.strip():
+        logger.warning(f"Archivo vacío: {file_path}")
+        return None
+    return content
+
+
+def iter_in_processes(fn, items, workers=None, max_in_flight=None):
+    """
+    Aplica `fn` a cada elemento en un pool de procesos y entrega los resultados en orden
+    a medida que terminan.
+
+    Como mucho hay `max_in_flight` elementos en vuelo (por defecto 2 por worker), así que
+    la memoria pico depende de ese número y no de cuántos elementos haya.
+    """
+    items = list(items)
+    if not items:
+        return
+    workers = min(workers or os.cpu_count() or 1, len(items))
+    max_in_flight = max_in_flight or 2 * workers
+
+    if workers == 1:
+        for item in items:
+            yield fn(item)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        remaining = iter(items)
+        for item in remaining:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_in_flight:
+                break
+        while pending:
+            yield pending.popleft().result()
+            item = next(remaining, None)
+            if item is not None:
+                pending.append(executor.submit(fn, item))
+
+
+def map_in_processes(fn, items, workers=None):
+    """
+    Aplica `fn` a cada elemento en un pool de procesos y devuelve los resultados en orden.
+    Con un solo worker (o un solo elemento) se ejecuta en este proceso.
+    """
+    items = list(items)
+    workers = min(workers or os.cpu_count() or 1, len(items))
+    if workers <= 1:
+        return [fn(item) for item in items]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fn, items))
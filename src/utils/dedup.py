@@ -0,0 +1,89 @@
+import re
+import hashlib
+import numpy as np
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+SIMHASH_BITS = 64
+
+
+def _shingles(tokens, size):
+    if len(tokens) <= size:
+        return [" ".join(tokens)]
+    return [" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)]
+
+
+def simhash(text, shingle_size=3):
+    """
+    SimHash de 64 bits sobre shingles de `shingle_size` palabras.
+    Devuelve (hash, número de palabras). Textos casi iguales difieren en pocos bits.
+    """
+    tokens = _WORD_RE.findall(text.lower())
+    if not tokens:
+        return 0, 0
+    hashes = np.array([
+        int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little")
+        for s in _shingles(tokens, shingle_size)
+    ], dtype="uint64")
+    # Cada bit del resultado es el voto mayoritario de ese bit entre los shingles
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    majority = bits.sum(axis=0) * 2 > len(hashes)
+    value = int.from_bytes(np.packbits(majority, bitorder="little").tobytes(), "little")
+    return value, len(tokens)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class SimHashIndex:
+    """
+    Índice de SimHash para encontrar chunks casi duplicados sin compararlos todos.
+
+    El hash se parte en max_distance + 1 bandas: dos hashes a distancia de Hamming
+    <= max_distance coinciden al menos en una banda (principio del palomar), así que
+    solo se comparan los chunks que comparten alguna banda.
+    Los textos con menos de `min_tokens` palabras no se deduplican: su SimHash es
+    poco fiable y suelen ser títulos o frases sueltas.
+    """
+
+    def __init__(self, max_distance=3, min_tokens=8, shingle_size=3):
+        self.max_distance = max_distance
+        self.min_tokens = min_tokens
+        self.shingle_size = shingle_size
+        self.n_bands = max_distance + 1
+        self.band_bits = SIMHASH_BITS // self.n_bands
+        self.tables = [dict() for _ in range(self.n_bands)]
+        self.hashes = {}
+
+    def _bands(self, value):
+        mask = (1 << self.band_bits) - 1
+        return [(value >> (i * self.band_bits)) & mask for i in range(self.n_bands)]
+
+    def add(self, chunk_id, value):
+        self.hashes[chunk_id] = value
+        for table, band in zip(self.tables, self._bands(value)):
+            table.setdefault(band, []).append(chunk_id)
+
+    def find(self, value):
+        """Id del primer chunk indexado a distancia <= max_distance, o None."""
+        best, best_distance = None, self.max_distance + 1
+        for table, band in zip(self.tables, self._bands(value)):
+            for chunk_id in table.get(band, ()):
+                distance = hamming(value, self.hashes[chunk_id])
+                if distance < best_distance or (best is not None and distance == best_distance and chunk_id < best):
+                    best, best_distance = chunk_id, distance
+        return best if best_distance <= self.max_distance else None
+
+    def check(self, chunk_id, text):
+        """
+        Calcula el SimHash de `text` y devuelve (hash, id del original). Si no es
+        duplicado de nada, el chunk queda registrado como original y el id es -1.
+        """
+        value, n_tokens = simhash(text, self.shingle_size)
+        if n_tokens < self.min_tokens:
+            return value, -1
+        original = self.find(value)
+        if original is not None:
+            return value, original
+        self.add(chunk_id, value)
+        return value, -1
@@ -0,0 +1,217 @@
+import os
+import json
+import shutil
+import asyncio
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+ETAGS_NAME = ".etags.json"
+# Lista de archivos que publica un espejo HTTP (p. ej. `python -m http.server` en la carpeta)
+MIRROR_INDEX = "index.json"
+_STREAM_CHUNK = 1 << 16
+
+
+def run_sync(coro):
+    """Ejecuta una corrutina desde código síncrono, aunque ya haya un event loop corriendo (p. ej. en un agente)."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+def write_mirror_index(folder):
+    """Escribe index.json con los .txt de `folder` para servirla como espejo HTTP."""
+    names = sorted(name for name in os.listdir(folder) if name.endswith(".txt"))
+    with open(os.path.join(folder, MIRROR_INDEX), "w", encoding="utf-8") as f:
+        json.dump(names, f, ensure_ascii=False, indent=1)
+    return names
+
+
+class CorpusDownloader:
+    """
+    Descargador asíncrono de libros hacia `dest_folder`.
+
+    Cada host tiene su propia sesión HTTP (las conexiones se reutilizan) y un semáforo
+    que limita las descargas simultáneas a `per_host`. Las peticiones bloqueantes de
+    requests se ejecutan en hilos para no frenar el event loop.
+
+    - Reanudación: la descarga se escribe en `<archivo>.part`; si se corta, la siguiente
+      pide solo los bytes que faltan con Range/If-Range.
+    - ETag: se guarda el ETag/Last-Modified de cada archivo en .etags.json y al volver a
+      pedirlo se envía If-None-Match; un 304 evita descargarlo de nuevo.
+    - Espejo: si `mirror` es una carpeta local los archivos se copian desde ella; si es
+      una URL, se descargan de `<mirror>/<nombre>` (p. ej. un http.server local). Así la
+      construcción del corpus es reproducible y se puede medir sin conexión.
+    """
+
+    def __init__(self, dest_folder, per_host=4, mirror=None, timeout=30, user_agent="Mozilla/5.0"):
+        self.dest_folder = dest_folder
+        self.per_host = per_host
+        self.mirror = mirror
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self.stats = Counter()
+        self._sessions = {}
+        self._semaphores = {}
+        self._lock = threading.Lock()
+        os.makedirs(dest_folder, exist_ok=True)
+        self._etags_file = os.path.join(dest_folder, ETAGS_NAME)
+        try:
+            with open(self._etags_file, "r", encoding="utf-8") as f:
+                self.etags = json.load(f)
+        except (OSError, ValueError):
+            self.etags = {}
+
+    @property
+    def mirror_is_local(self):
+        return self.mirror is not None and not urlsplit(self.mirror).scheme.startswith("http")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for session in self._sessions.values():
+            session.close()
+        self._sessions.clear()
+
+    def _session(self, host):
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.per_host, max_retries=2)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers["User-Agent"] = self.user_agent
+                self._sessions[host] = session
+            return session
+
+    def _semaphore(self, host):
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.per_host)
+        return self._semaphores[host]
+
+    def _save_etags(self):
+        with self._lock:
+            tmp_file = self._etags_file + ".tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(self.etags, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_file, self._etags_file)
+
+    async def get_json(self, url, params=None):
+        host = urlsplit(url).netloc
+        async with self._semaphore(host):
+            def get():
+                r = self._session(host).get(url, params=params, timeout=self.timeout)
+                r.raise_for_status()
+                return r.json()
+            return await asyncio.to_thread(get)
+
+    async def mirror_files(self):
+        """Nombres de los .txt disponibles en el espejo, en orden."""
+        if self.mirror_is_local:
+            return sorted(name for name in os.listdir(self.mirror) if name.endswith(".txt"))
+        return sorted(await self.get_json(f"{self.mirror.rstrip('/')}/{MIRROR_INDEX}"))
+
+    async def fetch(self, url, filename, min_size=0):
+        """
+        Descarga `url` como `dest_folder/filename` (o la toma del espejo).
+        Devuelve la ruta, o None si no existe o tiene menos de `min_size` bytes.
+        """
+        if self.mirror is not None:
+            if self.mirror_is_local:
+                return await asyncio.to_thread(self._copy_from_mirror, filename, min_size)
+            url = f"{self.mirror.rstrip('/')}/{filename}"
+        host = urlsplit(url).netloc
+        async with self._semaphore(host):
+            try:
+                return await asyncio.to_thread(self._fetch_blocking, host, url, filename, min_size)
+            except requests.RequestException as e:
+                self.stats["failed"] += 1
+                logger.warning(f"No se pudo descargar {url}: {str(e)}")
+                return None
+
+    def _copy_from_mirror(self, filename, min_size):
+        source = os.path.join(self.mirror, filename)
+        dest = os.path.join(self.dest_folder, filename)
+        if not os.path.exists(source) or os.path.getsize(source) < min_size:
+            return None
+        if os.path.exists(dest):
+            src_stat, dst_stat = os.stat(source), os.stat(dest)
+            if src_stat.st_size == dst_stat.st_size and int(src_stat.st_mtime) == int(dst_stat.st_mtime):
+                self.stats["not_modified"] += 1
+                return dest
+        shutil.copy2(source, dest)
+        self.stats["copied"] += 1
+        self.stats["bytes"] += os.path.getsize(dest)
+        return dest
+
+    def _fetch_blocking(self, host, url, filename, min_size):
+        dest = os.path.join(self.dest_folder, filename)
+        part = dest + ".part"
+        entry = self.etags.get(filename)
+        if entry is not None and entry.get("url") != url:
+            entry = None
+        validator = entry and (entry.get("etag") or entry.get("last_modified"))
+
+        headers = {}
+        resume_from = 0
+        if os.path.exists(dest):
+            if not validator:
+                # Descargado antes de guardar ETags o copiado a mano: no se vuelve a pedir
+                return dest
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        elif os.path.exists(part) and validator:
+            resume_from = os.path.getsize(part)
+            headers["Range"] = f"bytes={resume_from}-"
+            headers["If-Range"] = validator
+
+        with self._session(host).get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+            if r.status_code == 304:
+                self.stats["not_modified"] += 1
+                return dest
+            if r.status_code == 416 and resume_from:
+                # El .part ya estaba completo
+                r.close()
+            elif r.status_code == 404:
+                return None
+            else:
+                r.raise_for_status()
+                if r.status_code == 206:
+                    mode = "ab"
+                    self.stats["resumed"] += 1
+                else:
+                    mode = "wb"
+                    resume_from = 0
+                self.etags[filename] = {
+                    "url": url,
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified")
+                }
+                self._save_etags()
+                with open(part, mode) as f:
+                    for chunk in r.iter_content(_STREAM_CHUNK):
+                        f.write(chunk)
+                        self.stats["bytes"] += len(chunk)
+
+        if os.path.getsize(part) < min_size:
+            os.remove(part)
+            return None
+        os.replace(part, dest)
+        self.stats["downloaded"] += 1
+        return dest
@@ -0,0 +1,134 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# SQLite admite como mucho 999 parámetros por consulta en versiones antiguas
+_SQL_BATCH = 500
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Caché persistente de embeddings direccionada por contenido.
+
+    La clave es (id del modelo, sha256 del texto), así que un chunk idéntico nunca se
+    vuelve a codificar aunque cambie la estrategia de chunking o se reconstruya el
+    índice. Se guarda la salida cruda del modelo (sin normalizar). Cuando el tamaño
+    total supera `max_bytes` se expulsan las entradas usadas hace más tiempo.
+    """
+
+    def __init__(self, path, max_bytes=1 << 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " text_hash TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_access REAL NOT NULL,"
+            " PRIMARY KEY (model, text_hash))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings(last_access)")
+        self.conn.commit()
+
+    def get_many(self, model_id, hashes):
+        """Devuelve {hash: vector} para los hashes presentes y actualiza su último acceso."""
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        for start in range(0, len(unique), _SQL_BATCH):
+            batch = unique[start:start + _SQL_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.conn.execute(
+                f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                [model_id, *batch]
+            ).fetchall()
+            for h, blob in rows:
+                found[h] = np.frombuffer(blob, dtype="float32")
+        if found:
+            now = time.time()
+            self.conn.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE model = ? AND text_hash = ?",
+                [(now, model_id, h) for h in found]
+            )
+            self.conn.commit()
+        return found
+
+    def put_many(self, model_id, hashes, vectors):
+        now = time.time()
+        rows = []
+        for h, vector in zip(hashes, vectors):
+            blob = np.ascontiguousarray(vector, dtype="float32").tobytes()
+            rows.append((model_id, h, blob, len(blob), now))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, size, last_access) VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+        self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        """Expulsa por LRU hasta dejar la caché en el 90% de `max_bytes`."""
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.9)
+        removed = 0
+        cursor = self.conn.execute("SELECT model, text_hash, size FROM embeddings ORDER BY last_access ASC")
+        victims = []
+        for model_id, h, size in cursor:
+            if total - removed <= target:
+                break
+            victims.append((model_id, h))
+            removed += size
+        cursor.close()
+        self.conn.executemany("DELETE FROM embeddings WHERE model = ? AND text_hash = ?", victims)
+        self.conn.commit()
+        logger.info(f"EmbeddingCache: expulsadas {len(victims)} entradas ({removed} bytes)")
+
+    def encode(self, model_id, texts, encode_fn):
+        """
+        Devuelve los embeddings de `texts` consultando primero la caché.
+        `encode_fn` solo se llama con los textos que faltan (sin repetidos).
+        """
+        hashes = [text_hash(t) for t in texts]
+        found = self.get_many(model_id, hashes)
+
+        missing = {}
+        for h, t in zip(hashes, texts):
+            if h not in found and h not in missing:
+                missing[h] = t
+        n_missing = sum(1 for h in hashes if h not in found)
+        self.hits += len(texts) - n_missing
+        self.misses += n_missing
+
+        if missing:
+            new_vectors = np.asarray(encode_fn(list(missing.values())), dtype="float32")
+            self.put_many(model_id, list(missing), new_vectors)
+            found.update(zip(missing, new_vectors))
+
+        if not texts:
+            return np.empty((0, 0), dtype="float32")
+        return np.vstack([found[h] for h in hashes])
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,154 @@
+import os
+import json
+import shutil
+import logging
+from itertools import islice
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_NAME = "checkpoint.json"
+
+
+class EmbeddingShards:
+    """
+    Almacén de embeddings en shards .npy mapeados en memoria, con checkpoint.
+
+    Las filas se escriben en orden de llegada; la fila i vive en el shard i // shard_size.
+    Tras cada lote se hace flush del shard y se actualiza checkpoint.json, de modo que
+    si el proceso muere la siguiente ejecución con la misma `build_key` retoma desde
+    la última fila confirmada en lugar de volver a embeber todo.
+    """
+
+    def __init__(self, shard_dir, build_key, shard_size=65536):
+        self.shard_dir = shard_dir
+        self.build_key = build_key
+        self.shard_size = shard_size
+        self.rows = 0
+        self.dimension = None
+        self.seen = 0
+        self._shard = None
+        self._shard_id = None
+        os.makedirs(shard_dir, exist_ok=True)
+
+        checkpoint = self._read_checkpoint()
+        if checkpoint and checkpoint.get("build_key") == build_key and checkpoint.get("shard_size") == shard_size:
+            self.rows = checkpoint["rows"]
+            self.dimension = checkpoint["dimension"]
+            # Abrir los shards de una construcción terminada (train/add) es lo normal;
+            # quien retoma embebiendo lo anuncia él mismo
+            logger.debug(f"Shards de embeddings con checkpoint: {self.rows} filas.")
+        else:
+            if checkpoint:
+                logger.info("Checkpoint de embeddings de otra construcción, se descarta.")
+            self._reset()
+
+    def _checkpoint_path(self):
+        return os.path.join(self.shard_dir, CHECKPOINT_NAME)
+
+    def _shard_path(self, shard_id):
+        return os.path.join(self.shard_dir, f"shard_{shard_id:05d}.npy")
+
+    def _read_checkpoint(self):
+        try:
+            with open(self._checkpoint_path(), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_checkpoint(self):
+        tmp_file = self._checkpoint_path() + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({
+                "build_key": self.build_key,
+                "rows": self.rows,
+                "dimension": self.dimension,
+                "shard_size": self.shard_size
+            }, f)
+        os.replace(tmp_file, self._checkpoint_path())
+
+    def _reset(self):
+        for name in os.listdir(self.shard_dir):
+            if name.startswith("shard_") or name == CHECKPOINT_NAME:
+                os.remove(os.path.join(self.shard_dir, name))
+        self.rows = 0
+        self.dimension = None
+
+    def _open_shard(self, shard_id):
+        if self._shard_id == shard_id:
+            return self._shard
+        if self._shard is not None:
+            self._shard.flush()
+        path = self._shard_path(shard_id)
+        if os.path.exists(path):
+            self._shard = np.load(path, mmap_mode="r+")
+        else:
+            self._shard = np.lib.format.open_memmap(
+                path, mode="w+", dtype="float32", shape=(self.shard_size, self.dimension)
+            )
+        self._shard_id = shard_id
+        return self._shard
+
+    def _write(self, embeddings):
+        if self.dimension is None:
+            self.dimension = int(embeddings.shape[1])
+        offset = 0
+        while offset < len(embeddings):
+            shard_id, row = divmod(self.rows, self.shard_size)
+            shard = self._open_shard(shard_id)
+            n = min(self.shard_size - row, len(embeddings) - offset)
+            shard[row:row + n] = embeddings[offset:offset + n]
+            offset += n
+            self.rows += n
+        self._shard.flush()
+        self._write_checkpoint()
+
+    def extend(self, texts, encode, batch_size=512):
+        """
+        Añade los embeddings de `texts` (en orden), saltándose las filas que el
+        checkpoint ya tiene. `texts` puede ser cualquier iterable: solo se tiene en
+        memoria un lote. `encode` recibe una lista de textos y devuelve un array float32.
+        Devuelve cuántos textos se codificaron realmente.
+        """
+        texts = iter(texts)
+        encoded = 0
+        while True:
+            batch = list(islice(texts, batch_size))
+            if not batch:
+                return encoded
+            skip = min(len(batch), max(0, self.rows - self.seen))
+            self.seen += len(batch)
+            pending = batch[skip:]
+            if pending:
+                self._write(np.ascontiguousarray(encode(pending), dtype="float32"))
+                encoded += len(pending)
+
+    def _shard_rows(self, shard_id):
+        return min(self.shard_size, self.rows - shard_id * self.shard_size)
+
+    def iter_batches(self, batch_rows=65536):
+        """Itera (fila_inicial, array) sobre las filas confirmadas, shard a shard."""
+        n_shards = (self.rows + self.shard_size - 1) // self.shard_size
+        for shard_id in range(n_shards):
+            shard = np.load(self._shard_path(shard_id), mmap_mode="r")
+            valid = self._shard_rows(shard_id)
+            for start in range(0, valid, batch_rows):
+                end = min(start + batch_rows, valid)
+                yield shard_id * self.shard_size + start, np.ascontiguousarray(shard[start:end])
+
+    def take(self, rows):
+        """Copia a memoria solo las filas pedidas, en orden ascendente (p. ej. la muestra de entrenamiento)."""
+        rows = np.sort(np.asarray(rows, dtype="int64"))
+        out = np.empty((len(rows), self.dimension), dtype="float32")
+        shard_ids = rows // self.shard_size
+        for shard_id in np.unique(shard_ids):
+            mask = shard_ids == shard_id
+            shard = np.load(self._shard_path(int(shard_id)), mmap_mode="r")
+            out[mask] = shard[rows[mask] - shard_id * self.shard_size]
+        return out
+
+    def clear(self):
+        """Borra los shards una vez que el índice se ha persistido."""
+        self._shard = None
+        self._shard_id = None
+        shutil.rmtree(self.shard_dir, ignore_errors=True)
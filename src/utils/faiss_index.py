@@ -0,0 +1,190 @@
+import os
+import math
+import time
+import logging
+import numpy as np
+import faiss
+
+logger = logging.getLogger(__name__)
+
+# Alias cortos para las cadenas de index_factory de FAISS.
+# {nlist} y {m} se resuelven según el tamaño del corpus y la dimensión.
+INDEX_ALIASES = {
+    "flat": "Flat",
+    "ivf": "IVF{nlist},Flat",
+    "ivfpq": "IVF{nlist},PQ{m}",
+    "hnsw": "HNSW32"
+}
+
+# FAISS recomienda al menos 39 puntos de entrenamiento por centroide
+MIN_POINTS_PER_CENTROID = 39
+PQ_CENTROIDS = 256
+
+
+def suggest_nlist(n_vectors, n_train=None):
+    """nlist ≈ 4·√N, limitado para que cada centroide tenga suficientes puntos de entrenamiento."""
+    nlist = int(4 * math.sqrt(max(n_vectors, 1)))
+    if n_train is not None:
+        nlist = min(nlist, n_train // MIN_POINTS_PER_CENTROID)
+    return max(1, nlist)
+
+
+def suggest_training_size(n_vectors):
+    """Tamaño de muestra para entrenar: el 10% del corpus, o más si nlist lo necesita."""
+    wanted = MIN_POINTS_PER_CENTROID * suggest_nlist(n_vectors)
+    return min(n_vectors, max(int(0.1 * n_vectors), wanted, PQ_CENTROIDS * 4))
+
+
+def pq_subquantizers(dimension):
+    """Número de subcuantizadores PQ: subvectores de 8 dimensiones si la dimensión lo permite."""
+    for sub_dim in (8, 4, 16, 2, 32, 1):
+        if dimension % sub_dim == 0:
+            return dimension // sub_dim
+    return 1
+
+
+def resolve_index_spec(spec, dimension, n_vectors, n_train):
+    """Convierte un alias o una cadena de index_factory con placeholders en una cadena concreta."""
+    description = INDEX_ALIASES.get(spec.lower(), spec)
+    if "PQ" in description and n_train < PQ_CENTROIDS:
+        logger.warning(f"Solo hay {n_train} puntos de entrenamiento, insuficientes para PQ. Se usará IVF-Flat.")
+        description = INDEX_ALIASES["ivf"]
+    return description.format(nlist=suggest_nlist(n_vectors, n_train), m=pq_subquantizers(dimension))
+
+
+def try_extract_ivf(index):
+    try:
+        return faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return None
+
+
+def create_index(spec, dimension, n_vectors, n_train):
+    """
+    Crea un índice de producto interno sin entrenar a partir de `spec`.
+    Devuelve (índice, descripción resuelta). Los IVF usan direct map con hashtable
+    para admitir add_with_ids/remove_ids; el resto se envuelve en IndexIDMap2.
+    """
+    description = resolve_index_spec(spec, dimension, n_vectors, n_train)
+    index = faiss.index_factory(dimension, description, faiss.METRIC_INNER_PRODUCT)
+    ivf = try_extract_ivf(index)
+    if ivf is not None:
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+    else:
+        index = faiss.IndexIDMap2(index)
+    return index, description
+
+
+def search_param_grid(description, index):
+    """Valores de nprobe (IVF) o efSearch (HNSW) a evaluar, de menor a mayor coste."""
+    ivf = try_extract_ivf(index)
+    if ivf is not None:
+        values = [1]
+        while values[-1] * 2 <= ivf.nlist:
+            values.append(values[-1] * 2)
+        return "nprobe", values
+    if description.startswith("HNSW"):
+        return "efSearch", [16, 32, 64, 128, 256]
+    return None, []
+
+
+def apply_search_params(index, params):
+    """Aplica los parámetros de búsqueda persistidos (nprobe, efSearch) a un índice cargado."""
+    parameter_space = faiss.ParameterSpace()
+    for name, value in (params or {}).items():
+        parameter_space.set_index_parameter(index, name, value)
+
+
+def exact_search(batches, queries, k):
+    """
+    Búsqueda exacta por producto interno recorriendo los vectores lote a lote
+    (p. ej. desde los shards), sin cargarlos todos a la vez.
+    `batches` itera (ids, vectores). Devuelve (distancias, ids) como index.search.
+    """
+    best_d = np.full((len(queries), k), -np.inf, dtype="float32")
+    best_i = np.full((len(queries), k), -1, dtype="int64")
+    for ids, vectors in batches:
+        flat = faiss.IndexFlatIP(vectors.shape[1])
+        flat.add(vectors)
+        d, i = flat.search(queries, min(k, len(vectors)))
+        i = np.where(i >= 0, ids[np.maximum(i, 0)], -1)
+        all_d = np.hstack([best_d, d])
+        all_i = np.hstack([best_i, i])
+        order = np.argsort(-all_d, axis=1)[:, :k]
+        best_d = np.take_along_axis(all_d, order, axis=1)
+        best_i = np.take_along_axis(all_i, order, axis=1)
+    return best_d, best_i
+
+
+def recall_latency_report(index, description, queries, ground_truth, k=10, exact_latency_ms=None):
+    """
+    Mide recall@k frente a la búsqueda exacta y la latencia media por consulta
+    para cada valor del parámetro de búsqueda del índice.
+    """
+    param_name, values = search_param_grid(description, index)
+    rows = []
+    if exact_latency_ms is not None:
+        rows.append({"index": "IndexFlatIP (exacto)", "param": None, "value": None,
+                     "recall": 1.0, "latency_ms": exact_latency_ms})
+    for value in values or [None]:
+        if param_name:
+            apply_search_params(index, {param_name: value})
+        start = time.perf_counter()
+        _, found = index.search(queries, k)
+        latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        hits = sum(len(set(f[f >= 0]) & set(g[g >= 0])) for f, g in zip(found, ground_truth))
+        rows.append({"index": description, "param": param_name, "value": value,
+                     "recall": hits / (k * len(queries)), "latency_ms": latency_ms})
+    return rows
+
+
+def choose_search_params(report, target_recall):
+    """El valor más barato que alcanza `target_recall`; si ninguno llega, el de mayor recall."""
+    candidates = [row for row in report if row["param"]]
+    if not candidates:
+        return {}
+    for row in candidates:
+        if row["recall"] >= target_recall:
+            return {row["param"]: row["value"]}
+    best = max(candidates, key=lambda row: row["recall"])
+    return {best["param"]: best["value"]}
+
+
+def log_report(report):
+    logger.info(f"{'Índice':<24} | {'Parámetro':<14} | {'Recall@k':>9} | {'ms/consulta':>11}")
+    logger.info("-" * 68)
+    for row in report:
+        param = f"{row['param']}={row['value']}" if row["param"] else "-"
+        logger.info(f"{row['index']:<24} | {param:<14} | {row['recall']:>9.3f} | {row['latency_ms']:>11.3f}")
+
+
+def write_index_atomic(index, index_file):
+    """
+    Escribe el índice en un archivo temporal y lo renombra. Los procesos que tienen
+    mapeado el índice anterior siguen leyendo su inode sin riesgo de SIGBUS.
+    """
+    tmp_file = f"{index_file}.tmp"
+    faiss.write_index(index, tmp_file)
+    os.replace(tmp_file, index_file)
+
+
+def read_index_shared(index_file, description=None, use_mmap=True):
+    """
+    Carga el índice para servir consultas, mapeándolo en memoria en modo solo lectura.
+
+    En los IVF, IO_FLAG_MMAP sirve las listas invertidas directamente desde el archivo
+    (OnDiskInvertedLists); en Flat/HNSW, IO_FLAG_MMAP_IFC evita copiar los códigos.
+    Así el arranque no copia el índice al heap y varias réplicas comparten las páginas
+    a través del sistema operativo. Si el mmap no es posible se hace una carga normal.
+    """
+    if not use_mmap:
+        return faiss.read_index(index_file)
+    if description is None or description.startswith("IVF"):
+        flags = faiss.IO_FLAG_MMAP
+    else:
+        flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    try:
+        return faiss.read_index(index_file, flags | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError as e:
+        logger.warning(f"No se pudo mapear {index_file} en memoria ({str(e)}). Carga normal.")
+        return faiss.read_index(index_file)
@@ -0,0 +1,95 @@
+import os
+import asyncio
+import logging
+from utils.bm25 import load_bm25_index
+from utils.chunk_store import ChunkStore
+from utils.faiss_index import apply_search_params, read_index_shared
+from utils.index_manifest import load_manifest
+
+logger = logging.getLogger(__name__)
+
+
+class IndexSnapshot:
+    """Índice FAISS, almacén de chunks, índice BM25 (o None) y manifiesto de una misma generación."""
+
+    def __init__(self, index, chunks, manifest, bm25=None):
+        self.index = index
+        self.chunks = chunks
+        self.bm25 = bm25
+        self.manifest = manifest
+        self.generation = manifest.get("generation", 0)
+
+
+class IndexHolder:
+    """
+    Doble buffer del índice para los agentes que lo consultan.
+
+    `current` siempre apunta a una instantánea completa. Cuando el manifiesto en disco
+    anuncia una generación nueva, la siguiente se carga en un hilo aparte y luego se
+    sustituye la referencia de una sola vez. Una búsqueda en curso conserva la
+    instantánea que tomó al empezar, así que el cambio no le afecta.
+    Con `load_index=False` solo se cargan el almacén y el BM25 (el índice FAISS queda en None).
+    """
+
+    def __init__(self, index_file, chunk_store_dir, manifest_file, use_mmap=True, load_index=True):
+        self.index_file = index_file
+        self.chunk_store_dir = chunk_store_dir
+        self.manifest_file = manifest_file
+        self.use_mmap = use_mmap
+        self.load_index = load_index
+        self._manifest_mtime = None
+        self._loading = False
+        self.current = self._load()
+
+    def _manifest_stamp(self):
+        try:
+            return os.stat(self.manifest_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load(self):
+        stamp = self._manifest_stamp()
+        manifest = load_manifest(self.manifest_file)
+        index = None
+        if self.load_index:
+            index = read_index_shared(self.index_file, manifest.get("index_description"), self.use_mmap)
+            apply_search_params(index, manifest.get("search_params", {}))
+        chunks = ChunkStore(self.chunk_store_dir)
+        if "vectors" in manifest and ((index is not None and index.ntotal != manifest["vectors"])
+                                      or len(chunks) != manifest["next_chunk_id"]):
+            # Se leyó a mitad de una construcción; se reintentará en la próxima comprobación
+            raise RuntimeError("índice y manifiesto de generaciones distintas")
+        bm25 = load_bm25_index(self.chunk_store_dir, len(chunks))
+        if bm25 is None:
+            logger.warning("IndexHolder: sin índice BM25, la búsqueda será solo densa")
+        self._manifest_mtime = stamp
+        return IndexSnapshot(index, chunks, manifest, bm25)
+
+    def has_update(self):
+        """Comprobación barata: solo relee el manifiesto si su mtime cambió."""
+        stamp = self._manifest_stamp()
+        if stamp is None or stamp == self._manifest_mtime:
+            return False
+        generation = load_manifest(self.manifest_file).get("generation", 0)
+        if generation == self.current.generation:
+            self._manifest_mtime = stamp
+            return False
+        return True
+
+    async def refresh(self):
+        """Si hay una generación nueva la carga en segundo plano y la publica. Devuelve True si cambió."""
+        if self._loading or not self.has_update():
+            return False
+        self._loading = True
+        try:
+            loop = asyncio.get_running_loop()
+            snapshot = await loop.run_in_executor(None, self._load)
+        except Exception as e:
+            logger.warning(f"IndexHolder: no se pudo cargar la nueva generación ({str(e)})")
+            return False
+        finally:
+            self._loading = False
+        previous = self.current.generation
+        self.current = snapshot
+        logger.info(f"IndexHolder: índice recargado, generación {previous} -> {snapshot.generation}")
+        return True
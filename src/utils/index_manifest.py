@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import inspect
+import logging
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+
+def file_sha256(file_path, block_size=1 << 20):
+    """Hash del contenido de un archivo, leído por bloques para no cargarlo entero."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def empty_manifest():
+    return {
+        "version": MANIFEST_VERSION,
+        "next_chunk_id": 0,
+        "next_document_id": 0,
+        "files": {}
+    }
+
+
+def load_manifest(manifest_file):
+    """Carga el manifiesto del índice o devuelve uno vacío si no existe o es ilegible."""
+    if not os.path.exists(manifest_file):
+        return empty_manifest()
+    try:
+        with open(manifest_file, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Manifiesto ilegible {manifest_file}: {str(e)}")
+        return empty_manifest()
+    if manifest.get("version") != MANIFEST_VERSION:
+        logger.warning(f"Versión de manifiesto desconocida en {manifest_file}, se ignorará")
+        return empty_manifest()
+    return manifest
+
+
+def save_manifest(manifest, manifest_file):
+    """Escribe el manifiesto de forma atómica (archivo temporal + rename)."""
+    tmp_file = f"{manifest_file}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, manifest_file)
+
+
+def diff_corpus(manifest, file_paths):
+    """
+    Compara los archivos actuales con el manifiesto.
+    Devuelve (nuevos_o_modificados, eliminados, hashes) donde hashes mapea
+    nombre de archivo -> sha256 actual.
+    """
+    known = manifest["files"]
+    hashes = {}
+    changed = []
+    for file_path in sorted(file_paths):
+        name = os.path.basename(file_path)
+        hashes[name] = file_sha256(file_path)
+        entry = known.get(name)
+        if entry is None or entry["sha256"] != hashes[name]:
+            changed.append(file_path)
+    removed = [name for name in known if name not in hashes]
+    return changed, removed, hashes
+
+
+def describe_chunker(chunker):
+    """Nombre y parámetros efectivos de un chunker (función o functools.partial)."""
+    keywords = {}
+    func = chunker
+    while isinstance(func, partial):
+        keywords = {**func.keywords, **keywords}
+        func = func.func
+    try:
+        params = {
+            name: p.default for name, p in inspect.signature(func).parameters.items()
+            if p.default is not inspect.Parameter.empty
+        }
+    except (TypeError, ValueError):
+        params = {}
+    params.update(keywords)
+    # Solo el nombre, sin módulo: el indexer puede ejecutarse como __main__ o importarse
+    return {"name": getattr(func, "__qualname__", repr(func)),
+            "params": json.loads(json.dumps(params, default=repr))}
+
+
+def embedder_fingerprint(model_id, dimension, chunker, normalized=True, metric="inner_product"):
+    """
+    Huella de cómo se construyeron los vectores del índice. Las consultas solo son
+    comparables con ellos si se codifican con el mismo modelo y la misma normalización.
+    `dimension` puede ser None cuando aún no se conoce.
+    """
+    return {
+        "model_id": model_id,
+        "dimension": dimension,
+        "normalized": normalized,
+        "metric": metric,
+        "chunker": describe_chunker(chunker) if chunker is not None else None
+    }
+
+
+def fingerprint_mismatches(recorded, expected):
+    """Campos de `expected` que no coinciden con la huella guardada (se ignoran los None)."""
+    if not recorded:
+        return ["embedder"]
+    return [key for key, value in expected.items() if value is not None and recorded.get(key) != value]
@@ -0,0 +1,733 @@
+import os
+import glob
+import json
+import time
+import pickle
+import random
+import shutil
+import hashlib
+import logging
+import threading
+from collections import Counter, defaultdict
+from functools import partial
+import numpy as np
+import faiss
+from sentence_transformers import SentenceTransformer
+from utils.chunking import chunk_sentence_based, chunk_hierarchical
+from utils.chunk_store import ChunkStore, store_exists, append_chunks, mark_tombstones, set_duplicates, truncate_chunks
+from utils.cleaning import CLEANING_RULES, clean_text
+from utils.constants import (
+    EMBEDDING_CACHE_FILE, EMBEDDING_CACHE_MAX_BYTES, EMBEDDING_MODEL, FAISS_INDEX_SPEC, TARGET_RECALL,
+    DEDUP_MAX_DISTANCE, DEDUP_MIN_TOKENS, PARENT_CHUNK_CHARS, BM25_K1, BM25_B
+)
+from utils.bm25 import build_bm25_index, bm25_index_current
+from utils.corpus import iter_in_processes, read_text_mmap
+from utils.dedup import SimHashIndex
+from utils.embedding_cache import EmbeddingCache
+from utils.embedding_shards import EmbeddingShards
+from utils.faiss_index import (
+    create_index, suggest_training_size, exact_search, recall_latency_report,
+    choose_search_params, apply_search_params, log_report, write_index_atomic
+)
+from utils.index_manifest import (
+    load_manifest, save_manifest, empty_manifest, diff_corpus, embedder_fingerprint, fingerprint_mismatches
+)
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+STAGE_NAMES = ["load", "clean", "chunk", "dedup", "embed", "train", "add", "persist"]
+REPORT_NAME = "stage_report.json"
+# Salidas de clean y chunk, en disco dentro de shard_dir para que la memoria no crezca con el corpus
+CLEANED_DIR = "cleaned"
+STAGED_DIR = "staged_chunks"
+# Caracteres que se acumulan antes de volcar un grupo de documentos a un almacén de chunks
+FLUSH_CHARS = 32 * 2**20
+
+
+def current_rss():
+    """Memoria residente del proceso en bytes (0 si no se puede medir en esta plataforma)."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+class PeakMemory:
+    """
+    Muestrea la RSS en un hilo mientras dura el bloque y guarda el máximo en `peak`
+    y la RSS al entrar en `start`; `growth` es lo que creció por encima de esta.
+    """
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.start = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop.wait(self.interval)
+
+    @property
+    def growth(self):
+        return max(0, self.peak - self.start)
+
+    def __enter__(self):
+        self.start = self.peak = current_rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+class BuildContext:
+    """
+    Estado que las etapas se pasan de una a otra. Tras cada etapa se guarda con pickle
+    en `work_dir`, de modo que se puede volver a ejecutar la construcción desde cualquier
+    etapa partiendo de la salida guardada de la anterior.
+    """
+
+    def __init__(self, **config):
+        self.__dict__.update(config)
+        self.stop_reason = None
+        self.report = []
+
+
+# --- Etapas -------------------------------------------------------------------
+# Cada etapa recibe el contexto, lo modifica y devuelve sus estadísticas:
+# {"items": n, "unit": "...", "bytes": opcional, ...extras}. Para poner fin a la
+# construcción una etapa puede fijar ctx.stop_reason.
+
+def stage_load(ctx):
+    """Compara el corpus con el manifiesto, retira lo obsoleto del índice y lee los libros nuevos o modificados."""
+    manifest = load_manifest(ctx.manifest_file)
+    # La generación sobrevive a las reconstrucciones: los agentes la usan para detectar índices nuevos
+    ctx.generation = manifest.get("generation", 0)
+    index_exists = os.path.exists(ctx.index_file) and store_exists(ctx.chunk_store_dir)
+
+    if index_exists and not manifest["files"]:
+        # Índice anterior al manifiesto: no sabemos de qué archivo viene cada chunk
+        logger.info("Índice existente sin manifiesto. Se reconstruirá desde cero.")
+        index_exists = False
+    elif index_exists and manifest.get("index_spec") != ctx.index_spec:
+        logger.info(f"El tipo de índice pasó de {manifest.get('index_spec')} a {ctx.index_spec}. Se reconstruirá desde cero.")
+        index_exists = False
+    elif index_exists and manifest.get("cleaning_rules") != ctx.cleaning_rules:
+        logger.info("Las reglas de limpieza del texto cambiaron. Se reconstruirá desde cero.")
+        index_exists = False
+    elif index_exists and manifest.get("parent_chars") != ctx.parent_chars:
+        logger.info(f"El tamaño de los chunks padre pasó de {manifest.get('parent_chars')} a {ctx.parent_chars}. "
+                    f"Se reconstruirá desde cero.")
+        index_exists = False
+    elif index_exists:
+        mismatches = fingerprint_mismatches(manifest.get("embedder"), embedder_fingerprint(ctx.model_id, None, ctx.chunker))
+        if mismatches:
+            logger.info(f"El índice se construyó con otro embedder ({', '.join(mismatches)}). Se reconstruirá desde cero.")
+            index_exists = False
+    if not index_exists:
+        manifest = empty_manifest()
+
+    file_paths = glob.glob(os.path.join(ctx.folder_path, "*.txt"))
+    changed, removed, hashes = diff_corpus(manifest, file_paths)
+    if index_exists and not changed and not removed:
+        if not bm25_index_current(ctx.chunk_store_dir):
+            # Índice sin BM25 o tokenizado con otro tokenizador: basta con rehacer el BM25
+            _build_bm25(ctx)
+        ctx.stop_reason = "El índice está al día con el corpus."
+        return {"items": 0, "unit": "docs"}
+
+    index = None
+    stale_ids = []
+    if index_exists:
+        index = faiss.read_index(ctx.index_file)
+        if index.ntotal != manifest.get("vectors", index.ntotal):
+            # El índice se guardó en una ejecución que no llegó a escribir el manifiesto
+            logger.warning("El índice no coincide con el manifiesto. Se reconstruirá desde cero.")
+            index = None
+        else:
+            # Descartar chunks de una ejecución que guardó el almacén pero no el manifiesto
+            truncate_chunks(ctx.chunk_store_dir, manifest["next_chunk_id"])
+
+            # Tombstones: chunks de archivos eliminados o modificados
+            stale_files = removed + [os.path.basename(p) for p in changed if os.path.basename(p) in manifest["files"]]
+            for name in stale_files:
+                entry = manifest["files"][name]
+                stale_ids.extend(range(entry["first_chunk_id"], entry["first_chunk_id"] + entry["num_chunks"]))
+            if stale_ids:
+                logger.info(f"Eliminando {len(stale_ids)} chunks obsoletos de {len(stale_files)} archivos.")
+                try:
+                    index.remove_ids(np.array(stale_ids, dtype='int64'))
+                except RuntimeError as e:
+                    # p. ej. HNSW no admite borrar vectores
+                    logger.warning(f"El índice no permite eliminar vectores ({str(e)}). Se reconstruirá desde cero.")
+                    index = None
+                    stale_ids = []
+            for name in removed:
+                del manifest["files"][name]
+
+    if index is None:
+        # Con la caché de embeddings, reconstruir desde cero es barato
+        shutil.rmtree(ctx.chunk_store_dir, ignore_errors=True)
+        manifest = empty_manifest()
+        changed, removed, hashes = diff_corpus(manifest, file_paths)
+
+    ctx.manifest = manifest
+    ctx.index = index
+    ctx.stale_ids = stale_ids
+    ctx.hashes = hashes
+    # Solo las rutas: cada archivo lo lee el worker que lo limpia
+    ctx.files = sorted(changed)
+    total_bytes = sum(os.path.getsize(file_path) for file_path in ctx.files)
+    logger.info(f"{len(ctx.files)} documentos nuevos o modificados en {ctx.folder_path}.")
+    return {"items": len(ctx.files), "unit": "docs", "bytes": total_bytes}
+
+
+def _scratch_dir(ctx, name):
+    """Directorio de trabajo `name` dentro de shard_dir, vacío."""
+    path = os.path.join(ctx.shard_dir, name)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return path
+
+
+def _clean_file(file_path, rules, out_dir):
+    """Worker: lee un archivo, lo limpia y escribe el texto limpio en `out_dir`."""
+    name = os.path.basename(file_path)
+    content = read_text_mmap(file_path)
+    if content is None:
+        # Un archivo vacío sigue su curso sin chunks para que salga del manifiesto
+        return name, None, 0, {}
+    text, removed = clean_text(content, name, rules)
+    path = os.path.join(out_dir, name)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+    return name, path, len(content.encode("utf-8")), removed
+
+
+def stage_clean(ctx):
+    """
+    Limpia cada documento según las reglas de su fuente en un pool de procesos. Cada
+    worker lee su archivo y deja el texto limpio en disco: en memoria solo están los
+    documentos en vuelo.
+    """
+    out_dir = _scratch_dir(ctx, CLEANED_DIR)
+    worker = partial(_clean_file, rules=ctx.cleaning_rules, out_dir=out_dir)
+    total_bytes = 0
+    bytes_removed = Counter()
+    ctx.documents = []
+    for name, path, size, removed in iter_in_processes(worker, ctx.files, ctx.workers):
+        total_bytes += size
+        bytes_removed.update(removed)
+        ctx.documents.append((name, path))
+    detail = ", ".join(f"{step}: {n}" for step, n in bytes_removed.items() if n)
+    logger.info(f"Limpieza del texto: {sum(bytes_removed.values())} bytes eliminados ({detail or 'nada'}).")
+    return {"items": len(ctx.documents), "unit": "docs", "bytes": total_bytes,
+            "bytes_removed": sum(bytes_removed.values()), "bytes_removed_by_step": dict(bytes_removed)}
+
+
+def _chunk_file(document, chunker, parent_chars, ranges_chunker=None):
+    """Worker: trocea un documento limpio. Devuelve (nombre, padres, [(padre, hijo)])."""
+    name, path = document
+    if path is None:
+        return name, [], []
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    if parent_chars is None:
+        return name, [], [(-1, chunk) for chunk in chunker(text)]
+    parents, children = chunk_hierarchical(text, chunker, parent_chars, ranges_chunker)
+    return name, parents, children
+
+
+def stage_chunk(ctx):
+    """
+    Trocea los documentos limpios en un pool de procesos: primero en chunks padre de
+    hasta `ctx.parent_chars` y cada padre en los chunks hijo de `ctx.chunker` (o de
+    `ctx.ranges_chunker`, con todos los padres de un documento a la vez). Los
+    chunks se vuelcan por grupos de documentos a un almacén provisional en disco, del
+    que leen dedup, embed y persist.
+    """
+    staged_dir = _scratch_dir(ctx, STAGED_DIR)
+    worker = partial(_chunk_file, chunker=ctx.chunker, parent_chars=ctx.parent_chars,
+                     ranges_chunker=ctx.ranges_chunker)
+    total_bytes = sum(os.path.getsize(path) for _, path in ctx.documents if path)
+    # (nombre, primer chunk, nº de chunks, primer padre, nº de padres) en el almacén provisional
+    ctx.chunked = []
+    records, parents, pending_chars = [], [], 0
+    n_chunks = n_parents = 0
+    for name, doc_parents, children in iter_in_processes(worker, ctx.documents, ctx.workers):
+        ctx.chunked.append((name, n_chunks, len(children), n_parents, len(doc_parents)))
+        first_parent = len(parents)
+        parents.extend(doc_parents)
+        for parent, chunk in children:
+            records.append({"document_id": 0, "text": chunk, "file": name,
+                            "parent": first_parent + parent if parent >= 0 else -1})
+            pending_chars += len(chunk)
+        pending_chars += sum(len(parent) for parent in doc_parents)
+        n_chunks += len(children)
+        n_parents += len(doc_parents)
+        if pending_chars >= FLUSH_CHARS:
+            append_chunks(staged_dir, records, parents)
+            records, parents, pending_chars = [], [], 0
+    append_chunks(staged_dir, records, parents)
+    return {"items": n_chunks, "unit": "chunks", "bytes": total_bytes, "parents": n_parents}
+
+
+def stage_dedup(ctx):
+    """
+    Asigna ids a los chunks y detecta los casi duplicados con SimHash. Los duplicados se
+    guardan con `duplicate_of` apuntando al original pero no se embeben. Los duplicados
+    cuyo original se elimina pasan a ser originales (o duplicados de otro) y se embeben.
+    Los textos se leen del almacén provisional; aquí solo se guardan ids y columnas.
+    """
+    manifest = ctx.manifest
+    dedup = SimHashIndex(ctx.dedup_max_distance, ctx.dedup_min_tokens)
+    ctx.reassigned = {}
+    ctx.chunk_ids, ctx.row_document_ids = [], []
+    if ctx.index is not None:
+        chunks = ChunkStore(ctx.chunk_store_dir)
+        stale = np.zeros(len(chunks), dtype=bool)
+        stale[np.array(ctx.stale_ids, dtype='int64')] = True
+        live = ~np.asarray(chunks.tombstones) & ~stale
+        duplicate_of = np.asarray(chunks.duplicate_of)
+        for chunk_id in np.flatnonzero(live & (duplicate_of < 0)):
+            dedup.add(int(chunk_id), int(chunks.simhashes[chunk_id]))
+        orphans = np.flatnonzero(live & (duplicate_of >= 0) & stale[np.maximum(duplicate_of, 0)])
+        for chunk_id in orphans.tolist():
+            _, original = dedup.check(chunk_id, chunks.text(chunk_id))
+            ctx.reassigned[chunk_id] = original
+            if original < 0:
+                ctx.chunk_ids.append(chunk_id)
+                ctx.row_document_ids.append(int(chunks.document_ids[chunk_id]))
+        chunks.close()
+        if ctx.reassigned:
+            logger.info(f"{len(ctx.reassigned)} duplicados pierden su original; {len(ctx.chunk_ids)} se embeberán.")
+
+    staged = ChunkStore(os.path.join(ctx.shard_dir, STAGED_DIR))
+    # Columnas de los chunks nuevos, en el orden del almacén provisional
+    ctx.new_document_ids, ctx.new_simhashes, ctx.new_duplicates = [], [], []
+    ctx.n_duplicates = 0
+    for name, first, count, _, _ in ctx.chunked:
+        if not count:
+            manifest["files"].pop(name, None)
+            continue
+        previous = manifest["files"].get(name)
+        if previous is not None:
+            doc_id = previous["document_id"]
+        else:
+            doc_id = manifest["next_document_id"]
+            manifest["next_document_id"] += 1
+
+        # Los ids de un documento son contiguos: basta con guardar el primero y la cantidad
+        first_id = manifest["next_chunk_id"] + first
+        for chunk_id, position in enumerate(range(first, first + count), start=first_id):
+            value, original = dedup.check(chunk_id, staged.text(position))
+            ctx.new_document_ids.append(doc_id)
+            ctx.new_simhashes.append(value)
+            ctx.new_duplicates.append(original)
+            if original < 0:
+                ctx.chunk_ids.append(chunk_id)
+                ctx.row_document_ids.append(doc_id)
+            else:
+                ctx.n_duplicates += 1
+        manifest["files"][name] = {
+            "sha256": ctx.hashes[name],
+            "document_id": doc_id,
+            "first_chunk_id": first_id,
+            "num_chunks": count
+        }
+    staged.close()
+    n_new = len(ctx.new_document_ids)
+    if ctx.n_duplicates:
+        logger.info(f"Deduplicación: {ctx.n_duplicates} de {n_new} chunks nuevos son "
+                    f"casi duplicados y no se embeben.")
+    if not ctx.chunk_ids and ctx.index is None:
+        ctx.stop_reason = "No se generaron chunks válidos para indexar."
+    return {"items": n_new, "unit": "chunks", "duplicates": ctx.n_duplicates}
+
+
+def iter_embed_texts(ctx):
+    """
+    Textos de ctx.chunk_ids en orden, leídos de disco: los duplicados que recuperan su
+    vector vienen del almacén actual y los chunks nuevos del provisional.
+    """
+    base = ctx.manifest["next_chunk_id"]
+    chunks = ChunkStore(ctx.chunk_store_dir) if ctx.chunk_ids and ctx.chunk_ids[0] < base else None
+    staged = ChunkStore(os.path.join(ctx.shard_dir, STAGED_DIR))
+    try:
+        for chunk_id in ctx.chunk_ids:
+            yield chunks.text(chunk_id) if chunk_id < base else staged.text(chunk_id - base)
+    finally:
+        staged.close()
+        if chunks is not None:
+            chunks.close()
+
+
+def stage_embed(ctx):
+    """
+    Embebe los chunks únicos. Los embeddings pasan por la caché persistente y se
+    escriben por lotes en shards con checkpoint: una ejecución interrumpida se retoma.
+    """
+    texts_digest = hashlib.sha256()
+    for text in iter_embed_texts(ctx):
+        texts_digest.update(text.encode("utf-8") + b"\x00")
+    ctx.build_key = hashlib.sha256(json.dumps({
+        "model": ctx.model_id,
+        "next_chunk_id": ctx.manifest["next_chunk_id"],
+        "chunks": [ctx.chunk_ids[0], ctx.chunk_ids[-1], len(ctx.chunk_ids)] if ctx.chunk_ids else [],
+        "texts": texts_digest.hexdigest()
+    }).encode("utf-8")).hexdigest()
+    store = EmbeddingShards(ctx.shard_dir, ctx.build_key)
+    if store.rows:
+        logger.info(f"Retomando embeddings desde el checkpoint: {store.rows} filas ya calculadas.")
+
+    embedder = None
+    embedding_cache = EmbeddingCache(EMBEDDING_CACHE_FILE, EMBEDDING_CACHE_MAX_BYTES)
+
+    def encode_misses(texts):
+        # El modelo solo se carga si algún chunk no está en la caché
+        nonlocal embedder
+        if embedder is None:
+            embedder = SentenceTransformer(ctx.model_id)
+        return embedder.encode(texts, convert_to_numpy=True, batch_size=512)
+
+    def encode(texts):
+        embeddings = embedding_cache.encode(ctx.model_id, texts, encode_misses)
+        # Normalizar los embeddings para similitud coseno
+        faiss.normalize_L2(embeddings)
+        return embeddings
+
+    try:
+        encoded = store.extend(iter_embed_texts(ctx), encode, batch_size=512)
+    finally:
+        logger.info(f"Caché de embeddings: {embedding_cache.hits} aciertos, {embedding_cache.misses} fallos "
+                    f"({embedding_cache.hit_rate():.1%})")
+        embedding_cache.close()
+    return {"items": len(ctx.chunk_ids), "unit": "chunks", "encoded": encoded,
+            "cache_hits": embedding_cache.hits, "cache_misses": embedding_cache.misses}
+
+
+def train_index(store, document_ids, index_spec):
+    """
+    Crea y entrena el índice descrito por `index_spec` con un submuestreo estratificado
+    por documento (`document_ids` da el documento de cada fila de los shards).
+    Solo la muestra se copia a memoria; el resto se queda en los shards.
+    """
+    n_train = suggest_training_size(store.rows)
+    doc_indices = defaultdict(list)
+    for idx, doc_id in enumerate(document_ids):
+        doc_indices[doc_id].append(idx)
+
+    training_indices = []
+    for doc_id, indices in doc_indices.items():
+        n_sample = max(1, round(n_train * len(indices) / store.rows))  # al menos 1
+        sampled = random.sample(indices, min(n_sample, len(indices)))
+        training_indices.extend(sampled)
+
+    index, description = create_index(index_spec, store.dimension, store.rows, len(training_indices))
+    logger.info(f"Índice FAISS '{description}' para {store.rows} embeddings.")
+    if not index.is_trained:
+        logger.info(f"Entrenando el índice con {len(training_indices)} embeddings seleccionados...")
+        index.train(store.take(training_indices))
+    return index, description, len(training_indices)
+
+
+def stage_train(ctx):
+    """Crea y entrena el índice solo al construir desde cero; en una actualización se reutiliza."""
+    ctx.trained_now = ctx.index is None and bool(ctx.chunk_ids)
+    if not ctx.trained_now:
+        return {"items": 0, "unit": "vectors"}
+    logger.info(f"Construyendo el índice FAISS ({ctx.index_spec})...")
+    store = EmbeddingShards(ctx.shard_dir, ctx.build_key)
+    ctx.index, ctx.description, n_train = train_index(store, ctx.row_document_ids, ctx.index_spec)
+    return {"items": n_train, "unit": "vectors"}
+
+
+def calibrate_search_params(index, description, store, chunk_ids, n_queries=200, k=10):
+    """
+    Compara el índice con una búsqueda exacta (IndexFlatIP) usando como consultas una
+    muestra de los propios chunks, y elige el parámetro de búsqueda más barato que
+    alcanza TARGET_RECALL. Devuelve (parámetros, informe).
+    """
+    sample = random.sample(range(store.rows), min(n_queries, store.rows))
+    queries = store.take(sample)
+    ids = np.array(chunk_ids, dtype='int64')
+    batches = ((ids[start:start + len(batch)], batch) for start, batch in store.iter_batches())
+
+    start = time.perf_counter()
+    _, ground_truth = exact_search(batches, queries, k)
+    exact_latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    report = recall_latency_report(index, description, queries, ground_truth, k, exact_latency_ms)
+    log_report(report)
+    params = choose_search_params(report, TARGET_RECALL)
+    apply_search_params(index, params)
+    logger.info(f"Parámetros de búsqueda elegidos: {params or 'ninguno'}")
+    return params, report
+
+
+def stage_add(ctx):
+    """Añade los vectores leyendo shard a shard y, si el índice es nuevo, calibra nprobe/efSearch."""
+    if not ctx.chunk_ids:
+        return {"items": 0, "unit": "vectors"}
+    store = EmbeddingShards(ctx.shard_dir, ctx.build_key)
+    ids = np.array(ctx.chunk_ids, dtype='int64')
+    min_norm, max_norm = np.inf, 0.0
+    for start, batch in store.iter_batches():
+        ctx.index.add_with_ids(batch, ids[start:start + len(batch)])
+        norms = np.linalg.norm(batch, axis=1)
+        min_norm, max_norm = min(min_norm, norms.min()), max(max_norm, norms.max())
+    logger.info(f"Normas de embeddings - Min: {min_norm:.4f}, Max: {max_norm:.4f}")
+
+    if ctx.trained_now:
+        params, report = calibrate_search_params(ctx.index, ctx.description, store, ctx.chunk_ids)
+        ctx.manifest["index_spec"] = ctx.index_spec
+        ctx.manifest["index_description"] = ctx.description
+        ctx.manifest["embedder"] = embedder_fingerprint(ctx.model_id, store.dimension, ctx.chunker)
+        ctx.manifest["cleaning_rules"] = ctx.cleaning_rules
+        ctx.manifest["parent_chars"] = ctx.parent_chars
+        ctx.manifest["search_params"] = params
+        ctx.manifest["recall_report"] = report
+    return {"items": len(ctx.chunk_ids), "unit": "vectors"}
+
+
+def _build_bm25(ctx):
+    chunks = ChunkStore(ctx.chunk_store_dir)
+    try:
+        return build_bm25_index(chunks, ctx.chunk_store_dir, BM25_K1, BM25_B, ctx.workers)
+    finally:
+        chunks.close()
+
+
+def _append_staged(ctx):
+    """
+    Copia los chunks nuevos del almacén provisional al definitivo, por grupos de
+    documentos de hasta FLUSH_CHARS caracteres. Devuelve cuántos padres se añadieron.
+    """
+    staged = ChunkStore(os.path.join(ctx.shard_dir, STAGED_DIR))
+    records, parents, pending_chars, n_parents = [], [], 0, 0
+    row = 0
+    try:
+        for name, first, count, first_parent, parent_count in ctx.chunked:
+            if not count:
+                continue
+            group_parent = len(parents)
+            parents.extend(staged.parent_text(p) for p in range(first_parent, first_parent + parent_count))
+            for position in range(first, first + count):
+                parent = int(staged.parents[position])
+                text = staged.text(position)
+                records.append({
+                    'document_id': ctx.new_document_ids[row],
+                    'text': text,
+                    'source': 'internet_archive',
+                    'file': name,
+                    'simhash': ctx.new_simhashes[row],
+                    'duplicate_of': ctx.new_duplicates[row],
+                    'parent': parent - first_parent + group_parent if parent >= 0 else -1
+                })
+                pending_chars += len(text)
+                row += 1
+            pending_chars += sum(len(parent) for parent in parents[group_parent:])
+            n_parents += parent_count
+            if pending_chars >= FLUSH_CHARS:
+                append_chunks(ctx.chunk_store_dir, records, parents)
+                records, parents, pending_chars = [], [], 0
+        append_chunks(ctx.chunk_store_dir, records, parents)
+    finally:
+        staged.close()
+    return n_parents
+
+
+def stage_persist(ctx):
+    """Guarda el índice, el almacén de chunks, su índice BM25 y por último el manifiesto."""
+    manifest = ctx.manifest
+    n_new = len(ctx.new_document_ids)
+    # Si se repite la etapa desde una salida guardada, lo que escribió la vez anterior se descarta
+    truncate_chunks(ctx.chunk_store_dir, manifest["next_chunk_id"])
+    manifest["next_chunk_id"] += n_new
+    write_index_atomic(ctx.index, ctx.index_file)
+    if ctx.stale_ids:
+        mark_tombstones(ctx.chunk_store_dir, ctx.stale_ids)
+    if ctx.reassigned:
+        set_duplicates(ctx.chunk_store_dir, list(ctx.reassigned), list(ctx.reassigned.values()))
+    n_parents = _append_staged(ctx)
+    # Antes del manifiesto: un agente que recarga la nueva generación encuentra su BM25
+    bm25 = _build_bm25(ctx)
+    manifest["vectors"] = int(ctx.index.ntotal)
+    # Del manifiesto en disco y no solo del contexto: si se repite persist desde una
+    # salida guardada, la generación tiene que seguir subiendo
+    manifest["generation"] = max(load_manifest(ctx.manifest_file).get("generation", 0), ctx.generation) + 1
+    save_manifest(manifest, ctx.manifest_file)
+    if not ctx.cache_stages:
+        # Con las salidas guardadas se conservan para poder repetir train/add
+        shutil.rmtree(ctx.shard_dir, ignore_errors=True)
+
+    logger.info(f"Índice actualizado con éxito. Documentos: {len(manifest['files'])}, "
+                f"chunks nuevos: {n_new} ({ctx.n_duplicates} duplicados, {n_parents} padres), "
+                f"chunks eliminados: {len(ctx.stale_ids)}, vectores: {ctx.index.ntotal}")
+    return {"items": n_new, "unit": "chunks", "bm25_terms": len(bm25.terms)}
+
+
+DEFAULT_STAGES = {
+    "load": stage_load,
+    "clean": stage_clean,
+    "chunk": stage_chunk,
+    "dedup": stage_dedup,
+    "embed": stage_embed,
+    "train": stage_train,
+    "add": stage_add,
+    "persist": stage_persist
+}
+
+
+class IndexBuildPipeline:
+    """
+    Construcción (o actualización incremental) del índice en etapas explícitas:
+    load -> clean -> chunk -> dedup -> embed -> train -> add -> persist.
+
+    Cada etapa se puede sustituir con `set_stage` y de cada una se registra el tiempo
+    de pared, el rendimiento (elementos/s y MB/s) y el pico de memoria residente del
+    proceso. Con `cache_stages=True` el contexto se guarda en `work_dir` tras cada
+    etapa y `run(start="embed")` repite la construcción desde ahí, sin volver a leer,
+    limpiar ni trocear; así se puede medir y optimizar una etapa concreta.
+
+    Ni los documentos ni los chunks pasan enteros por memoria: clean y chunk reparten
+    los archivos en un pool de procesos con un número acotado en vuelo y dejan su
+    salida (texto limpio y un almacén de chunks provisional) en `shard_dir`, junto a
+    los shards de embeddings; dedup, embed y persist la leen de ahí. El contexto que
+    se guarda tras cada etapa solo lleva rutas, ids y columnas.
+
+    En persist se actualiza además el índice BM25 (utils/bm25.py) de los chunks vivos,
+    tokenizando solo los nuevos; el SearchAgent lo usa como segundo recuperador junto a
+    FAISS y el EvaluationAgent para puntuar los candidatos, los dos mapeándolo en memoria.
+
+    Los chunks hijo (los que se embeben) se cortan dentro de chunks padre de hasta
+    `parent_chars` caracteres (None para no usar padres). `ranges_chunker`, opcional, es
+    la variante por tramos de `chunker` (ranges_chunker(texto, [(inicio, fin)]) devuelve
+    una lista de chunks por tramo, los mismos que daría `chunker` con cada tramo): con
+    ella cada documento se trocea de una vez y no padre a padre.
+    Por defecto los hijos son de oraciones de hasta 1000 caracteres, con EMBEDDING_MODEL
+    y FAISS_INDEX_SPEC (el indexer pasa su chunk_text, que corta al límite de tokens del
+    modelo); cualquier otra combinación de chunker, modelo o índice se obtiene con los
+    argumentos del constructor.
+    """
+
+    def __init__(self, folder_path, index_file='faiss_index.bin', chunk_store_dir='chunk_store',
+                 manifest_file='index_manifest.json', shard_dir='embedding_shards', work_dir='build_cache',
+                 chunker=chunk_sentence_based, model_id=EMBEDDING_MODEL, index_spec=FAISS_INDEX_SPEC,
+                 cleaning_rules=None, workers=None, dedup_max_distance=DEDUP_MAX_DISTANCE,
+                 dedup_min_tokens=DEDUP_MIN_TOKENS, parent_chars=PARENT_CHUNK_CHARS, cache_stages=False,
+                 ranges_chunker=None):
+        self.config = {
+            "folder_path": folder_path,
+            "index_file": index_file,
+            "chunk_store_dir": chunk_store_dir,
+            "manifest_file": manifest_file,
+            "shard_dir": shard_dir,
+            "work_dir": work_dir,
+            "chunker": chunker,
+            "ranges_chunker": ranges_chunker,
+            "model_id": model_id,
+            "index_spec": index_spec,
+            "cleaning_rules": CLEANING_RULES if cleaning_rules is None else cleaning_rules,
+            "workers": workers,
+            "dedup_max_distance": dedup_max_distance,
+            "dedup_min_tokens": dedup_min_tokens,
+            "parent_chars": parent_chars,
+            "cache_stages": cache_stages
+        }
+        self.stages = dict(DEFAULT_STAGES)
+
+    def set_stage(self, name, stage):
+        """Sustituye la etapa `name` por `stage(ctx) -> estadísticas`."""
+        if name not in self.stages:
+            raise ValueError(f"Etapa desconocida: {name}. Etapas: {', '.join(STAGE_NAMES)}")
+        self.stages[name] = stage
+
+    def _snapshot_path(self, name):
+        return os.path.join(self.config["work_dir"], f"{STAGE_NAMES.index(name)}_{name}.pkl")
+
+    def _save_snapshot(self, name, ctx):
+        os.makedirs(self.config["work_dir"], exist_ok=True)
+        tmp_file = self._snapshot_path(name) + ".tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(ctx.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self._snapshot_path(name))
+
+    def _load_snapshot(self, start):
+        previous = STAGE_NAMES[STAGE_NAMES.index(start) - 1]
+        path = self._snapshot_path(previous)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No hay salida guardada de la etapa '{previous}' en {path}")
+        ctx = BuildContext()
+        with open(path, "rb") as f:
+            ctx.__dict__.update(pickle.load(f))
+        # La configuración actual manda (p. ej. repetir train con otro index_spec)
+        ctx.__dict__.update(self.config)
+        ctx.stop_reason = None
+        ctx.report = [row for row in ctx.report if STAGE_NAMES.index(row["stage"]) < STAGE_NAMES.index(start)]
+        logger.info(f"Retomando la construcción en '{start}' con la salida guardada de '{previous}'.")
+        return ctx
+
+    def run(self, start="load", stop=None):
+        """
+        Ejecuta las etapas de `start` a `stop` (incluida). Devuelve el contexto, con el
+        informe por etapa en ctx.report, o None si una etapa falló.
+        """
+        if start not in STAGE_NAMES or (stop is not None and stop not in STAGE_NAMES):
+            raise ValueError(f"Etapas válidas: {', '.join(STAGE_NAMES)}")
+        ctx = BuildContext(**self.config) if start == "load" else self._load_snapshot(start)
+        last = STAGE_NAMES.index(stop) if stop else len(STAGE_NAMES) - 1
+
+        for name in STAGE_NAMES[STAGE_NAMES.index(start):last + 1]:
+            started = time.perf_counter()
+            try:
+                with PeakMemory() as memory:
+                    stats = self.stages[name](ctx) or {}
+            except Exception as e:
+                logger.error(f"Error en la etapa '{name}': {str(e)}")
+                return None
+            seconds = time.perf_counter() - started
+            row = {"stage": name, "seconds": round(seconds, 4), "peak_rss_mb": round(memory.peak / 2**20, 1)}
+            row.update(stats)
+            items = stats.get("items", 0)
+            row["per_second"] = round(items / seconds, 1) if seconds > 0 else None
+            if stats.get("bytes"):
+                row["mb_per_second"] = round(stats["bytes"] / 2**20 / seconds, 2) if seconds > 0 else None
+            ctx.report.append(row)
+
+            if ctx.stop_reason:
+                logger.info(f"{ctx.stop_reason} Fin de la construcción tras '{name}'.")
+                break
+            if ctx.cache_stages:
+                self._save_snapshot(name, ctx)
+
+        self.log_report(ctx.report)
+        if ctx.cache_stages:
+            with open(os.path.join(ctx.work_dir, REPORT_NAME), "w", encoding="utf-8") as f:
+                json.dump(ctx.report, f, ensure_ascii=False, indent=1)
+        return ctx
+
+    @staticmethod
+    def log_report(report):
+        logger.info(f"{'Etapa':<8} | {'Segundos':>9} | {'Elementos':>10} | {'Por segundo':>14} | {'MB/s':>7} | {'Pico RSS MB':>11}")
+        logger.info("-" * 75)
+        for row in report:
+            rate = f"{row['per_second']} {row.get('unit', '')}" if row.get("per_second") is not None else "-"
+            mb_rate = row.get("mb_per_second")
+            logger.info(f"{row['stage']:<8} | {row['seconds']:>9.3f} | {row.get('items', 0):>10} | {rate:>14} | "
+                        f"{mb_rate if mb_rate is not None else '-':>7} | {row['peak_rss_mb']:>11}")
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBatcher:
+    """
+    Agrupa en lotes las consultas que llegan casi a la vez.
+
+    `submit` encola una consulta y espera su resultado. La primera consulta de un lote
+    abre una ventana de `window_ms` milisegundos; el lote se procesa al cerrarse la
+    ventana o al reunir `max_batch` consultas, con una sola llamada a
+    `process_batch(lista de consultas) -> lista de resultados` (en el mismo orden), y
+    cada resultado se devuelve a quien lo pidió.
+
+    `process_batch` se ejecuta en `executor` (el del event loop si es None), nunca en
+    el propio loop: mientras se codifica un lote el agente sigue recibiendo mensajes y
+    formando el siguiente. Como mucho hay `max_inflight` lotes en proceso y
+    `max_pending` consultas en cola (0 = sin límite); con la cola llena `submit`
+    espera, así que bajo carga la latencia crece sin bloquear al agente.
+    """
+
+    def __init__(self, process_batch, window_ms=10, max_batch=32, executor=None, max_inflight=1, max_pending=0):
+        self.process_batch = process_batch
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.executor = executor
+        self.max_inflight = max_inflight
+        self.max_pending = max_pending
+        self.batches = 0
+        self.queries = 0
+        self._queue = None
+        self._inflight = None
+        self._worker = None
+        self._tasks = set()
+
+    async def submit(self, query):
+        loop = asyncio.get_running_loop()
+        if self._worker is None:
+            # Se crean aquí para quedar ligados al event loop del agente
+            self._queue = asyncio.Queue(self.max_pending)
+            self._inflight = asyncio.Semaphore(self.max_inflight)
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        await self._queue.put((query, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Con max_inflight lotes en proceso las consultas se acumulan en la cola y
+            # el siguiente lote sale más grande
+            await self._inflight.acquire()
+            batch = await self._collect()
+            task = loop.create_task(self._process(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, batch):
+        queries = [query for query, _ in batch]
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.executor, self.process_batch, queries)
+        except Exception as e:
+            logger.warning(f"QueryBatcher: error procesando un lote de {len(batch)} consultas: {str(e)}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._inflight.release()
+        self.batches += 1
+        self.queries += len(batch)
+        for (_, future), result in zip(batch, results):
+            # Quien pidió la consulta pudo haberse cancelado mientras tanto
+            if not future.done():
+                future.set_result(result)
+
+    def mean_batch_size(self):
+        return self.queries / self.batches if self.batches else 0.0
+
+    def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for task in list(self._tasks):
+            task.cancel()
@@ -0,0 +1,79 @@
+import re
+import time
+import logging
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_query(query):
+    """Clave de caché de una consulta: NFC, minúsculas, espacios simples y sin signos de los extremos."""
+    query = unicodedata.normalize("NFC", query).lower()
+    return _SPACES_RE.sub(" ", query).strip(" ¿?¡!.,;:\"'")
+
+
+class QueryCache:
+    """
+    Caché LRU de resultados de búsqueda, acotada en tamaño y con caducidad.
+
+    La clave es la consulta expandida y normalizada; el valor, lo que se obtuvo al
+    buscarla (embedding de la consulta, distancias e ids del top-k). Los ids solo
+    valen para la generación del índice con la que se buscaron, así que la caché se
+    vacía en cuanto se le pide o se le da un resultado de otra generación; un resultado
+    de una generación anterior a la actual simplemente no se guarda.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _check_generation(self, generation):
+        if generation != self.generation:
+            if self._entries:
+                logger.info(f"QueryCache: generación {self.generation} -> {generation}, "
+                            f"se descartan {len(self._entries)} consultas (aciertos {self.hit_rate():.1%})")
+            self._entries.clear()
+            self.generation = generation
+
+    def get(self, query, generation):
+        self._check_generation(generation)
+        key = normalize_query(query)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < self.clock():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, query, generation, value):
+        if self.generation is not None and generation < self.generation:
+            return
+        self._check_generation(generation)
+        key = normalize_query(query)
+        self._entries[key] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hit_rate(), "generation": self.generation}
@@ -5,4 +5,41 @@ testingqueries = [
     "¿Por qué el sistema de Tolomeo se basaba en la idea de que los objetos estelares debían moverse describiendo círculos perfectos?",
     "Holiiiiisss",
     "ZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZ"
-]
\ No newline at end of file
+]
+# Consultas etiquetadas para evaluar la recuperación (test/testingChunks.py).
+# Un chunk es relevante si contiene todas las palabras de alguno de los grupos de
+# `evidence` (sin distinguir mayúsculas ni acentos); así la etiqueta no depende de
+# cómo se trocee el texto. Las consultas sin respuesta en el corpus llevan evidence=[].
+labeled_queries = [
+    {"query": testingqueries[0], "evidence": [["john gribbin", "historia de la ciencia"]]},
+    {"query": testingqueries[1], "evidence": [["john gribbin, 2001"], ["historia de la ciencia", "1543-2001"]]},
+    {"query": testingqueries[2], "evidence": [["tolomeo", "círculos perfectos"]]},
+    {"query": testingqueries[3], "evidence": []},
+    {"query": testingqueries[4], "evidence": []},
+    {"query": "¿En qué año publicó Copérnico De Revolutionibus?",
+     "evidence": [["copérnico", "revolutionibus", "1543"]]},
+    {"query": "¿Qué obra de anatomía publicó Vesalio?",
+     "evidence": [["vesalio", "corporis fabrica"]]},
+    {"query": "¿Qué despertó el interés de Tycho Brahe por la astronomía a los 13 años?",
+     "evidence": [["tycho", "eclipse"]]},
+    {"query": "¿Cómo descubrió Galileo la regularidad del péndulo?",
+     "evidence": [["galileo", "péndulo"], ["péndulo", "pulso"]]},
+    {"query": "¿Cuándo publicó Newton los Principia?",
+     "evidence": [["newton", "principia", "1687"]]},
+    {"query": "¿Con qué plantas estudió Mendel la herencia?",
+     "evidence": [["mendel", "guisantes"]]},
+    {"query": "¿Quién relacionó la combustión con el oxígeno?",
+     "evidence": [["lavoisier", "oxígeno"]]},
+    {"query": "¿Cuál fue el mecanismo de la evolución que propuso Darwin?",
+     "evidence": [["darwin", "selección natural"]]},
+    {"query": "¿Qué facciones se disputaban la sucesión de Porfirio Díaz?",
+     "evidence": [["científicos", "reyistas"]]},
+    {"query": "¿Qué hicieron los rangers de Texas ante la actividad guerrillera mexicana?",
+     "evidence": [["rangers", "mexicanos"]]},
+    {"query": "¿Qué cargo ocupó Madero en el Centro Antirreeleccionista?",
+     "evidence": [["madero", "antirreeleccionista"]]},
+    {"query": "¿Qué procesos históricos conmemoran los números de Historia Mexicana sobre 1808, 1810 y 1910?",
+     "evidence": [["1810", "1910"]]},
+    {"query": "¿Quiénes eran los revolucionarios fundamentales de la revolución mexicana?",
+     "evidence": [["pancho villa", "emiliano zapata"]]}
+]
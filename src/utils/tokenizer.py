@@ -0,0 +1,64 @@
+import re
+from functools import lru_cache
+from nltk.stem.snowball import SpanishStemmer
+from utils.constants import QUERY_TOKENS_CACHE_SIZE
+
+# Tokenizador del camino léxico (BM25 al indexar y al consultar): una sola expresión
+# regular sobre el texto en minúsculas, sin stopwords, con stemming Snowball y sin
+# acentos. Si cambia cualquier paso hay que subir la versión: el BM25 guardado con
+# otra versión se vuelve a construir entero.
+TOKENIZER_VERSION = "es-snowball-1"
+
+# Palabras (letras y dígitos); los signos de puntuación y el guion bajo separan
+_WORD_RE = re.compile(r"[^\W_]+")
+# La ñ se conserva: "año" y "ano" no son la misma palabra
+_FOLD = str.maketrans("áéíóúüàèìòùâêîôûäëïö", "aeiouuaeiouaeiouaeio")
+_STEMMER = SpanishStemmer()
+
+# Ya sin acentos, porque se comparan con la palabra plegada
+STOPWORDS = frozenset("""
+a al algo algun alguna algunas alguno algunos ante antes aquel aquella aquellas aquello aquellos aqui asi
+aun aunque bajo bien cada casi como con contra cual cuales cualquier cuando cuanto de del desde donde dos
+durante e el ella ellas ello ellos en entre era eramos eran eras eres es esa esas ese eso esos esta estaba
+estaban estado estamos estan estar estas este esto estos estoy fue fueron fui fuimos ha habia habian haber
+habra han has hasta hay he hemos hizo la las le les lo los mas me mi mis mismo mucho muchos muy nada ni no
+nos nosotros nuestra nuestras nuestro nuestros o os otra otras otro otros para pero poco por porque pues que
+quien quienes se sea sean ser sera si sido siempre sin sino sobre sois solo somos son soy su sus suya suyas
+suyo suyos tal tambien tan tanto te tenia tenian tener tengo ti tiene tienen toda todas todo todos tu tus
+u un una unas uno unos usted ustedes vosotros y ya yo
+""".split())
+
+
+@lru_cache(maxsize=200000)
+def _term(word):
+    """Término de una palabra en minúsculas: su raíz sin acentos, o None si es una stopword."""
+    if word.translate(_FOLD) in STOPWORDS:
+        return None
+    # El stemmer espera las tildes originales (sus sufijos las llevan) y las quita él mismo
+    return _STEMMER.stem(word).translate(_FOLD)
+
+
+def tokenize(text):
+    """Términos léxicos de un texto, en orden y con repeticiones."""
+    terms = []
+    for word in _WORD_RE.findall(text.lower()):
+        term = _term(word)
+        if term:
+            terms.append(term)
+    return terms
+
+
+@lru_cache(maxsize=QUERY_TOKENS_CACHE_SIZE)
+def _tokenize_query(query):
+    return tuple(tokenize(query))
+
+
+def tokenize_query(query):
+    """Como tokenize, para consultas: las repetidas no se vuelven a tokenizar."""
+    return list(_tokenize_query(query))
+
+
+def clear_caches():
+    """Vacía las cachés de raíces y de consultas (p. ej. para medir el tokenizador en frío)."""
+    _term.cache_clear()
+    _tokenize_query.cache_clear()